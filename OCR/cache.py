@@ -0,0 +1,158 @@
+# ----- Cache su disco dei testi estratti con OCR -----
+import os
+import json
+import socket
+import time
+import hashlib
+import threading
+from utils.style import *
+from utils.config import ocr_cache_dir, ocr_cache_max_mb, ocr_cache_max_giorni
+
+
+class OCRCache:
+    """
+    Cache persistente dei testi OCR indicizzata sul contenuto del PDF.
+    Ogni voce è un file JSON con testo e numero di token, la chiave è
+    l'hash SHA-256 del PDF più i parametri di estrazione (dpi e modalità OCR).
+    """
+    def __init__(self, cartella, max_mb, max_giorni):
+        self.cartella = cartella
+        self.max_byte = int(max_mb * 1024 * 1024)
+        self.max_secondi = max_giorni * 24 * 3600
+        self.hit = 0
+        self.miss = 0
+        # protegge contatori e dimensione totale (accesso dai thread OCR)
+        self._lock = threading.Lock()
+        self._dimensione = None
+
+    @staticmethod
+    def hash_file(pdf_path):
+        """
+        Calcola l'hash SHA-256 del contenuto del file, leggendolo a blocchi.
+        """
+        sha = hashlib.sha256()
+        with open(pdf_path, "rb") as f:
+            for blocco in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(blocco)
+        return sha.hexdigest()
+
+    @staticmethod
+    def chiave(hash_pdf, dpi, modalita):
+        return f"{hash_pdf}-{dpi}-{modalita}"
+
+    def _percorso(self, chiave):
+        # sottocartelle per prefisso, evita directory con troppi file
+        return os.path.join(self.cartella, chiave[:2], f"{chiave}.json")
+
+    def leggi(self, chiave):
+        """
+        Ritorna il dizionario salvato per la chiave, None se assente o scaduto.
+        """
+        percorso = self._percorso(chiave)
+        try:
+            if time.time() - os.path.getmtime(percorso) > self.max_secondi:
+                self._rimuovi(percorso)
+                dati = None
+            else:
+                with open(percorso, "r", encoding="utf-8") as f:
+                    dati = json.load(f)
+                # aggiorna mtime per l'eviction LRU
+                os.utime(percorso, None)
+        except (OSError, ValueError):
+            dati = None
+
+        with self._lock:
+            if dati is None:
+                self.miss += 1
+            else:
+                self.hit += 1
+        return dati
+
+    def scrivi(self, chiave, dati):
+        """
+        Salva la voce in modo atomico (file temporaneo + rename).
+        """
+        percorso = self._percorso(chiave)
+        try:
+            os.makedirs(os.path.dirname(percorso), exist_ok=True)
+            tmp = f"{percorso}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(dati, f, ensure_ascii=False)
+            os.replace(tmp, percorso)
+            dimensione = os.path.getsize(percorso)
+        except OSError as e:
+            print(f"\n{YELLOW}Impossibile scrivere la cache OCR: {e}{RESET}")
+            return
+
+        with self._lock:
+            if self._dimensione is None:
+                self._dimensione = self._calcola_dimensione()
+            else:
+                self._dimensione += dimensione
+            if self._dimensione > self.max_byte:
+                self._eviction()
+
+    def _voci(self):
+        voci = []
+        if not os.path.isdir(self.cartella):
+            return voci
+        for radice, _, files in os.walk(self.cartella):
+            for nome in files:
+                if nome.endswith(".json"):
+                    percorso = os.path.join(radice, nome)
+                    try:
+                        stat = os.stat(percorso)
+                    except OSError:
+                        continue
+                    voci.append((stat.st_mtime, stat.st_size, percorso))
+        return voci
+
+    def _calcola_dimensione(self):
+        return sum(size for _, size, _ in self._voci())
+
+    @staticmethod
+    def _rimuovi(percorso):
+        try:
+            os.remove(percorso)
+        except OSError:
+            pass
+
+    def _eviction(self):
+        """
+        Rimuove le voci scadute e poi le meno usate di recente
+        finché la cache non scende sotto l'80% della dimensione massima.
+        Va chiamata con il lock acquisito.
+        """
+        adesso = time.time()
+        voci = sorted(self._voci())
+        rimaste = []
+        totale = 0
+        for mtime, size, percorso in voci:
+            if adesso - mtime > self.max_secondi:
+                self._rimuovi(percorso)
+            else:
+                rimaste.append((mtime, size, percorso))
+                totale += size
+
+        soglia = self.max_byte * 0.8
+        for mtime, size, percorso in rimaste:
+            if totale <= soglia:
+                break
+            self._rimuovi(percorso)
+            totale -= size
+        self._dimensione = totale
+
+    def pulisci(self):
+        """
+        Applica eviction per età e dimensione su tutta la cache.
+        """
+        with self._lock:
+            self._eviction()
+
+    def riepilogo(self):
+        totale = self.hit + self.miss
+        percentuale = (self.hit / totale * 100) if totale else 0
+        return f"{self.hit} hit / {self.miss} miss ({percentuale:.0f}% hit)"
+
+
+ocr_cache = OCRCache(ocr_cache_dir, ocr_cache_max_mb, ocr_cache_max_giorni)
@@ -0,0 +1,122 @@
+# ----- Conversione delle pagine PDF in immagini in un pool di processi -----
+# Modulo leggero: viene importato anche dai processi worker, che non devono creare il client Vision.
+import io
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
+from utils.config import poppler_path, opzioni_immagine
+from utils.metriche import metriche
+
+# pagine per file convertite in anticipo (limita le immagini vive in memoria)
+MAX_PAGINE_IN_VOLO = 2
+# processi per la conversione (default: uno per core)
+RASTER_PROCESSI = os.cpu_count() or 1
+
+# frazione minima di pixel scuri (a piena risoluzione) perché una pagina non sia considerata vuota:
+# a 300 dpi su A4 circa 900 pixel, meno di una parola stampata
+SOGLIA_PAGINA_VUOTA = 0.0001
+
+_pool = None
+_lock_pool = threading.Lock()
+
+
+def pool_raster():
+    """
+    Pool di processi condiviso, creato al primo utilizzo.
+    Viene creato da un thread OCR mentre altri thread sono attivi: i processi partono con "spawn"
+    e non con fork, che duplicherebbe un processo con più thread (lock trattenuti, possibili blocchi).
+    """
+    global _pool
+    with _lock_pool:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=RASTER_PROCESSI, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def numero_pagine(pdf_path):
+    return pdfinfo_from_path(pdf_path, poppler_path=poppler_path)["Pages"]
+
+def firma_opzioni(opzioni=opzioni_immagine):
+    """
+    Stringa breve che identifica le opzioni di preprocessing (parte della chiave della cache OCR).
+    """
+    return "{}{}-{}{}".format(
+        "g" if opzioni["scala_grigi"] else "c",
+        opzioni["lato_max"],
+        opzioni["formato"].lower(),
+        opzioni["qualita"] if opzioni["formato"].upper() != "PNG" else "",
+    )
+
+def pagina_vuota(img):
+    """
+    Rileva una pagina bianca contando i pixel scuri a piena risoluzione
+    (in una miniatura il testo sottile si schiarisce e la pagina sembrerebbe vuota).
+    """
+    istogramma = img.convert("L").histogram()
+    scuri = sum(istogramma[:160])
+    return scuri / max(1, sum(istogramma)) < SOGLIA_PAGINA_VUOTA
+
+def prepara_immagine(img, opzioni=opzioni_immagine):
+    """
+    Applica il preprocessing e codifica l'immagine.
+    Ritorna i byte da inviare a Vision, None se la pagina è vuota e va saltata.
+    """
+    if opzioni["salta_vuote"] and pagina_vuota(img):
+        return None
+
+    if opzioni["scala_grigi"]:
+        img = img.convert("L")
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    lato_max = opzioni["lato_max"]
+    if lato_max and max(img.size) > lato_max:
+        scala = lato_max / max(img.size)
+        img = img.resize((round(img.width * scala), round(img.height * scala)), Image.LANCZOS)
+
+    formato = opzioni["formato"].upper()
+    img_byte_array = io.BytesIO()
+    if formato == "PNG":
+        img.save(img_byte_array, format="PNG")
+    else:
+        img.save(img_byte_array, format=formato, quality=opzioni["qualita"])
+    return img_byte_array.getvalue()
+
+def rasterizza_pagina(pdf_path, numero, dpi, opzioni=opzioni_immagine):
+    """
+    Converte una singola pagina e ritorna i byte dell'immagine preparata (eseguita nei processi worker).
+    None se la pagina è vuota.
+    """
+    img = convert_from_path(pdf_path, dpi=dpi, first_page=numero, last_page=numero, poppler_path=poppler_path)[0]
+    return prepara_immagine(img, opzioni)
+
+def _rasterizza_misurata(pdf_path, numero, dpi):
+    # il worker misura la propria conversione: le metriche si registrano nel processo principale
+    inizio = time.perf_counter()
+    contenuto = rasterizza_pagina(pdf_path, numero, dpi)
+    return contenuto, time.perf_counter() - inizio
+
+def rasterizza_pagine(pdf_path, pagine, dpi):
+    """
+    Generatore di (numero_pagina, byte immagine o None se vuota) nell'ordine delle pagine.
+    Al massimo MAX_PAGINE_IN_VOLO pagine del file sono in conversione o in attesa di essere consumate.
+    """
+    pool = pool_raster()
+    pagine = list(pagine)
+    in_volo = []
+    prossima = 0
+    while prossima < len(pagine) or in_volo:
+        while prossima < len(pagine) and len(in_volo) < MAX_PAGINE_IN_VOLO:
+            n = pagine[prossima]
+            in_volo.append((n, pool.submit(_rasterizza_misurata, pdf_path, n, dpi)))
+            prossima += 1
+        n, future = in_volo.pop(0)
+        contenuto, secondi = future.result()
+        metriche.osserva("raster_pagina_secondi", secondi)
+        metriche.incrementa("pagine_raster")
+        if contenuto is None:
+            metriche.incrementa("pagine_vuote")
+        yield n, contenuto
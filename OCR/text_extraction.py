@@ -1,13 +1,134 @@
-import io
 import os
+import threading
+import subprocess
 from utils.style import *
-from pdf2image import convert_from_path
+from OCR.raster import rasterizza_pagine, numero_pagine, firma_opzioni
 from utils.config import poppler_path, google_vision_path
-from google.cloud import vision
+from OCR.vision_batch import VisionBatcher
+from utils.metriche import metriche
 
-# inizializza il client Google Vision
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = google_vision_path
-client = vision.ImageAnnotatorClient()
+# client Google Vision, inizializzato al primo utilizzo (sostituibile con imposta_client)
+_client = None
+_lock_client = threading.Lock()
+
+def vision_client():
+    """
+    Client Google Vision, creato al primo utilizzo.
+    """
+    global _client
+    with _lock_client:
+        if _client is None:
+            # import pesante: solo quando una pagina va davvero inviata a Vision
+            from google.cloud import vision
+            if google_vision_path:
+                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = google_vision_path
+            _client = vision.ImageAnnotatorClient()
+        return _client
+
+def imposta_client(client):
+    """
+    Sostituisce il client Vision (es. un client finto per test e benchmark).
+    """
+    global _client
+    with _lock_client:
+        _client = client
+
+# raggruppa le pagine (anche di file diversi) in richieste batch_annotate_images
+VISION_BATCH = True
+vision_batcher = VisionBatcher(vision_client)
+
+# risoluzione di conversione e modalità OCR (parte della chiave della cache OCR)
+OCR_DPI = 300
+OCR_MODE = f"nativo+vision-text+{firma_opzioni()}"
+
+# soglie per considerare utilizzabile il testo nativo di una pagina
+NATIVO_MIN_CARATTERI = 100   # caratteri alfanumerici minimi
+NATIVO_MIN_ALNUM = 0.6       # frazione minima di caratteri alfanumerici (spazi esclusi)
+NATIVO_MIN_PAROLE = 0.5      # frazione minima di parole con almeno 2 lettere
+
+# Livello di testo nativo (PDF generati digitalmente)
+def estrai_testo_nativo(pdf_path):
+    """
+    Estrae il livello di testo nativo del PDF, pagina per pagina, con pdftotext di Poppler.
+    Ritorna una lista di testi (uno per pagina) oppure None se l'estrazione non è possibile.
+    """
+    comando = os.path.join(poppler_path, "pdftotext") if poppler_path else "pdftotext"
+    try:
+        with metriche.cronometro("pdftotext_secondi"):
+            risultato = subprocess.run(
+                [comando, "-enc", "UTF-8", pdf_path, "-"],
+                capture_output=True,
+                timeout=60,
+            )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if risultato.returncode != 0:
+        return None
+
+    # pdftotext separa le pagine con un form feed, l'ultimo è seguito da stringa vuota
+    pagine = risultato.stdout.decode("utf-8", errors="replace").split("\f")
+    if pagine and not pagine[-1].strip():
+        pagine = pagine[:-1]
+    return pagine
+
+def testo_utilizzabile(testo):
+    """
+    Valuta se il testo nativo di una pagina è affidabile o se la pagina va passata all'OCR.
+    Scarta pagine vuote, quasi vuote o con testo corrotto (font senza mappatura unicode).
+    """
+    compatto = "".join(testo.split())
+    if not compatto:
+        return False
+
+    alfanumerici = sum(c.isalnum() for c in compatto)
+    if alfanumerici < NATIVO_MIN_CARATTERI:
+        return False
+    if alfanumerici / len(compatto) < NATIVO_MIN_ALNUM or "�" in compatto:
+        return False
+
+    parole = testo.split()
+    valide = sum(1 for p in parole if sum(c.isalpha() for c in p) >= 2)
+    return valide / len(parole) >= NATIVO_MIN_PAROLE
+
+def ocr_pagine(pdf_path, pagine=None):
+    """
+    Esegue Google Vision OCR sulle pagine indicate (numerate da 1), tutte se None.
+    Le pagine vengono convertite una alla volta nel pool di processi (OCR/raster.py).
+    Ritorna un dizionario {numero_pagina: testo}.
+    """
+    if pagine is None:
+        pagine = range(1, numero_pagine(pdf_path) + 1)
+
+    testi = {}
+    futures = {}
+    for n, img_content in rasterizza_pagine(pdf_path, pagine, OCR_DPI):
+        # pagina vuota: nessuna chiamata a Vision
+        if img_content is None:
+            testi[n] = ""
+            continue
+
+        if VISION_BATCH:
+            futures[n] = vision_batcher.invia(img_content)
+            continue
+
+        from google.cloud import vision
+        image = vision.Image(content=img_content)
+        with metriche.cronometro("vision_richiesta_secondi"):
+            response = vision_client().text_detection(image=image)
+        metriche.incrementa("vision_richieste")
+        metriche.incrementa("vision_immagini")
+
+        if response.error.message:
+            raise Exception(f"Errore nell'API di Vision: {response.error.message}")
+
+        # gestisce pagine vuote
+        testi[n] = response.text_annotations[0].description if response.text_annotations else ""
+
+    # raccoglie i testi delle pagine spedite in batch
+    for n, future in futures.items():
+        testi[n] = future.result()
+
+    return testi
 
 # Cloud Vision API 
 def estrai_google_vision(pdf_path):
@@ -15,30 +136,56 @@ def estrai_google_vision(pdf_path):
     Estrae testo da un PDF multipagina utilizzando Google Vision OCR.
     """
     try:
-        # converto pdf in img per google_vision
-        immagini = convert_from_path(pdf_path, dpi=300, poppler_path=poppler_path)
+        testi = ocr_pagine(pdf_path)
+        return "\n".join(t for _, t in sorted(testi.items()) if t).strip()
 
-        # estrae testo per ogni img del pdf
-        testo_completo = ""
-        for img in immagini:
-            # converte in byte
-            img_byte_array = io.BytesIO()
-            img.save(img_byte_array, format='PNG')
-            img_content = img_byte_array.getvalue()
+    except Exception as e:
+        file_name = os.path.basename(pdf_path)
+        print(f"\n{RED}Errore durante l'elaborazione del file {file_name} con Google Vision: {e}{RESET}")
+        return "Errore"
 
-            image = vision.Image(content=img_content)
-            response = client.text_detection(image=image)
+def anteprima_testo(pdf_path):
+    """
+    Per le stime, senza chiamare Vision: testo nativo utilizzabile e numero di pagine che andrebbero all'OCR.
+    Ritorna (testo, pagine_da_ocr), con le stesse regole di estrai_testo.
+    """
+    pagine_native = estrai_testo_nativo(pdf_path)
+    if not pagine_native:
+        try:
+            return "", numero_pagine(pdf_path)
+        except Exception:
+            # PDF non leggibile: conta come una pagina
+            return "", 1
+    utilizzabili = [testo.strip() for testo in pagine_native if testo_utilizzabile(testo)]
+    if not utilizzabili:
+        return "", len(pagine_native)
+    return "\n".join(t for t in utilizzabili if t), len(pagine_native) - len(utilizzabili)
 
-            if response.error.message:
-                raise Exception(f"Errore nell'API di Vision: {response.error.message}")
-            
-            # gestisce pagine vuote
-            if response.text_annotations:
-                testo_completo += response.text_annotations[0].description + "\n"
+def estrai_testo(pdf_path):
+    """
+    Estrae il testo di un PDF usando il livello di testo nativo dove utilizzabile
+    e Google Vision OCR solo per le pagine rimanenti.
+    Ritorna (testo, metodo) con metodo 'nativo', 'ocr' o 'misto'.
+    """
+    pagine_native = estrai_testo_nativo(pdf_path)
+    if not pagine_native:
+        return estrai_google_vision(pdf_path), "ocr"
 
-        return testo_completo.strip()
+    da_ocr = [n for n, testo in enumerate(pagine_native, start=1) if not testo_utilizzabile(testo)]
+    if len(da_ocr) == len(pagine_native):
+        return estrai_google_vision(pdf_path), "ocr"
 
+    try:
+        testi_ocr = ocr_pagine(pdf_path, da_ocr) if da_ocr else {}
     except Exception as e:
         file_name = os.path.basename(pdf_path)
         print(f"\n{RED}Errore durante l'elaborazione del file {file_name} con Google Vision: {e}{RESET}")
-        return "Errore"
\ No newline at end of file
+        return "Errore", "misto"
+
+    testo_completo = ""
+    for n, testo in enumerate(pagine_native, start=1):
+        testo = testi_ocr[n] if n in testi_ocr else testo.strip()
+        if testo:
+            testo_completo += testo + "\n"
+
+    return testo_completo.strip(), "misto" if da_ocr else "nativo"
@@ -0,0 +1,106 @@
+# ----- Raggruppamento delle pagine in richieste batch a Google Vision -----
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils.metriche import metriche
+
+# limiti per singola richiesta batch_annotate_images (https://cloud.google.com/vision/quotas)
+VISION_MAX_IMMAGINI = 16
+# la richiesta JSON è limitata a 10 MB, con margine per l'overhead di codifica
+VISION_MAX_BYTE = 7 * 1024 * 1024
+
+
+class VisionBatcher:
+    """
+    Accumula le pagine inviate da più thread (anche di file diversi) e le spedisce
+    a Vision con batch_annotate_images, fino a VISION_MAX_IMMAGINI pagine o VISION_MAX_BYTE per richiesta.
+    Ogni pagina riceve un Future con il proprio testo, nell'ordine in cui è stata inviata.
+    """
+    def __init__(self, crea_client, attesa=0.2, richieste_parallele=4):
+        # funzione che ritorna il client Vision (creato solo al primo invio)
+        self.crea_client = crea_client
+        # tempo massimo di attesa per riempire un lotto prima di spedirlo
+        self.attesa = attesa
+        self.richieste = 0
+        self._coda = []
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=richieste_parallele)
+        self._thread = None
+
+    def invia(self, contenuto):
+        """
+        Accoda i byte di un'immagine e ritorna un Future con il testo estratto.
+        """
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._ciclo, daemon=True)
+                self._thread.start()
+            self._coda.append((contenuto, future))
+            self._cond.notify()
+        return future
+
+    def _lotto_pieno(self):
+        return len(self._coda) >= VISION_MAX_IMMAGINI or sum(len(c) for c, _ in self._coda) >= VISION_MAX_BYTE
+
+    def _preleva_lotto(self):
+        lotto = []
+        dimensione = 0
+        while self._coda and len(lotto) < VISION_MAX_IMMAGINI:
+            contenuto = self._coda[0][0]
+            # un'immagine più grande del limite viene comunque spedita da sola
+            if lotto and dimensione + len(contenuto) > VISION_MAX_BYTE:
+                break
+            lotto.append(self._coda.pop(0))
+            dimensione += len(contenuto)
+        return lotto
+
+    def _ciclo(self):
+        while True:
+            with self._cond:
+                while not self._coda:
+                    self._cond.wait()
+                scadenza = time.monotonic() + self.attesa
+                while not self._lotto_pieno():
+                    rimanente = scadenza - time.monotonic()
+                    if rimanente <= 0:
+                        break
+                    self._cond.wait(rimanente)
+                lotto = self._preleva_lotto()
+            self._executor.submit(self._invia_lotto, lotto)
+
+    def _invia_lotto(self, lotto):
+        from google.cloud import vision
+        richieste = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=contenuto),
+                features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+            )
+            for contenuto, _ in lotto
+        ]
+        try:
+            with metriche.cronometro("vision_richiesta_secondi"):
+                response = self.crea_client().batch_annotate_images(requests=richieste)
+            self.richieste += 1
+            metriche.incrementa("vision_richieste")
+            metriche.incrementa("vision_immagini", len(lotto))
+        except Exception as e:
+            metriche.incrementa("vision_errori")
+            for _, future in lotto:
+                future.set_exception(e)
+            return
+
+        # le risposte sono nello stesso ordine delle richieste
+        for (_, future), risposta in zip(lotto, response.responses):
+            if risposta.error.message:
+                future.set_exception(Exception(f"Errore nell'API di Vision: {risposta.error.message}"))
+            else:
+                # gestisce pagine vuote
+                future.set_result(risposta.text_annotations[0].description if risposta.text_annotations else "")
+
+        # risposte meno numerose delle immagini: i thread OCR in attesa non devono restare bloccati
+        mancanti = len(lotto) - len(response.responses)
+        if mancanti > 0:
+            errore = Exception(f"Errore nell'API di Vision: {mancanti} risposte mancanti su {len(lotto)} immagini")
+            for _, future in lotto[len(response.responses):]:
+                future.set_exception(errore)
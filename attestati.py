@@ -1,85 +1,477 @@
 import os
-import openpyxl
+import sys
+import time
+import argparse
 from utils.style import *
 from utils.format import Formatter
-from utils.config import pdf_folder, excel_path
-from gpt.tokens import shared
-from gpt.openai_api import openai_call, crea_batch
+from utils.config import pdf_folder, excel_path, excel_checkpoint_ogni, excel_sidecar, deduplica, sorveglia_intervallo, sorveglia_attesa_max, archivio, archivio_path, budget_euro
+from utils.excel import ExcelWriter, riga_excel
+from gpt.tokens import shared, TOKEN_OUTPUT_RATE, SECONDI_PAGINA_OCR, OCR_THREADS
+from gpt.openai_api import dispatch_batch, crea_batch, stima_batch, MAX_RICHIESTE_IN_VOLO, TPM_BUDGET
+from gpt.budget import limite_spesa
+from gpt.bulk import elabora_bulk
+from OCR.cache import ocr_cache
+from gpt.statistiche import statistiche
+from utils.journal import journal, FASE_ANALISI, FASE_SCRITTO
+from utils.metriche import metriche
+from utils.duplicati import Deduplicatore, deduplica as solo_rappresentanti
+from utils.sorveglianza import CartellaSorvegliata, MicroBatch
+from utils.shard import ShardWriter, percorso_shard, file_dello_shard, unisci_shard
+from utils.archivio import Archivio, ArchivioWriter, esporta
+
+def writer_excel(excel_path):
+    """
+    Writer con ricerca della prima riga libera, checkpoint periodici e sidecar opzionale;
+    le righe salvate su disco vengono segnate come completate nel journal.
+    """
+    return ExcelWriter(excel_path, excel_checkpoint_ogni, excel_sidecar,
+                       al_salvataggio=lambda documenti: journal.registra(documenti, FASE_SCRITTO))
+
+
+def writer_risultati(excel):
+    """
+    Writer in cui la pipeline scrive i risultati: l'archivio SQLite, da cui il file Excel viene poi esportato,
+    oppure (ARCHIVIO=0) direttamente il file Excel.
+    """
+    if not archivio:
+        return excel
+    return ArchivioWriter(Archivio(archivio_path), excel.nomi_file_presenti(),
+                          al_salvataggio=lambda documenti: journal.registra(documenti, FASE_SCRITTO))
+
+def esporta_risultati(writer, excel):
+    """
+    Salva i risultati e, con l'archivio, accoda al file Excel le righe nuove
+    (colonne di debug solo nel CSV separato, se attivo).
+    """
+    writer.salva()
+    if writer is not excel:
+        with metriche.cronometro("excel_esportazione_secondi"):
+            esportate = esporta(writer.archivio, excel, debug=excel_sidecar)
+        if esportate:
+            print(f"\U0001F4E4 Righe esportate nel file Excel: {BOLD}{esportate}{RESET}")
 
-def aggiorna_excel(excel_path, pdf_folder):
-    try:
-        workbook = openpyxl.load_workbook(excel_path)
-        sheet = workbook.active
-
-        # cerca prima riga con nome e cognome vuoti
-        row = 1
-        for current_row in range(1, sheet.max_row + 1):
-            if (not sheet[f'B{current_row}'].value) and (not sheet[f'C{current_row}'].value):
-                row = current_row
-                break
-        else:
-            row = sheet.max_row + 1  
 
-        # crea dizionario attestati con nome file, testo, num token per ogni attestato
-        testi_estratti = shared.token_per_pdf(pdf_folder)
+class Elaborazione:
+    """
+    Stato condiviso da un'esecuzione completa e dalla modalità sorveglianza:
+    writer Excel, duplicati e scrittura delle analisi (in streaming e a fine batch).
+    """
+    def __init__(self, writer):
+        # ExcelWriter o, per i worker di uno shard, ShardWriter
+        self.writer = writer
+        # duplicati (stesso file o stessa scansione): viene analizzato solo il primo documento del gruppo
+        # e la sua analisi viene scritta anche per gli altri
+        self.deduplicatore = Deduplicatore() if deduplica else None
 
-        batch_counter = 1
+    def con_duplicati(self, documento, attestato, righe, documenti):
+        # aggiunge alle righe da scrivere i duplicati che aspettavano l'analisi di `documento`
+        if self.deduplicatore is None:
+            return
+        for duplicato in self.deduplicatore.risolvi(documento, attestato):
+            righe.append(riga_excel(attestato, duplicato))
+            documenti.append(duplicato)
 
-        # crea i batch basandosi sul calcolo dei token
-        for batch in crea_batch(testi_estratti):
+    def rappresentanti(self, documenti):
+        for documento in documenti:
+            rappresentante, analisi = self.deduplicatore.registra(documento)
+            if rappresentante is None:
+                # copia di un file analizzato in passato e ormai dimenticato dal deduplicatore: basta il journal
+                salvata = journal.analisi_contenuto_salvata(documento)
+                if salvata is None or salvata[0] == documento["nome_file"]:
+                    yield documento
+                    continue
+                rappresentante, analisi = {"nome_file": salvata[0]}, salvata[1]
+                self.deduplicatore.risolvi(documento, analisi)
+                self.deduplicatore.esatti += 1
+            documento["metodo"] = f"{documento.get('metodo', 'ND')} (duplicato di {rappresentante['nome_file']})"
+            if analisi is not None:
+                self.writer.scrivi_righe([riga_excel(analisi, documento)], [documento])
+
+    def da_analizzare(self, documenti):
+        """
+        Attestati da inviare a OpenAI: i duplicati e quelli già analizzati in un'esecuzione interrotta
+        vengono scritti subito, senza nuova chiamata API.
+        """
+        if self.deduplicatore is not None:
+            documenti = self.rappresentanti(documenti)
+        for documento in documenti:
+            analisi = journal.analisi_salvata(documento)
+            if analisi is None:
+                yield documento
+            else:
+                righe, scritti = [riga_excel(analisi, documento)], [documento]
+                self.con_duplicati(documento, analisi, righe, scritti)
+                self.writer.scrivi_righe(righe, scritti)
+
+    def scrivi_attestato(self, batch, attestato):
+        # chiamata dai thread di invio appena il JSON di un attestato è completo (streaming)
+        documento = batch[int(attestato["id"]) - 1]
+        try:
+            riga = riga_excel(attestato, documento)
+        except Exception as e:
+            print(f"{RED}{BOLD}Errore durante la scrittura dei dati per {documento['nome_file']}:{RESET} {e}")
+            return
+        righe, documenti = [riga], [documento]
+        self.con_duplicati(documento, attestato, righe, documenti)
+        journal.registra(documenti, FASE_ANALISI, [attestato] * len(documenti))
+        self.writer.scrivi_righe(righe, documenti)
+        documento["scritto"] = True
+
+    def scrivi_risultati(self, risultati):
+        """
+        Scrive le righe degli attestati non ancora scritti in streaming, batch per batch.
+        """
+        for batch_counter, batch, analisi_batch in risultati:
             try:
-                print(f"{BOLD}Elaborando Batch {batch_counter} con {len(batch)} attestati{RESET}")
-                analisi_batch = openai_call([(t["nome_file"], t["testo"]) for t in batch])
+                print(f"{BOLD}Completato Batch {batch_counter} con {len(batch)} attestati{RESET}")
 
-                # allinea i JSON agli attestati nel batch
+                # allinea i JSON agli attestati nel batch (placeholder per quelli non recuperati)
                 json_completi = Formatter.allinea_json(batch, analisi_batch)
 
+                righe = []
+                documenti = []
                 for i, attestato in enumerate(json_completi):
+                    if batch[i].get("scritto"):
+                        continue
                     try:
-                        nome_file = batch[i]["nome_file"]
-                        testo_attestato = batch[i]["testo"]
-                        nome_corso = Formatter.pulisci_nome_corso(attestato.get("nome_corso", "ND")).upper()
-                        
-                        # scrittura nell'excel
-                        sheet[f'B{row}'] = attestato.get("nome_partecipante", "ND").upper()
-                        sheet[f'C{row}'] = attestato.get("cognome_partecipante", "ND").upper()
-                        sheet[f'D{row}'] = attestato.get("data_fine_corso", "ND")
-                        sheet[f'E{row}'] = attestato.get("dati_anagrafici", "ND")
-                        sheet[f'F{row}'] = Formatter.valida_cf(attestato.get("codice_fiscale", "ND"))
-                        sheet[f'I{row}'] = attestato.get("tdi", "ND")
-                        sheet[f'J{row}'] = nome_file
-                        sheet[f'H{row}'] = attestato.get("codice_corso", "ND")
-                        sheet[f'N{row}'] = attestato.get("durata_corso", "ND")
-                        # DEBUG columns
-                        sheet[f'T{row}'] = nome_corso
-                        sheet[f'U{row}'] = testo_attestato
-                        sheet[f'V{row}'] = str(attestato)
-
-                        row += 1
-                        
+                        righe.append(riga_excel(attestato, batch[i]))
+                        documenti.append(batch[i])
+                        self.con_duplicati(batch[i], attestato, righe, documenti)
                     except Exception as e:
-                        print(f"{RED}{BOLD}Errore durante la scrittura dei dati per {nome_file}:{RESET} {e}")
-    
-                batch_counter += 1
+                        print(f"{RED}{BOLD}Errore durante la scrittura dei dati per {batch[i]['nome_file']}:{RESET} {e}")
+
+                # scrittura nell'excel
+                self.writer.scrivi_righe(righe, documenti)
+                self.writer.fine_batch()
 
             except Exception as e:
                 print(f"{RED}{BOLD}Errore durante l'elaborazione del batch:{RESET} {e}")
+                # salva i batch già completati prima di interrompere
+                self.writer.salva()
                 raise RuntimeError(f"Errore critico nel Batch {batch_counter}: {e}")
 
-        workbook.save(excel_path)
+    def concludi(self):
+        self.writer.salva()
+        deduplicatore = self.deduplicatore
+        if deduplicatore is not None and (deduplicatore.esatti or deduplicatore.simili):
+            metriche.incrementa("duplicati_esatti", deduplicatore.esatti)
+            metriche.incrementa("duplicati_simili", deduplicatore.simili)
+            print(f"\U0001F46F Duplicati analizzati una sola volta: {BOLD}{deduplicatore.esatti} esatti, {deduplicatore.simili} quasi uguali{RESET}")
+            if deduplicatore.non_risolti():
+                print(f"{YELLOW}{deduplicatore.non_risolti()} duplicati non scritti: l'analisi del documento originale non è disponibile{RESET}")
+
+
+def elabora(elaborazione, pdf_folder, pdf_files=None, bulk=False):
+    """
+    OCR, analisi e scrittura con il writer di `elaborazione` dei PDF della cartella (o dei soli `pdf_files`).
+    """
+    # flusso di attestati con nome file, testo, num token: l'OCR prosegue in background
+    # mentre i batch già completi vengono inviati a OpenAI.
+    # i file già presenti nella colonna J (o nel file dello shard) o completati nel journal vengono saltati
+    testi_estratti = shared.flusso_pdf(pdf_folder, escludi=elaborazione.writer.nomi_file_presenti(), pdf_files=pdf_files)
+
+    # crea i batch basandosi sul calcolo dei token e li invia in parallelo (o in un job bulk)
+    batches = crea_batch(elaborazione.da_analizzare(testi_estratti))
+    if bulk:
+        risultati = elabora_bulk(batches, al_json=elaborazione.scrivi_attestato)
+    else:
+        risultati = dispatch_batch(batches, al_json=elaborazione.scrivi_attestato)
+
+    try:
+        elaborazione.scrivi_risultati(risultati)
+    finally:
+        # anche dopo un errore le righe già analizzate vengono salvate
+        elaborazione.concludi()
+
+def aggiorna_excel(excel_path, pdf_folder, bulk=False):
+    """
+    Estrae, analizza e scrive nel file Excel gli attestati della cartella.
+    - bulk: usa la Batch API di OpenAI (offline, prezzo ridotto) invece delle chiamate interattive.
+    Ritorna False se l'elaborazione si è interrotta per un errore.
+    """
+    try:
+        excel = writer_excel(excel_path)
+        writer = writer_risultati(excel)
+        try:
+            elabora(Elaborazione(writer), pdf_folder, bulk=bulk)
+        finally:
+            esporta_risultati(writer, excel)
         print(f"\nDati aggiornati in {BOLD}{YELLOW}{excel_path}{RESET} \u2705\n")
+        return True
 
     except Exception as e:
         print(f"{RED}{BOLD}Errore durante l'aggiornamento del file Excel:{RESET} {e}")
+        return False
 
+def worker(pdf_folder, shard, totale, bulk=False):
+    """
+    Elabora solo i PDF dello shard `shard` (da 0 a totale-1, assegnati per nome e dimensione) e scrive
+    i risultati nel file intermedio dello shard invece che nel file Excel. Più worker possono girare su
+    macchine diverse che condividono solo il filesystem: ognuno ha il suo file intermedio, il suo journal
+    e il suo report delle metriche. Il file Excel viene scritto dal comando `unisci`.
+    Ritorna False se l'elaborazione si è interrotta per un errore.
+    """
+    journal.sposta(percorso_shard(shard, totale, prefisso="journal"))
+    metriche.percorso_json = percorso_shard(shard, totale, "json", prefisso="metriche")
+    writer = ShardWriter(percorso_shard(shard, totale), al_salvataggio=lambda documenti: journal.registra(documenti, FASE_SCRITTO))
+    try:
+        pdf_files = file_dello_shard(pdf_folder, shard, totale)
+        print(f"\U0001F9F1 Shard {BOLD}{shard}{RESET} di {totale}: {BOLD}{len(pdf_files)}{RESET} PDF")
+        elabora(Elaborazione(writer), pdf_folder, pdf_files, bulk)
+        print(f"\nRisultati dello shard salvati in {BOLD}{YELLOW}{writer.percorso}{RESET} \u2705\n")
+        return True
 
+    except Exception as e:
+        print(f"{RED}{BOLD}Errore durante l'elaborazione dello shard:{RESET} {e}")
+        return False
+    finally:
+        # token e costi di questa esecuzione, sommati dall'unione
+        writer.registra_totali(shared)
 
+def unisci(excel_path):
+    """
+    Scrive nel file Excel i risultati dei file intermedi dei worker, in ordine di nome file,
+    con token e costo totali sommati dalle esecuzioni dei worker.
+    """
+    try:
+        excel = writer_excel(excel_path)
+        writer = writer_risultati(excel)
+        scritte = unisci_shard(writer, shared)
+        esporta_risultati(writer, excel)
+        print(f"\nRighe aggiunte: {BOLD}{scritte}{RESET}. Dati aggiornati in {BOLD}{YELLOW}{excel_path}{RESET} \u2705\n")
+
+    except Exception as e:
+        print(f"{RED}{BOLD}Errore durante l'unione dei file intermedi:{RESET} {e}")
 
 
+def sorveglia(excel_path, pdf_folder, intervallo=sorveglia_intervallo, attesa_max=sorveglia_attesa_max):
+    """
+    Modalità servizio: controlla la cartella ogni `intervallo` secondi, estrae il testo dei PDF appena arrivati
+    e invia un batch quando raggiunge il budget di token di crea_batch o quando il primo attestato
+    in attesa aspetta da `attesa_max` secondi. Le righe vengono aggiunte e salvate a ogni invio.
+    I file già visti non vengono più considerati; si interrompe con Ctrl+C.
+    Ritorna False se la sorveglianza si è interrotta per un errore.
+    """
+    excel = writer_excel(excel_path)
+    elaborazione = Elaborazione(writer_risultati(excel))
+    cartella = CartellaSorvegliata(pdf_folder, escludi=elaborazione.writer.nomi_file_presenti())
+    micro_batch = MicroBatch(attesa_max)
+    numero_invio = 0
+
+    def invia():
+        nonlocal numero_invio
+        documenti = micro_batch.svuota()
+        numero_invio += 1
+        print(f"{BOLD}Invio {numero_invio}: {len(documenti)} attestati{RESET}")
+        elaborazione.scrivi_risultati(dispatch_batch(crea_batch(documenti), al_json=elaborazione.scrivi_attestato))
+        # le righe sono subito su disco (e segnate come scritte nel journal)
+        esporta_risultati(elaborazione.writer, excel)
+        statistiche.salva()
+
+    print(f"\U0001F440 Sorveglianza di {BOLD}{pdf_folder}{RESET} (controllo ogni {intervallo} s, attesa massima {attesa_max} s). Ctrl+C per terminare.")
+    try:
+        # con il budget raggiunto non vengono inviati altri batch: la sorveglianza termina
+        while not limite_spesa.superato:
+            nuovi = cartella.nuovi_file()
+            if nuovi:
+                for documento in elaborazione.da_analizzare(shared.flusso_pdf(pdf_folder, pdf_files=nuovi)):
+                    micro_batch.aggiungi(documento)
+                    if micro_batch.pieno():
+                        invia()
+                # duplicati e analisi recuperate dal journal scritti senza invio
+                esporta_risultati(elaborazione.writer, excel)
+            if micro_batch.pronto():
+                invia()
+            time.sleep(micro_batch.attesa(intervallo))
+    except KeyboardInterrupt:
+        print(f"\n{YELLOW}Sorveglianza interrotta{RESET}")
+        if len(micro_batch):
+            invia()
+    except Exception as e:
+        print(f"{RED}{BOLD}Errore durante la sorveglianza della cartella:{RESET} {e}")
+        return False
+    finally:
+        elaborazione.concludi()
+        esporta_risultati(elaborazione.writer, excel)
+    return True
+
+
+def esporta_excel(excel_path, debug=False, rivalida=False):
+    """
+    Esporta nel file Excel le righe dell'archivio non ancora presenti, senza OCR né chiamate API.
+    - rivalida: ricalcola prima i campi dal JSON del modello salvato (es. dopo una modifica alle validazioni)
+      e riscrive le righe modificate già presenti nel file Excel.
+    """
+    db = Archivio(archivio_path)
+    modificate = []
+    if rivalida:
+        modificate = db.rivalida()
+        print(f"\U0001F504 Righe rivalidate: {BOLD}{len(modificate)}{RESET}")
+    esportate = esporta(db, writer_excel(excel_path), debug, riscrivi=modificate)
+    print(f"\U0001F4E4 Righe esportate: {BOLD}{esportate}{RESET} in {BOLD}{YELLOW}{excel_path}{RESET}")
+    db.chiudi()
+
+def cerca(codice_fiscale=None, cognome=None):
+    """
+    Attestati archiviati di un codice fiscale e/o di un cognome.
+    """
+    db = Archivio(archivio_path)
+    risultati = db.cerca(codice_fiscale, cognome)
+    db.chiudi()
+    if not risultati:
+        print(f"{YELLOW}Nessun attestato trovato{RESET}")
+        return
+    print(f"{BOLD}{'cognome':<18}{'nome':<15}{'codice fiscale':<18}{'fine corso':<12}{'codice':<10}{'ore':<6}file{RESET}")
+    for r in risultati:
+        print(f"{r['cognome_partecipante'] or '':<18}{r['nome_partecipante'] or '':<15}{r['codice_fiscale'] or '':<18}"
+              f"{r['data_fine_corso'] or '':<12}{r['codice_corso'] or '':<10}{r['durata_corso'] or '':<6}{r['nome_file']}")
+
+
+def solo_ocr(pdf_folder):
+    """
+    Estrae il testo di tutti i PDF della cartella e lo salva nella cache OCR, senza chiamate a OpenAI.
+    """
+    estratti = sum(1 for _ in shared.flusso_pdf(pdf_folder))
+    print(f"\U0001F4C4 Testi estratti: {BOLD}{estratti}{RESET} ({', '.join(f'{n} {metodo}' for metodo, n in shared.metodi_estrazione.items())})")
+    print(f"\U0001F5C3 Cache OCR: {BOLD}{ocr_cache.riepilogo()}{RESET}")
+
+def stima(pdf_folder, bulk=False):
+    """
+    Stima batch, token, pagine per Google Vision, costo e durata dei PDF della cartella senza chiamate API:
+    testo dalla cache OCR se disponibile, altrimenti testo nativo del PDF più una stima per le pagine da OCR.
+    """
+    documenti = []
+    gia_elaborati = 0
+    for nome in sorted(f for f in os.listdir(pdf_folder) if f.lower().endswith(".pdf")):
+        documento = shared.documento_stimato(pdf_folder, nome)
+        if journal.completato(documento):
+            gia_elaborati += 1
+        else:
+            documenti.append(documento)
+
+    # le pagine vanno a Vision anche per i duplicati (l'hash è noto solo dopo l'OCR dei quasi-duplicati)
+    pagine_ocr = sum(d["pagine_ocr"] for d in documenti)
+    if deduplica:
+        documenti = solo_rappresentanti(documenti)
+
+    token_input = 0
+    token_output = 0
+    durate = []
+    batches = list(crea_batch(documenti))
+    for batch in batches:
+        ingresso, uscita = stima_batch(batch)
+        token_input += ingresso
+        token_output += uscita
+        durate.append((ingresso + uscita) / statistiche.token_rate(TOKEN_OUTPUT_RATE))
+
+    costo_llm = shared.stima_prezzo(token_input, token_output, bulk)
+    costo_vision = shared.stima_prezzo_vision(pagine_ocr)
+    # durata: OCR in parallelo sui thread, batch fino a MAX_RICHIESTE_IN_VOLO alla volta ma non oltre il limite di token al minuto
+    secondi_ocr = pagine_ocr * SECONDI_PAGINA_OCR / OCR_THREADS
+    secondi_llm = max(sum(durate) / MAX_RICHIESTE_IN_VOLO, max(durate, default=0), (token_input + token_output) / TPM_BUDGET * 60)
+
+    print(f"\U0001F4C4 Attestati da analizzare: {BOLD}{len(documenti)}{RESET} in {BOLD}{len(batches)} batch{RESET}")
+    print(f"\U0001F5BC Pagine da inviare a Google Vision: {BOLD}{pagine_ocr}{RESET}")
+    print(f"\U0001F9E9 Token stimati: {BOLD}{token_input} input + {token_output} output{RESET}")
+    print(f"\U0001F4B8 Costo stimato: {BOLD}{round(costo_llm + costo_vision, 3)} \u20AC{RESET} (OpenAI {costo_llm} \u20AC + Vision {costo_vision} \u20AC)")
+    if bulk:
+        print(f"\u23F1 Durata stimata: {BOLD}OCR ~{round(secondi_ocr / 60, 1)} min{RESET}, più l'attesa del job della Batch API (fino a 24 ore)")
+    else:
+        print(f"\u23F1 Durata stimata: {BOLD}~{round((secondi_ocr + secondi_llm) / 60, 1)} min{RESET} (OCR {round(secondi_ocr / 60, 1)} min + OpenAI {round(secondi_llm / 60, 1)} min)")
+    print(f"\u23ED Già elaborati: {BOLD}{gia_elaborati}{RESET}")
+    if limite_spesa.attivo() and costo_llm > limite_spesa.limite:
+        print(f"{YELLOW}Il costo OpenAI stimato supera il budget di {limite_spesa.limite} \u20AC: l'esecuzione si fermerà prima di analizzare tutti gli attestati{RESET}")
+
+def riepilogo():
+    print(f"\U0001F9E9 Token totali: {BOLD}{shared.token_totali} ({shared.token_totali_input} input + {shared.token_totali_output} output){RESET}")
+    print(f"\u267B Token input da prompt cache: {BOLD}{shared.token_totali_input_cached}{RESET}")
+    print(f"\U0001F4B8 Costo totale: {BOLD}{shared.price()} \u20AC{RESET}")
+    print(f"\U0001F4C4 Estrazione testo: {BOLD}{', '.join(f'{n} {metodo}' for metodo, n in shared.metodi_estrazione.items())}{RESET}")
+    print(f"\u23ED File saltati (già elaborati): {BOLD}{shared.file_saltati}{RESET}")
+    limite_spesa.riepilogo()
+    print(f"\U0001F5C3 Cache OCR: {BOLD}{ocr_cache.riepilogo()}{RESET}")
+
+    # tempi per fase e report dell'esecuzione (JSON ed eventuale file Prometheus)
+    metriche.stampa()
+    metriche.salva({
+        "token": {
+            "input": shared.token_totali_input,
+            "input_cached": shared.token_totali_input_cached,
+            "output": shared.token_totali_output,
+        },
+        "costo_euro": shared.price(),
+        "metodi_estrazione": dict(shared.metodi_estrazione),
+        "file_saltati": shared.file_saltati,
+        "cache_ocr": {"hit": ocr_cache.hit, "miss": ocr_cache.miss},
+    })
+    print(f"\U0001F4CA Metriche salvate in {BOLD}{metriche.percorso_json}{RESET}")
+
+
+# il guard è necessario anche per il pool di processi della conversione PDF (spawn su Windows)
 if __name__ == "__main__":
-    if not os.path.exists(pdf_folder):
+    parser = argparse.ArgumentParser(description="Analisi attestati PDF con OCR e OpenAI")
+    parser.add_argument("--bulk", action="store_true", help="elaborazione offline con la Batch API di OpenAI")
+    parser.add_argument("--budget", type=float, default=budget_euro, help="spesa massima in euro dell'esecuzione (default: BUDGET_EURO)")
+    # ogni comando inizializza solo ciò che usa (database corsi, client Vision e OpenAI sono caricati al primo utilizzo)
+    comandi = parser.add_subparsers(dest="comando")
+    comando_esegui = comandi.add_parser("esegui", help="OCR, analisi con OpenAI e scrittura nel file Excel (default)")
+    comando_esegui.add_argument("--bulk", action="store_true", default=argparse.SUPPRESS, help="elaborazione offline con la Batch API di OpenAI")
+    comandi.add_parser("ocr", help="solo estrazione del testo nella cache OCR, senza OpenAI")
+    comando_stima = comandi.add_parser("stima", help="stima di batch, token, pagine OCR, costo e durata, senza chiamate API")
+    comando_stima.add_argument("--bulk", action="store_true", default=argparse.SUPPRESS, help="stima con i prezzi della Batch API")
+    comando_sorveglia = comandi.add_parser("sorveglia", help="servizio: elabora i PDF man mano che arrivano nella cartella")
+    comando_sorveglia.add_argument("--intervallo", type=float, default=sorveglia_intervallo, help="secondi tra due controlli della cartella")
+    comando_sorveglia.add_argument("--attesa-max", type=float, default=sorveglia_attesa_max, help="secondi massimi di attesa di un attestato prima dell'invio")
+    comando_worker = comandi.add_parser("worker", help="elabora uno shard della cartella e scrive i risultati in un file intermedio")
+    comando_worker.add_argument("--shard", type=int, required=True, help="indice dello shard (da 0 a shard-totali - 1)")
+    comando_worker.add_argument("--shard-totali", type=int, required=True, help="numero totale di shard (uguale per tutti i worker)")
+    comando_worker.add_argument("--bulk", action="store_true", default=argparse.SUPPRESS, help="elaborazione offline con la Batch API di OpenAI")
+    comandi.add_parser("unisci", help="scrive nel file Excel i risultati dei file intermedi dei worker")
+    comando_esporta = comandi.add_parser("esporta", help="esporta l'archivio dei risultati nel file Excel, senza chiamate API")
+    comando_esporta.add_argument("--excel", help="file Excel di destinazione (default: EXCEL_PATH)")
+    comando_esporta.add_argument("--debug", action="store_true", help="esporta anche testo OCR, JSON del modello e metodo di estrazione")
+    comando_esporta.add_argument("--rivalida", action="store_true", help="ricalcola i campi dal JSON del modello salvato prima di esportare")
+    comando_cerca = comandi.add_parser("cerca", help="cerca gli attestati archiviati")
+    comando_cerca.add_argument("--cf", help="codice fiscale")
+    comando_cerca.add_argument("--cognome", help="cognome del partecipante")
+    args = parser.parse_args()
+    limite_spesa.limite = args.budget
+
+    if args.comando == "esporta":
+        esporta_excel(args.excel or excel_path, args.debug, args.rivalida)
+    elif args.comando == "cerca":
+        cerca(args.cf, args.cognome)
+    elif args.comando == "unisci":
+        unisci(excel_path)
+        riepilogo()
+    elif not os.path.exists(pdf_folder):
         print(f"{RED}{BOLD}Cartella PDF {pdf_folder} non trovata.{RESET}")
+    elif args.comando == "worker":
+        if not 0 <= args.shard < args.shard_totali:
+            print(f"{RED}{BOLD}Shard {args.shard} non valido: deve essere tra 0 e {args.shard_totali - 1}.{RESET}")
+        else:
+            completato = worker(pdf_folder, args.shard, args.shard_totali, bulk=args.bulk)
+            statistiche.salva()
+            riepilogo()
+            if not completato:
+                sys.exit(1)
+    elif args.comando == "ocr":
+        solo_ocr(pdf_folder)
+        ocr_cache.pulisci()
+    elif args.comando == "stima":
+        stima(pdf_folder, bulk=args.bulk)
+    elif args.comando == "sorveglia":
+        completato = sorveglia(excel_path, pdf_folder, args.intervallo, args.attesa_max)
+        ocr_cache.pulisci()
+        statistiche.salva()
+        riepilogo()
+        if not completato:
+            sys.exit(1)
     else:
-        aggiorna_excel(excel_path, pdf_folder)
-        print(f"\U0001F9E9 Token totali: {BOLD}{shared.token_totali} ({shared.token_totali_input} input + {shared.token_totali_output} output){RESET}")
-        print(f"\U0001F4B8 Costo totale: {BOLD}{shared.price()} \u20AC{RESET}")
\ No newline at end of file
+        completato = aggiorna_excel(excel_path, pdf_folder, bulk=args.bulk)
+        ocr_cache.pulisci()
+        statistiche.salva()
+        riepilogo()
+        # uscita con errore solo dopo aver salvato risultati, statistiche e riepilogo
+        if not completato:
+            sys.exit(1)
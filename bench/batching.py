@@ -0,0 +1,54 @@
+# ----- Benchmark del bin packing: batch in streaming contro impacchettamento dell'intero insieme -----
+# Uso: python -m bench.batching [--documenti 400] [--token-min 500] [--token-max 3000] [--semi 20]
+# Non richiede credenziali, rete né Poppler: usa solo gpt/batching.py.
+import random
+import argparse
+from utils.style import *
+from gpt.batching import impacchetta, impacchetta_flusso
+
+# limiti tipici restituiti da limiti_batch() (gpt-4o, output compatto, margine del 10%)
+MAX_INPUT = 95000
+MAX_OUTPUT = 14745
+
+
+def documenti_casuali(rnd, numero, token_min, token_max, token_output):
+    return [{"token_batch": rnd.randint(token_min, token_max), "token_output": token_output} for _ in range(numero)]
+
+def sequenziale(documenti, max_input, max_output):
+    """
+    Riempimento in ordine di arrivo (un batch nuovo quando il corrente è pieno), come riferimento.
+    """
+    batches = 0
+    token_input = token_output = 0
+    for documento in documenti:
+        if batches == 0 or token_input + documento["token_batch"] > max_input or token_output + documento["token_output"] > max_output:
+            batches += 1
+            token_input = token_output = 0
+        token_input += documento["token_batch"]
+        token_output += documento["token_output"]
+    return batches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Numero di richieste con il bin packing in streaming e sull'intero insieme")
+    parser.add_argument("--documenti", type=int, default=400, help="attestati per prova")
+    parser.add_argument("--token-min", type=int, default=500, help="token minimi per attestato")
+    parser.add_argument("--token-max", type=int, default=3000, help="token massimi per attestato")
+    parser.add_argument("--token-output", type=int, default=90, help="token di output per attestato")
+    parser.add_argument("--semi", type=int, default=20, help="numero di prove (semi casuali)")
+    args = parser.parse_args()
+
+    print(f"{BOLD}{'seme':<6}{'streaming':>10}{'insieme':>10}{'sequenziale':>13}{RESET}")
+    peggiori = []
+    for seme in range(args.semi):
+        documenti = documenti_casuali(random.Random(seme), args.documenti, args.token_min, args.token_max, args.token_output)
+        flusso = list(impacchetta_flusso(iter(documenti), MAX_INPUT, MAX_OUTPUT))
+        insieme = impacchetta(documenti, MAX_INPUT, MAX_OUTPUT)
+        assert sum(len(b) for b in flusso) == len(documenti), "attestati persi o duplicati dal packing in streaming"
+        print(f"{seme:<6}{len(flusso):>10}{len(insieme):>10}{sequenziale(documenti, MAX_INPUT, MAX_OUTPUT):>13}")
+        if len(flusso) > len(insieme):
+            peggiori.append(seme)
+
+    # il packing in streaming non deve costare richieste in più rispetto all'intero insieme
+    assert not peggiori, f"{RED}streaming con più richieste dell'intero insieme per i semi {peggiori}{RESET}"
+    print(f"✅ Streaming mai peggiore dell'intero insieme su {args.semi} prove")
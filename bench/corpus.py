@@ -0,0 +1,194 @@
+# ----- Generatore di un corpus sintetico di attestati per i benchmark -----
+# Uso: python -m bench.corpus cartella_output [--file 200] [--scansioni 0.5] [--pagine 1] [--corsi 200]
+import os
+import random
+import argparse
+import openpyxl
+from PIL import Image, ImageDraw, ImageFont
+from utils.style import *
+
+# corsi di base combinati con le varianti per ottenere database di dimensione arbitraria
+CORSI_BASE = [
+    ("FGL", "Formazione generale lavoratori", "generale", 4, 4),
+    ("RSB", "Formazione specifica rischio basso", "rischio basso", 4, 4),
+    ("RSM", "Formazione specifica rischio medio", "rischio medio", 8, 8),
+    ("RSA", "Formazione specifica rischio alto", "rischio alto", 12, 12),
+    ("PRE", "Preposto", "preposti", 8, 8),
+    ("DIR", "Dirigente", "dirigenti", 16, 16),
+    ("RLS", "Rappresentante dei lavoratori per la sicurezza", "RLS", 32, 32),
+    ("ANT", "Addetto antincendio", "antincendio", 4, 16),
+    ("PSO", "Addetto primo soccorso", "primo soccorso", 12, 16),
+    ("CAR", "Carrelli elevatori", "muletto", 12, 12),
+    ("PLE", "Piattaforme di lavoro elevabili", "PLE", 8, 10),
+    ("QUO", "Lavori in quota e DPI di terza categoria", "quota", 8, 8),
+    ("PES", "Lavori elettrici PES PAV", "PES PAV", 16, 16),
+    ("HAC", "Igiene degli alimenti HACCP", "HACCP", 4, 12),
+    ("SPA", "Ambienti confinati", "spazi confinati", 8, 12),
+]
+VARIANTI_CORSO = [("", ""), ("A", "aggiornamento"), ("E", "e-learning"), ("B", "base"), ("V", "avanzato")]
+
+NOMI = ["Mario", "Giulia", "Luca", "Francesca", "Marco", "Chiara", "Matteo", "Sara", "Andrea", "Elena", "Paolo", "Anna"]
+COGNOMI = ["Rossi", "Bianchi", "Ferrari", "Esposito", "Romano", "Colombo", "Ricci", "Marino", "Greco", "Bruno", "Gallo", "Conti"]
+CITTA = ["Milano", "Torino", "Bologna", "Verona", "Padova", "Brescia", "Bergamo", "Firenze"]
+EROGATORI = ["Tecnologie d'Impresa S.r.l.", "Centro Formazione Sicurezza", "Ente Bilaterale Regionale"]
+
+
+def database_corsi(numero):
+    """
+    Lista di corsi (codice, nome, alias, durata minima, durata massima) lunga `numero`.
+    """
+    corsi = []
+    for i in range(numero):
+        codice, nome, alias, minima, massima = CORSI_BASE[i % len(CORSI_BASE)]
+        sigla, variante = VARIANTI_CORSO[(i // len(CORSI_BASE)) % len(VARIANTI_CORSO)]
+        giro = i // (len(CORSI_BASE) * len(VARIANTI_CORSO))
+        suffisso = f" {variante}" if variante else ""
+        if giro:
+            suffisso += f" modulo {giro + 1}"
+        corsi.append((f"{codice}{sigla}{giro or ''}", f"{nome}{suffisso}", alias, minima, massima))
+    return corsi
+
+def scrivi_database(percorso, corsi):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["CODICE CORSO", "NOME CORSO", "alias", "DURATA MINIMA CORSO (ore)", "DURATA MASSIMA CORSO (ore)"])
+    for corso in corsi:
+        sheet.append(list(corso))
+    workbook.save(percorso)
+
+def scrivi_excel_vuoto(percorso):
+    """
+    File Excel di output con la sola riga di intestazione.
+    """
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["", "NOME", "COGNOME", "DATA FINE CORSO", "DATI ANAGRAFICI", "CODICE FISCALE", "", "CODICE CORSO", "TDI", "FILE"])
+    workbook.save(percorso)
+
+def codice_fiscale(rnd):
+    lettere = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return (
+        "".join(rnd.choice(lettere) for _ in range(6))
+        + f"{rnd.randint(50, 99)}{rnd.choice('ABCDEHLMPRST')}{rnd.randint(1, 71):02d}"
+        + f"{rnd.choice(lettere)}{rnd.randint(100, 999)}{rnd.choice(lettere)}"
+    )
+
+def testo_attestato(rnd, corsi):
+    """
+    Righe di un attestato sintetico con i campi che il modello deve estrarre.
+    """
+    _, nome_corso, _, minima, massima = rnd.choice(corsi)
+    righe = [
+        rnd.choice(EROGATORI),
+        "ATTESTATO DI PARTECIPAZIONE",
+        f"Si attesta che {rnd.choice(NOMI)} {rnd.choice(COGNOMI)}",
+    ]
+    if rnd.random() < 0.8:
+        righe.append(f"nato a {rnd.choice(CITTA)} il {rnd.randint(1, 28):02d}/{rnd.randint(1, 12):02d}/{rnd.randint(1960, 2004)}")
+    if rnd.random() < 0.7:
+        righe.append(f"Codice fiscale: {codice_fiscale(rnd)}")
+    righe += [
+        "ha frequentato con esito positivo il corso",
+        nome_corso,
+        f"della durata di {rnd.randint(minima, massima)} ore",
+        f"concluso in data {rnd.randint(1, 28):02d}/{rnd.randint(1, 12):02d}/{rnd.randint(2019, 2025)}",
+        "ai sensi dell'art. 37 del D.Lgs. 81/2008 e dell'Accordo Stato-Regioni",
+        f"Rilasciato a {rnd.choice(CITTA)}",
+    ]
+    return righe
+
+def _escapa(testo):
+    return testo.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def pdf_nativo(pagine):
+    """
+    PDF minimale con layer di testo (Helvetica), una lista di righe per pagina.
+    """
+    oggetti = []
+    id_pagine = []
+    # 1 catalogo, 2 albero delle pagine, 3 font, poi pagina + contenuto per ogni pagina
+    for n, righe in enumerate(pagine):
+        contenuto = "BT /F1 11 Tf 14 TL 60 780 Td " + " ".join(f"({_escapa(r)}) '" for r in righe) + " ET"
+        id_pagina = 4 + 2 * n
+        id_pagine.append(id_pagina)
+        oggetti.append((id_pagina, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {id_pagina + 1} 0 R >>"))
+        flusso = contenuto.encode("latin-1", "replace")
+        oggetti.append((id_pagina + 1, f"<< /Length {len(flusso)} >>\nstream\n{flusso.decode('latin-1')}\nendstream"))
+
+    oggetti = [
+        (1, "<< /Type /Catalog /Pages 2 0 R >>"),
+        (2, f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in id_pagine)}] /Count {len(id_pagine)} >>"),
+        (3, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"),
+    ] + oggetti
+
+    dati = b"%PDF-1.4\n"
+    posizioni = []
+    for numero, corpo in oggetti:
+        posizioni.append(len(dati))
+        dati += f"{numero} 0 obj\n{corpo}\nendobj\n".encode("latin-1")
+    xref = len(dati)
+    dati += f"xref\n0 {len(oggetti) + 1}\n0000000000 65535 f \n".encode()
+    dati += "".join(f"{p:010d} 00000 n \n" for p in posizioni).encode()
+    dati += f"trailer\n<< /Size {len(oggetti) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return dati
+
+def pdf_scansione(percorso, pagine, rnd, dpi=150):
+    """
+    PDF di sole immagini (come uno scanner): testo disegnato su pagine A4 in scala di grigi con un po' di rumore.
+    """
+    try:
+        font = ImageFont.load_default(size=24)
+    except TypeError:
+        font = ImageFont.load_default()
+    immagini = []
+    for righe in pagine:
+        img = Image.new("L", (int(8.27 * dpi), int(11.69 * dpi)), 255)
+        disegno = ImageDraw.Draw(img)
+        for i, riga in enumerate(righe):
+            disegno.text((100 + rnd.randint(-3, 3), 150 + i * 45), riga, fill=rnd.randint(0, 60), font=font)
+        for _ in range(300):
+            disegno.point((rnd.randrange(img.width), rnd.randrange(img.height)), fill=rnd.randint(120, 200))
+        immagini.append(img)
+    immagini[0].save(percorso, "PDF", resolution=dpi, save_all=True, append_images=immagini[1:])
+
+def genera_corpus(cartella, numero_file=200, quota_scansioni=0.5, pagine=1, numero_corsi=200, seme=0):
+    """
+    Crea in `cartella` i PDF (sottocartella pdf), il database dei corsi e il file Excel di output.
+    Ritorna (cartella_pdf, database_path, excel_path).
+    """
+    rnd = random.Random(seme)
+    cartella_pdf = os.path.join(cartella, "pdf")
+    os.makedirs(cartella_pdf, exist_ok=True)
+    database_path = os.path.join(cartella, "corsi.xlsx")
+    excel_path = os.path.join(cartella, "attestati.xlsx")
+
+    corsi = database_corsi(numero_corsi)
+    scrivi_database(database_path, corsi)
+    scrivi_excel_vuoto(excel_path)
+
+    for n in range(numero_file):
+        # le pagine successive alla prima sono allegati (programma del corso, firme)
+        contenuto = [testo_attestato(rnd, corsi)] + [
+            [f"Allegato {p} - programma del corso", "Modulo 1: normativa", "Modulo 2: rischi e misure di prevenzione", "Firma del docente"]
+            for p in range(1, pagine)
+        ]
+        percorso = os.path.join(cartella_pdf, f"attestato_{n:05d}.pdf")
+        if rnd.random() < quota_scansioni:
+            pdf_scansione(percorso, contenuto, rnd)
+        else:
+            with open(percorso, "wb") as f:
+                f.write(pdf_nativo(contenuto))
+
+    return cartella_pdf, database_path, excel_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera un corpus sintetico di attestati PDF")
+    parser.add_argument("cartella", help="cartella di destinazione")
+    parser.add_argument("--file", type=int, default=200, help="numero di PDF")
+    parser.add_argument("--scansioni", type=float, default=0.5, help="quota di PDF senza layer di testo (0-1)")
+    parser.add_argument("--pagine", type=int, default=1, help="pagine per PDF")
+    parser.add_argument("--corsi", type=int, default=200, help="corsi nel database")
+    parser.add_argument("--seme", type=int, default=0, help="seme casuale (corpus riproducibile)")
+    args = parser.parse_args()
+    cartella_pdf, database_path, excel_path = genera_corpus(args.cartella, args.file, args.scansioni, args.pagine, args.corsi, args.seme)
+    print(f"{GREEN}Corpus generato:{RESET} {BOLD}{cartella_pdf}{RESET} (database {database_path}, Excel {excel_path})")
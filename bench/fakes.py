@@ -0,0 +1,326 @@
+# ----- Client finti di Google Vision e OpenAI per i benchmark (nessuna chiamata di rete) -----
+# Latenza, errori, 429 e risposte troncate sono configurabili; le risposte sono deterministiche.
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from types import SimpleNamespace
+import httpx
+from openai import RateLimitError
+from bench.corpus import testo_attestato, database_corsi
+
+
+class Contatori:
+    """
+    Conteggio thread-safe delle chiamate ricevute dai client finti.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.valori = {}
+
+    def incrementa(self, nome, quantita=1):
+        with self._lock:
+            self.valori[nome] = self.valori.get(nome, 0) + quantita
+
+
+class FakeVision:
+    """
+    Sostituto di vision.ImageAnnotatorClient: ogni immagine riceve il testo di un attestato sintetico
+    ricavato dall'hash dei byte (stessa pagina, stesso testo).
+    - latenza: secondi per richiesta, più `latenza_immagine` per ogni immagine del batch.
+    - errori: probabilità che una singola immagine risponda con errore.
+    """
+    def __init__(self, latenza=0.15, latenza_immagine=0.02, errori=0.0, seme=0):
+        self.latenza = latenza
+        self.latenza_immagine = latenza_immagine
+        self.errori = errori
+        self.corsi = database_corsi(200)
+        self.contatori = Contatori()
+        self._rnd = random.Random(seme)
+        self._lock = threading.Lock()
+
+    def _risposta(self, contenuto):
+        with self._lock:
+            errore = self._rnd.random() < self.errori
+        if errore:
+            self.contatori.incrementa("errori")
+            return SimpleNamespace(error=SimpleNamespace(message="errore simulato"), text_annotations=[])
+        seme = int.from_bytes(hashlib.sha256(contenuto).digest()[:8], "big")
+        testo = "\n".join(testo_attestato(random.Random(seme), self.corsi))
+        return SimpleNamespace(error=SimpleNamespace(message=""), text_annotations=[SimpleNamespace(description=testo)])
+
+    def text_detection(self, image):
+        self.contatori.incrementa("richieste")
+        self.contatori.incrementa("immagini")
+        time.sleep(self.latenza + self.latenza_immagine)
+        return self._risposta(image.content)
+
+    def batch_annotate_images(self, requests):
+        self.contatori.incrementa("richieste")
+        self.contatori.incrementa("immagini", len(requests))
+        time.sleep(self.latenza + self.latenza_immagine * len(requests))
+        return SimpleNamespace(responses=[self._risposta(r.image.content) for r in requests])
+
+
+# campi estratti dal testo degli attestati sintetici
+ESPRESSIONI = {
+    "partecipante": re.compile(r"Si attesta che (\S+) (\S+)"),
+    "codice_fiscale": re.compile(r"Codice fiscale: (\w{16})"),
+    "nascita": re.compile(r"nato a "),
+    "durata_corso": re.compile(r"durata di (\d+) ore"),
+    "data_fine_corso": re.compile(r"concluso in data (\d\d/\d\d/\d{4})"),
+    "nome_corso": re.compile(r"ha frequentato con esito positivo il corso\n(.+)"),
+}
+
+
+# chiavi dell'output compatto (richiesto quando il prompt di sistema ne contiene la legenda)
+CHIAVI_COMPATTE = {
+    "id": "i", "nome_partecipante": "n", "cognome_partecipante": "c", "codice_fiscale": "f",
+    "data_fine_corso": "d", "nome_corso": "nc", "codice_corso": "cc", "durata_corso": "h",
+}
+
+
+def token_approssimati(testo):
+    # circa 4 caratteri per token: sufficiente per usage e tempi simulati
+    return max(1, len(testo) // 4)
+
+
+class _RispostaGrezza:
+    def __init__(self, headers, risposta):
+        self.headers = headers
+        self._risposta = risposta
+
+    def parse(self):
+        return self._risposta
+
+
+class FakeOpenAI:
+    """
+    Sostituto del client OpenAI per chat.completions.with_raw_response.create (con e senza stream)
+    e per la Batch API (files.create/content, batches.create/retrieve).
+    Per ogni "Attestato X - nome_file" del messaggio restituisce un JSON con i campi del testo
+    (con chiavi brevi se il prompt richiede l'output compatto).
+    - latenza: secondi prima del primo token; token_al_secondo: velocità di generazione dell'output.
+    - errori_429: probabilità di una risposta 429 (con header retry-after-ms), solo per le chiamate interattive.
+    - troncamenti: probabilità di una risposta interrotta a metà (finish_reason "length").
+    - errori_bulk: probabilità che una richiesta di un job bulk fallisca (status_code 500 nel file di errori).
+    - controlli_job: controlli di stato (batches.retrieve) prima che un job risulti completato.
+    """
+    def __init__(self, latenza=0.5, token_al_secondo=400, errori_429=0.0, troncamenti=0.0, attesa_429_ms=200, seme=0,
+                 errori_bulk=0.0, controlli_job=1):
+        self.latenza = latenza
+        self.token_al_secondo = token_al_secondo
+        self.errori_429 = errori_429
+        self.troncamenti = troncamenti
+        self.attesa_429_ms = attesa_429_ms
+        self.errori_bulk = errori_bulk
+        self.controlli_job = controlli_job
+        self.contatori = Contatori()
+        self._rnd = random.Random(seme)
+        self._lock = threading.Lock()
+        self._prefissi = set()
+        # Batch API: file caricati e prodotti (id -> testo JSONL) e job (id -> stato)
+        self._file = {}
+        self._job = {}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create)))
+        self.files = SimpleNamespace(create=self._crea_file, content=self._contenuto_file)
+        self.batches = SimpleNamespace(create=self._crea_job, retrieve=self._stato_job)
+
+    def _caso(self, probabilita):
+        with self._lock:
+            return self._rnd.random() < probabilita
+
+    @staticmethod
+    def analizza(id_attestato, testo):
+        campi = {nome: espressione.search(testo) for nome, espressione in ESPRESSIONI.items()}
+        partecipante = campi["partecipante"]
+        valore = lambda nome: campi[nome].group(1) if campi[nome] else "ND"
+        return {
+            "id": str(id_attestato),
+            "nome_partecipante": partecipante.group(1) if partecipante else "ND",
+            "cognome_partecipante": partecipante.group(2) if partecipante else "ND",
+            "codice_fiscale": valore("codice_fiscale"),
+            "data_fine_corso": valore("data_fine_corso"),
+            "nome_corso": valore("nome_corso"),
+            "codice_corso": "ND",
+            "dati_anagrafici": "YES" if campi["codice_fiscale"] or campi["nascita"] else "NO",
+            "tdi": "YES" if "tecnologie d'impresa" in testo.lower() else "NO",
+            "durata_corso": valore("durata_corso"),
+        }
+
+    @staticmethod
+    def compatta(item, estratti):
+        """
+        JSON nel formato compatto: chiavi brevi, stringa vuota per i campi già estratti.
+        """
+        return {breve: "" if breve in estratti else item[campo] for campo, breve in CHIAVI_COMPATTE.items()}
+
+    def _contenuto(self, parametri):
+        compatto = "Legenda delle chiavi" in parametri["messages"][0]["content"]
+        messaggio = parametri["messages"][-1]["content"]
+        parti = re.split(r"^Attestato (\d+) - .*?(?: \[già estratti: ([a-z, ]+)\])?$", messaggio, flags=re.MULTILINE)
+        # parti = [prefisso, id1, nota1, testo1, id2, nota2, testo2, ...]
+        items = []
+        for i in range(1, len(parti) - 2, 3):
+            item = self.analizza(int(parti[i]), parti[i + 2])
+            if compatto:
+                item = self.compatta(item, (parti[i + 1] or "").split(", "))
+            items.append(item)
+        if parametri.get("response_format"):
+            return json.dumps({"attestati": items}, ensure_ascii=False)
+        return json.dumps(items, ensure_ascii=False)
+
+    def _usage(self, parametri, contenuto):
+        sistema = parametri["messages"][0]["content"]
+        prompt_tokens = sum(token_approssimati(m["content"]) for m in parametri["messages"])
+        # prefisso già visto: servito dalla prompt cache (come il provider, a blocchi)
+        with self._lock:
+            cached = token_approssimati(sistema) // 128 * 128 if sistema in self._prefissi else 0
+            self._prefissi.add(sistema)
+        completion_tokens = token_approssimati(contenuto)
+        return SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=cached),
+        )
+
+    def _headers(self):
+        return {
+            "x-ratelimit-limit-requests": "10000",
+            "x-ratelimit-remaining-requests": "9999",
+            "x-ratelimit-limit-tokens": "30000000",
+            "x-ratelimit-remaining-tokens": "29000000",
+        }
+
+    def create(self, **parametri):
+        self.contatori.incrementa("richieste")
+        if self._caso(self.errori_429):
+            self.contatori.incrementa("429")
+            time.sleep(0.01)
+            risposta = httpx.Response(
+                429, headers={"retry-after-ms": str(self.attesa_429_ms)},
+                request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"),
+            )
+            raise RateLimitError("Rate limit simulato", response=risposta, body=None)
+
+        contenuto = self._contenuto(parametri)
+        finish_reason = "stop"
+        if self._caso(self.troncamenti):
+            self.contatori.incrementa("troncamenti")
+            contenuto = contenuto[:len(contenuto) // 2]
+            finish_reason = "length"
+        usage = self._usage(parametri, contenuto)
+        self.contatori.incrementa("token_output", usage.completion_tokens)
+
+        if parametri.get("stream"):
+            return _RispostaGrezza(self._headers(), self._stream(contenuto, finish_reason, usage))
+
+        time.sleep(self.latenza + usage.completion_tokens / self.token_al_secondo)
+        risposta = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=contenuto), finish_reason=finish_reason)],
+            usage=usage,
+        )
+        return _RispostaGrezza(self._headers(), risposta)
+
+    def _stream(self, contenuto, finish_reason, usage, caratteri_per_chunk=64):
+        time.sleep(self.latenza)
+        pausa = caratteri_per_chunk / 4 / self.token_al_secondo
+        for inizio in range(0, len(contenuto), caratteri_per_chunk):
+            time.sleep(pausa)
+            delta = SimpleNamespace(content=contenuto[inizio:inizio + caratteri_per_chunk])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=None, finish_reason=finish_reason)], usage=None)
+        # con include_usage l'ultimo chunk ha solo l'usage
+        yield SimpleNamespace(choices=[], usage=usage)
+
+    # ----- Batch API -----
+    def _nuovo_file_locked(self, testo):
+        file_id = f"file-{len(self._file) + 1}"
+        self._file[file_id] = testo
+        return file_id
+
+    def _nuovo_file(self, testo):
+        with self._lock:
+            return self._nuovo_file_locked(testo)
+
+    def _crea_file(self, file, purpose):
+        self.contatori.incrementa("file_caricati")
+        return SimpleNamespace(id=self._nuovo_file(file.read().decode("utf-8")), purpose=purpose)
+
+    def _contenuto_file(self, file_id):
+        return SimpleNamespace(text=self._file[file_id])
+
+    def _risposta_bulk(self, richiesta):
+        """
+        Riga del file di output (o di errori) della Batch API per una riga del file di input.
+        """
+        custom_id = richiesta["custom_id"]
+        if self._caso(self.errori_bulk):
+            self.contatori.incrementa("errori_bulk")
+            errore = {"error": {"message": "errore simulato", "type": "server_error"}}
+            return False, {"id": f"batch_req_{custom_id}", "custom_id": custom_id,
+                           "response": {"status_code": 500, "request_id": f"req_{custom_id}", "body": errore}, "error": None}
+
+        parametri = richiesta["body"]
+        contenuto = self._contenuto(parametri)
+        finish_reason = "stop"
+        if self._caso(self.troncamenti):
+            self.contatori.incrementa("troncamenti")
+            contenuto = contenuto[:len(contenuto) // 2]
+            finish_reason = "length"
+        usage = self._usage(parametri, contenuto)
+        self.contatori.incrementa("token_output", usage.completion_tokens)
+        body = {
+            "id": f"chatcmpl-{custom_id}",
+            "object": "chat.completion",
+            "model": parametri["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": contenuto}, "finish_reason": finish_reason}],
+            "usage": {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens,
+                "prompt_tokens_details": {"cached_tokens": usage.prompt_tokens_details.cached_tokens},
+            },
+        }
+        return True, {"id": f"batch_req_{custom_id}", "custom_id": custom_id,
+                      "response": {"status_code": 200, "request_id": f"req_{custom_id}", "body": body}, "error": None}
+
+    def _crea_job(self, input_file_id, endpoint, completion_window, **_):
+        self.contatori.incrementa("job_bulk")
+        output, errori = [], []
+        for linea in self._file[input_file_id].splitlines():
+            if linea.strip():
+                riuscita, risposta = self._risposta_bulk(json.loads(linea))
+                (output if riuscita else errori).append(json.dumps(risposta, ensure_ascii=False))
+        with self._lock:
+            job_id = f"batch_{len(self._job) + 1}"
+            self._job[job_id] = {
+                "controlli": 0,
+                "totale": len(output) + len(errori),
+                "completate": len(output),
+                "fallite": len(errori),
+                "output": output,
+                "errori": errori,
+            }
+        return self._stato_job(job_id, conta=False)
+
+    def _stato_job(self, job_id, conta=True):
+        with self._lock:
+            job = self._job[job_id]
+            if conta:
+                job["controlli"] += 1
+            completato = job["controlli"] >= self.controlli_job
+            if completato and "output_file_id" not in job:
+                # come la Batch API: file di output e di errori solo se non vuoti
+                job["output_file_id"] = self._nuovo_file_locked("\n".join(job["output"]) + "\n") if job["output"] else None
+                job["error_file_id"] = self._nuovo_file_locked("\n".join(job["errori"]) + "\n") if job["errori"] else None
+            return SimpleNamespace(
+                id=job_id,
+                status="completed" if completato else "in_progress",
+                request_counts=SimpleNamespace(total=job["totale"], completed=job["completate"] if completato else 0, failed=job["fallite"] if completato else 0),
+                output_file_id=job.get("output_file_id"),
+                error_file_id=job.get("error_file_id"),
+            )
@@ -0,0 +1,191 @@
+# ----- Benchmark end-to-end della pipeline con client Vision e OpenAI finti -----
+# Uso: python -m bench.pipeline [--file 200] [--scansioni 0.5] [--latenza-openai 0.5] [--errori-429 0.05] [--bulk] [--json report.json]
+# Richiede Poppler (conversione delle pagine e pdftotext), non richiede credenziali né rete.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from utils.style import *
+from bench.corpus import genera_corpus
+
+
+def picco_rss_mb():
+    """
+    Picco di memoria residente del processo e dei processi figli (pool di conversione), in MB.
+    """
+    try:
+        import resource
+    except ImportError:
+        # Windows: non disponibile
+        return None
+    # ru_maxrss è in KB su Linux, in byte su macOS
+    divisore = 1024 * 1024 if sys.platform == "darwin" else 1024
+    processo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisore
+    figli = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisore
+    return {"processo": round(processo, 1), "figli": round(figli, 1)}
+
+
+class Misure:
+    """
+    Tempo e picco di memoria Python (tracemalloc) di ogni fase.
+    """
+    def __init__(self):
+        self.fasi = {}
+        tracemalloc.start()
+
+    @contextmanager
+    def fase(self, nome):
+        tracemalloc.reset_peak()
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            durata = time.perf_counter() - inizio
+            _, picco = tracemalloc.get_traced_memory()
+            self.fasi[nome] = {"secondi": round(durata, 3), "picco_mb": round(picco / 1024 / 1024, 1)}
+            print(f"{CYAN}{nome}{RESET}: {durata:.2f} s, picco {picco / 1024 / 1024:.1f} MB")
+
+
+def prepara_ambiente(cartella, database_path, excel_path):
+    """
+    Variabili d'ambiente lette da utils.config: vanno impostate prima di importare la pipeline,
+    così cache (OCR, corsi, cambio), journal, statistiche e archivio del benchmark non toccano quelli reali.
+    """
+    os.environ.update({
+        "PDF_FOLDER": os.path.join(cartella, "pdf"),
+        "DATABASE_PATH": database_path,
+        "EXCEL_PATH": excel_path,
+        "API_KEY": "benchmark",
+        "OCR_CACHE_DIR": os.path.join(cartella, "cache_ocr"),
+        "JOURNAL_PATH": os.path.join(cartella, "journal.jsonl"),
+        "STATISTICHE_PATH": os.path.join(cartella, "statistiche.json"),
+        "METRICHE_PATH": os.path.join(cartella, "metriche.json"),
+        "CORSI_CACHE_PATH": os.path.join(cartella, "corsi.json"),
+        "CAMBIO_PATH": os.path.join(cartella, "cambio.json"),
+        "ARCHIVIO_PATH": os.path.join(cartella, "attestati.sqlite"),
+    })
+
+def esegui(args, cartella):
+    cartella_pdf, database_path, excel_path = genera_corpus(cartella, args.file, args.scansioni, args.pagine, args.corsi, args.seme)
+    prepara_ambiente(cartella, database_path, excel_path)
+
+    misure = Misure()
+    with misure.fase("import"):
+        from utils.format import Formatter
+        from utils.excel import ExcelWriter, riga_excel
+        from gpt.tokens import shared
+        from gpt import openai_api, bulk
+        from OCR import text_extraction
+        from utils.metriche import metriche
+        from bench.fakes import FakeVision, FakeOpenAI
+
+    vision = FakeVision(args.latenza_vision, args.latenza_immagine, args.errori_vision, args.seme)
+    openai = FakeOpenAI(args.latenza_openai, args.token_al_secondo, args.errori_429, args.troncamenti, seme=args.seme,
+                        errori_bulk=args.errori_bulk)
+    text_extraction.imposta_client(vision)
+    openai_api.imposta_client(openai)
+    # file JSONL e riferimenti dei job bulk nella cartella del benchmark
+    bulk.BULK_CARTELLA = os.path.join(cartella, "bulk")
+    # nessuna richiesta del tasso di cambio
+    shared._cached_rate = 1.0
+
+    # stima senza OCR prima dell'elaborazione (cache vuota): i file del corpus sono tutti diversi,
+    # quindi nessuno deve risultare duplicato, nemmeno le scansioni senza testo nativo
+    with misure.fase("stima"):
+        from utils.duplicati import deduplica
+        stimati = [shared.documento_stimato(cartella_pdf, nome) for nome in sorted(os.listdir(cartella_pdf)) if nome.lower().endswith(".pdf")]
+        rappresentanti = deduplica(stimati)
+    assert len(rappresentanti) == len(stimati), \
+        f"stima: {len(stimati)} file distinti ridotti a {len(rappresentanti)} dalla deduplicazione"
+
+    inizio = time.perf_counter()
+    with misure.fase("token_per_pdf"):
+        documenti = shared.token_per_pdf(cartella_pdf)
+    with misure.fase("crea_batch"):
+        batches = list(openai_api.crea_batch(documenti))
+    if args.bulk:
+        # Batch API simulata: job creati, controllati senza attese e scaricati in formato JSONL
+        with misure.fase("openai_bulk"):
+            risultati = list(bulk.elabora_bulk(batches, client=openai, intervallo_polling=0))
+    else:
+        with misure.fase("openai_call"):
+            risultati = list(openai_api.dispatch_batch(batches))
+    with misure.fase("excel"):
+        writer = ExcelWriter(excel_path, args.checkpoint, args.sidecar)
+        for _, batch, analisi in risultati:
+            json_completi = Formatter.allinea_json(batch, analisi)
+            writer.scrivi_righe([riga_excel(attestato, documento) for attestato, documento in zip(json_completi, batch)], batch)
+            writer.fine_batch()
+        writer.salva()
+    totale = time.perf_counter() - inizio
+
+    analizzati = sum(len(analisi) for _, _, analisi in risultati)
+    report = {
+        "parametri": vars(args),
+        "file": args.file,
+        "file_estratti": len(documenti),
+        "attestati_analizzati": analizzati,
+        "batch": len(batches),
+        "secondi_totali": round(totale, 2),
+        "file_al_minuto": round(len(documenti) / totale * 60, 1) if totale else None,
+        "fasi": misure.fasi,
+        "picco_rss_mb": picco_rss_mb(),
+        "metodi_estrazione": dict(shared.metodi_estrazione),
+        "token": {"input": shared.token_totali_input, "input_cached": shared.token_totali_input_cached, "output": shared.token_totali_output},
+        "vision": vision.contatori.valori,
+        "openai": openai.contatori.valori,
+        # tempi per pagina, richiesta e batch registrati dalla pipeline
+        "metriche": metriche.riepilogo(),
+    }
+
+    print(f"\n{BOLD}{'fase':<16}{'secondi':>10}{'% totale':>10}{'picco MB':>10}{RESET}")
+    for nome, fase in misure.fasi.items():
+        if nome == "import":
+            continue
+        print(f"{nome:<16}{fase['secondi']:>10.2f}{fase['secondi'] / totale * 100:>10.1f}{fase['picco_mb']:>10.1f}")
+    print(f"\n\U0001F4C4 {BOLD}{len(documenti)}{RESET} file in {BOLD}{totale:.1f} s{RESET} ({BOLD}{report['file_al_minuto']} file/min{RESET}), "
+          f"{analizzati} attestati analizzati in {len(batches)} batch")
+    print(f"\U0001F4BE Picco RSS: {report['picco_rss_mb']}")
+    metriche.stampa()
+    print(f"\U0001F50E Vision: {vision.contatori.valori}  OpenAI: {openai.contatori.valori}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Report salvato in {BOLD}{args.json}{RESET}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end con client Vision e OpenAI simulati")
+    parser.add_argument("--file", type=int, default=200, help="numero di PDF del corpus sintetico")
+    parser.add_argument("--scansioni", type=float, default=0.5, help="quota di PDF senza layer di testo (0-1)")
+    parser.add_argument("--pagine", type=int, default=1, help="pagine per PDF")
+    parser.add_argument("--corsi", type=int, default=200, help="corsi nel database")
+    parser.add_argument("--seme", type=int, default=0, help="seme casuale")
+    parser.add_argument("--latenza-vision", type=float, default=0.15, help="secondi per richiesta Vision")
+    parser.add_argument("--latenza-immagine", type=float, default=0.02, help="secondi aggiuntivi per immagine")
+    parser.add_argument("--errori-vision", type=float, default=0.0, help="probabilità di errore per immagine")
+    parser.add_argument("--latenza-openai", type=float, default=0.5, help="secondi prima del primo token")
+    parser.add_argument("--token-al-secondo", type=float, default=400, help="velocità di output simulata")
+    parser.add_argument("--errori-429", type=float, default=0.0, help="probabilità di risposta 429")
+    parser.add_argument("--troncamenti", type=float, default=0.0, help="probabilità di risposta troncata")
+    parser.add_argument("--bulk", action="store_true", help="elaborazione con la Batch API simulata invece delle chiamate interattive")
+    parser.add_argument("--errori-bulk", type=float, default=0.0, help="probabilità di richiesta fallita in un job bulk")
+    parser.add_argument("--checkpoint", type=int, default=5, help="checkpoint Excel ogni N batch")
+    parser.add_argument("--sidecar", action="store_true", help="colonne di debug nel CSV separato")
+    parser.add_argument("--cartella", help="cartella di lavoro da conservare (default: temporanea)")
+    parser.add_argument("--json", help="file in cui salvare il report")
+    args = parser.parse_args()
+
+    cartella = args.cartella or tempfile.mkdtemp(prefix="bench_attestati_")
+    try:
+        esegui(args, cartella)
+    finally:
+        if not args.cartella:
+            shutil.rmtree(cartella, ignore_errors=True)
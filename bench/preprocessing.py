@@ -0,0 +1,94 @@
+# ----- Benchmark del preprocessing delle immagini inviate a Vision -----
+# Uso: python -m bench.preprocessing percorso/cartella_pdf [--max-pagine 20] [--senza-ocr]
+import os
+import time
+import argparse
+import difflib
+from pdf2image import convert_from_path
+from utils.style import *
+from utils.config import poppler_path, opzioni_immagine
+from OCR.raster import prepara_immagine, numero_pagine
+
+DPI = 300
+
+# percorso attuale come riferimento, poi le varianti da confrontare
+VARIANTI = {
+    "originale (PNG RGB)": {"scala_grigi": False, "lato_max": 0, "formato": "PNG", "qualita": 0, "salta_vuote": False},
+    "configurata": opzioni_immagine,
+    "grigi PNG 2400": {"scala_grigi": True, "lato_max": 2400, "formato": "PNG", "qualita": 0, "salta_vuote": True},
+    "grigi JPEG 2000 q80": {"scala_grigi": True, "lato_max": 2000, "formato": "JPEG", "qualita": 80, "salta_vuote": True},
+    "grigi WEBP 2000 q80": {"scala_grigi": True, "lato_max": 2000, "formato": "WEBP", "qualita": 80, "salta_vuote": True},
+}
+
+
+def ocr(client, contenuto):
+    from google.cloud import vision
+    response = client.text_detection(image=vision.Image(content=contenuto))
+    return response.text_annotations[0].description if response.text_annotations else ""
+
+def pagine_cartella(cartella, max_pagine):
+    """
+    Generatore delle pagine (immagini PIL a 300 dpi) dei PDF della cartella.
+    """
+    conteggio = 0
+    for nome in sorted(os.listdir(cartella)):
+        if not nome.lower().endswith(".pdf"):
+            continue
+        percorso = os.path.join(cartella, nome)
+        for n in range(1, numero_pagine(percorso) + 1):
+            if conteggio >= max_pagine:
+                return
+            yield nome, n, convert_from_path(percorso, dpi=DPI, first_page=n, last_page=n, poppler_path=poppler_path)[0]
+            conteggio += 1
+
+def esegui(cartella, max_pagine, con_ocr):
+    client = None
+    if con_ocr:
+        from OCR.text_extraction import vision_client
+        client = vision_client()
+
+    risultati = {nome: {"tempo": 0.0, "byte": 0, "saltate": 0, "similarita": [], "tempo_ocr": 0.0} for nome in VARIANTI}
+    pagine = 0
+    for nome_file, n, img in pagine_cartella(cartella, max_pagine):
+        pagine += 1
+        testo_riferimento = None
+        for nome, opzioni in VARIANTI.items():
+            inizio = time.perf_counter()
+            contenuto = prepara_immagine(img, opzioni)
+            risultati[nome]["tempo"] += time.perf_counter() - inizio
+
+            if contenuto is None:
+                risultati[nome]["saltate"] += 1
+                testo = ""
+            else:
+                risultati[nome]["byte"] += len(contenuto)
+                testo = None
+                if con_ocr:
+                    inizio = time.perf_counter()
+                    testo = ocr(client, contenuto)
+                    risultati[nome]["tempo_ocr"] += time.perf_counter() - inizio
+
+            if con_ocr:
+                if testo_riferimento is None:
+                    testo_riferimento = testo
+                risultati[nome]["similarita"].append(difflib.SequenceMatcher(None, testo_riferimento, testo).ratio())
+        print(f"{CYAN}{nome_file} pagina {n}{RESET}")
+
+    if not pagine:
+        print(f"{RED}Nessuna pagina PDF trovata in {cartella}{RESET}")
+        return
+
+    print(f"\n{BOLD}{'variante':<24}{'codifica ms':>12}{'KB/pagina':>12}{'saltate':>9}{'OCR ms':>9}{'similarità':>12}{RESET}")
+    for nome, r in risultati.items():
+        similarita = f"{sum(r['similarita']) / len(r['similarita']):.3f}" if r["similarita"] else "-"
+        tempo_ocr = f"{r['tempo_ocr'] / pagine * 1000:.0f}" if con_ocr else "-"
+        print(f"{nome:<24}{r['tempo'] / pagine * 1000:>12.1f}{r['byte'] / pagine / 1024:>12.1f}{r['saltate']:>9}{tempo_ocr:>9}{similarita:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del preprocessing delle immagini per Google Vision")
+    parser.add_argument("cartella", help="cartella con PDF di esempio")
+    parser.add_argument("--max-pagine", type=int, default=20, help="numero massimo di pagine da analizzare")
+    parser.add_argument("--senza-ocr", action="store_true", help="misura solo codifica e dimensione, senza chiamare Vision")
+    args = parser.parse_args()
+    esegui(args.cartella, args.max_pagine, not args.senza_ocr)
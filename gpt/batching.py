@@ -0,0 +1,140 @@
+# ----- Impacchettamento degli attestati nei batch (bin packing) -----
+import math
+
+# peso relativo dei token di input rispetto a quelli di output nella latenza stimata
+# (il prefill è molto più veloce della generazione)
+PESO_LATENZA_INPUT = 0.05
+
+
+class Batch:
+    """
+    Batch in costruzione: attestati, token di input/output e corsi candidati inclusi.
+    """
+    def __init__(self):
+        self.attestati = []
+        self.token_input = 0
+        self.token_output = 0
+        self.corsi = set()
+        self.token_corsi = 0
+
+    def latenza(self):
+        return self.token_output + (self.token_input + self.token_corsi) * PESO_LATENZA_INPUT
+
+    def riempimento(self, max_input, max_output):
+        # frazione del limite più vicino (input o output) già occupata
+        return max((self.token_input + self.token_corsi) / max_input, self.token_output / max_output)
+
+    def costo_corsi(self, attestato, token_righe):
+        # token dei corsi candidati non ancora presenti nel batch
+        if token_righe is None:
+            return 0
+        return sum(token_righe[i] for i in set(attestato["corsi"]) - self.corsi)
+
+    def entra(self, attestato, max_input, max_output, token_righe):
+        # un batch vuoto accetta sempre l'attestato (anche se da solo supera i limiti)
+        if not self.attestati:
+            return True
+        token_input = self.token_input + self.token_corsi + attestato["token_batch"] + self.costo_corsi(attestato, token_righe)
+        token_output = self.token_output + attestato["token_output"]
+        return token_input <= max_input and token_output <= max_output
+
+    def aggiungi(self, attestato, token_righe):
+        self.token_corsi += self.costo_corsi(attestato, token_righe)
+        if token_righe is not None:
+            self.corsi.update(attestato["corsi"])
+        self.attestati.append(attestato)
+        self.token_input += attestato["token_batch"]
+        self.token_output += attestato["token_output"]
+
+
+def _first_fit_decreasing(attestati, max_input, max_output, token_righe):
+    batches = []
+    for attestato in attestati:
+        for batch in batches:
+            if batch.entra(attestato, max_input, max_output, token_righe):
+                batch.aggiungi(attestato, token_righe)
+                break
+        else:
+            batch = Batch()
+            batch.aggiungi(attestato, token_righe)
+            batches.append(batch)
+    return batches
+
+def _bilanciato(attestati, numero_batch, max_input, max_output, token_righe):
+    """
+    Assegna ogni attestato (dal più grande) al batch con latenza stimata minore in cui entra.
+    Ritorna None se con `numero_batch` batch non si riesce a collocare tutto.
+    """
+    batches = [Batch() for _ in range(numero_batch)]
+    for attestato in attestati:
+        candidati = [b for b in batches if not b.attestati or b.entra(attestato, max_input, max_output, token_righe)]
+        if not candidati:
+            return None
+        min(candidati, key=Batch.latenza).aggiungi(attestato, token_righe)
+    return batches
+
+def impacchetta(attestati, max_input, max_output, token_righe=None):
+    """
+    Suddivide gli attestati nel minor numero di batch che rispettano i limiti di input e output,
+    bilanciando la latenza stimata tra i batch.
+    Ogni attestato deve avere `token_batch` (testo + intestazione) e `token_output`;
+    con `token_righe` (token per riga del database corsi) si conta anche l'unione dei `corsi` candidati.
+    Ritorna una lista di oggetti Batch; dentro ogni batch l'ordine originale degli attestati è mantenuto.
+    """
+    if not attestati:
+        return []
+
+    ordine = {id(a): i for i, a in enumerate(attestati)}
+    decrescenti = sorted(attestati, key=lambda a: (a["token_batch"], a["token_output"]), reverse=True)
+
+    # limite inferiore sul numero di batch, poi FFD come soluzione sempre valida
+    totale_input = sum(a["token_batch"] for a in attestati)
+    totale_output = sum(a["token_output"] for a in attestati)
+    minimo = max(1, math.ceil(totale_input / max_input), math.ceil(totale_output / max_output))
+    ffd = _first_fit_decreasing(decrescenti, max_input, max_output, token_righe)
+
+    batches = ffd
+    for numero_batch in range(minimo, len(ffd) + 1):
+        bilanciati = _bilanciato(decrescenti, numero_batch, max_input, max_output, token_righe)
+        if bilanciati is not None:
+            batches = bilanciati
+            break
+
+    for batch in batches:
+        batch.attestati.sort(key=lambda a: ordine[id(a)])
+    return [b for b in batches if b.attestati]
+
+def impacchetta_flusso(attestati, max_input, max_output, token_righe=None, finestra=2):
+    """
+    Bin packing in streaming: gli attestati si accumulano finché non riempiono `finestra` batch,
+    poi vengono distribuiti con first fit decreasing. I batch chiusi vengono restituiti subito,
+    il meno pieno resta aperto e riceve gli attestati successivi (nessun bilanciamento, che
+    lascerebbe ogni batch pieno solo in parte). A fine flusso il resto viene impacchettato con `impacchetta`.
+    Generatore di liste di attestati, nell'ordine di arrivo dentro ogni batch.
+    """
+    ordine = {}
+    in_attesa = []
+    token_input = 0
+    token_output = 0
+
+    for attestato in attestati:
+        ordine[id(attestato)] = len(ordine)
+        in_attesa.append(attestato)
+        token_input += attestato["token_batch"]
+        token_output += attestato["token_output"]
+        if token_input < finestra * max_input and token_output < finestra * max_output:
+            continue
+
+        decrescenti = sorted(in_attesa, key=lambda a: (a["token_batch"], a["token_output"]), reverse=True)
+        batches = _first_fit_decreasing(decrescenti, max_input, max_output, token_righe)
+        aperto = min(batches, key=lambda b: b.riempimento(max_input, max_output))
+        for batch in batches:
+            if batch is not aperto:
+                yield sorted(batch.attestati, key=lambda a: ordine[id(a)])
+        in_attesa = sorted(aperto.attestati, key=lambda a: ordine[id(a)])
+        token_input = sum(a["token_batch"] for a in in_attesa)
+        token_output = sum(a["token_output"] for a in in_attesa)
+        ordine = {id(a): i for i, a in enumerate(in_attesa)}
+
+    for batch in impacchetta(in_attesa, max_input, max_output, token_righe):
+        yield batch.attestati
@@ -0,0 +1,51 @@
+# ----- Limite di spesa dell'esecuzione: nessun nuovo batch oltre il budget in euro -----
+import threading
+from utils.style import *
+from utils.config import budget_euro
+from gpt.tokens import shared
+
+
+class LimiteSpesa:
+    """
+    Prima dell'invio di ogni batch somma la spesa già registrata (SharedState.price), i costi stimati
+    dei batch ancora in volo e quello del nuovo batch: se il totale supera il limite il batch non viene inviato
+    e da quel momento non ne partono altri. Gli attestati non inviati restano da elaborare (journal).
+    """
+    def __init__(self, limite_euro=None):
+        self.limite = limite_euro
+        self._lock = threading.Lock()
+        self.prenotati = {}
+        self.superato = False
+
+    def attivo(self):
+        return self.limite is not None
+
+    def prenota(self, chiave, costo_stimato):
+        """
+        Riserva il costo stimato di un batch; False se supererebbe il limite.
+        """
+        if not self.attivo():
+            return True
+        with self._lock:
+            previsto = shared.price() + sum(self.prenotati.values()) + costo_stimato
+            if self.superato or previsto > self.limite:
+                if not self.superato:
+                    print(f"\n{YELLOW}{BOLD}Budget di {self.limite} € raggiunto{RESET}{YELLOW} (spesa prevista {previsto:.3f} €): nessun nuovo batch verrà inviato{RESET}")
+                self.superato = True
+                return False
+            self.prenotati[chiave] = costo_stimato
+            return True
+
+    def rilascia(self, chiave):
+        """
+        Il batch è terminato: la sua spesa reale è ora in SharedState.
+        """
+        with self._lock:
+            self.prenotati.pop(chiave, None)
+
+    def riepilogo(self):
+        if self.superato:
+            print(f"{YELLOW}Budget di {self.limite} € raggiunto: gli attestati non inviati verranno elaborati alla prossima esecuzione{RESET}")
+
+
+limite_spesa = LimiteSpesa(budget_euro)
@@ -0,0 +1,209 @@
+# ----- Modalità bulk: elaborazione offline con la Batch API di OpenAI -----
+import os
+import json
+import time
+from types import SimpleNamespace
+from utils.style import *
+from utils.format import Formatter
+from gpt.tokens import shared
+from gpt import openai_api
+from gpt.openai_api import componi_messaggi, campi_locali, espandi_json, corsi_batch, stima_batch, MAX_OUTPUT_TOKENS, MAX_REINVII, SCHEMA_ATTESTATI
+from gpt.budget import limite_spesa
+
+# limiti per file di input della Batch API (https://platform.openai.com/docs/guides/batch)
+BULK_MAX_RICHIESTE = 50000
+BULK_MAX_BYTE = 190 * 1024 * 1024
+# secondi tra due controlli dello stato dei job
+BULK_POLLING = 60
+# cartella dei file JSONL inviati e dei riferimenti ai job
+BULK_CARTELLA = os.path.join(".cache", "bulk")
+
+STATI_FINALI = ("completed", "failed", "expired", "cancelled")
+
+
+def riga_richiesta(custom_id, documenti, corsi, locali=None):
+    """
+    Riga JSONL della Batch API per un (sotto)batch di documenti.
+    - locali: campi già ricavati localmente (da campi_locali), None per l'output esteso.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": "gpt-4o",
+            "messages": componi_messaggi([(d["nome_file"], d["testo"]) for d in documenti], corsi, locali),
+            "max_tokens": MAX_OUTPUT_TOKENS,
+            "temperature": 0.0,
+            "response_format": SCHEMA_ATTESTATI,
+        },
+    }
+
+def _usage(dati):
+    # usage della Batch API (dizionario) nella forma attesa da SharedState.token
+    dettagli = SimpleNamespace(**(dati.get("prompt_tokens_details") or {}))
+    return SimpleNamespace(**{**dati, "prompt_tokens_details": dettagli})
+
+def _dividi(righe):
+    """
+    Divide le righe JSONL in più file rispettando i limiti di richieste e dimensione.
+    """
+    parti, corrente, dimensione = [], [], 0
+    for riga in righe:
+        codificata = (json.dumps(riga, ensure_ascii=False) + "\n").encode("utf-8")
+        if corrente and (len(corrente) >= BULK_MAX_RICHIESTE or dimensione + len(codificata) > BULK_MAX_BYTE):
+            parti.append(corrente)
+            corrente, dimensione = [], 0
+        corrente.append(codificata)
+        dimensione += len(codificata)
+    if corrente:
+        parti.append(corrente)
+    return parti
+
+def esegui_job(righe, client, intervallo_polling=BULK_POLLING):
+    """
+    Carica le richieste, crea i job della Batch API, attende la loro conclusione
+    e ritorna {custom_id: body della risposta} per le richieste completate con successo.
+    """
+    os.makedirs(BULK_CARTELLA, exist_ok=True)
+    job_ids = []
+    for parte in _dividi(righe):
+        percorso = os.path.join(BULK_CARTELLA, f"richieste-{int(time.time() * 1000)}.jsonl")
+        with open(percorso, "wb") as f:
+            f.writelines(parte)
+        with open(percorso, "rb") as f:
+            file_input = client.files.create(file=f, purpose="batch")
+        job = client.batches.create(input_file_id=file_input.id, endpoint="/v1/chat/completions", completion_window="24h")
+        job_ids.append(job.id)
+        # riferimento al job per poterlo recuperare manualmente se il processo si interrompe
+        with open(f"{percorso}.job", "w", encoding="utf-8") as f:
+            f.write(job.id)
+        print(f"{BOLD}Job bulk {job.id} creato con {len(parte)} richieste{RESET}")
+
+    risposte = {}
+    for job_id in job_ids:
+        while True:
+            job = client.batches.retrieve(job_id)
+            if job.status in STATI_FINALI:
+                break
+            conteggi = job.request_counts
+            completate = f" ({conteggi.completed}/{conteggi.total})" if conteggi else ""
+            print(f"{CYAN}Job {job_id}: {job.status}{completate}{RESET}")
+            time.sleep(intervallo_polling)
+
+        if job.status != "completed":
+            print(f"{RED}{BOLD}Job bulk {job_id} terminato con stato {job.status}{RESET}")
+        if not job.output_file_id:
+            continue
+
+        for linea in client.files.content(job.output_file_id).text.splitlines():
+            if not linea.strip():
+                continue
+            risultato = json.loads(linea)
+            response = risultato.get("response") or {}
+            if response.get("status_code") == 200:
+                risposte[risultato["custom_id"]] = response["body"]
+    return risposte
+
+def analisi_da_body(body):
+    """
+    Estrae i JSON degli attestati dalla risposta di una richiesta della Batch API e ne conta i token.
+    """
+    if body.get("usage"):
+        shared.token(_usage(body["usage"]), bulk=True)
+    choice = body["choices"][0]
+    contenuto = choice["message"].get("content") or ""
+    if choice.get("finish_reason") != "length":
+        try:
+            return json.loads(contenuto)["attestati"]
+        except (ValueError, KeyError, TypeError):
+            pass
+    return Formatter.estrai_json_parziali(contenuto)
+
+def elabora_bulk(batches, client=None, intervallo_polling=BULK_POLLING, al_json=None):
+    """
+    Elabora tutti i batch con la Batch API: un job per round, i mancanti (id assenti o risposte troncate)
+    vengono reinviati nel round successivo, divisi a metà se la risposta non contiene nessun JSON valido.
+    Il client è sostituibile (es. un server locale di test).
+    - al_json: callback (batch, json) chiamata per ogni attestato appena scaricato il risultato del job,
+      come in dispatch_batch (scrittura e journal prima della fine di tutti i round).
+    Con un budget (BUDGET_EURO) ogni round contiene solo le richieste con spesa prevista entro il limite;
+    gli attestati esclusi non vengono restituiti e restano da elaborare.
+    Generatore con la stessa interfaccia di dispatch_batch: (numero_batch, batch, analisi).
+    """
+    client = client or openai_api.openai_client()
+    batches = list(batches)
+    if limite_spesa.attivo():
+        # nel job entrano solo i batch con spesa prevista entro il budget
+        ammessi = []
+        for n, batch in enumerate(batches, start=1):
+            if not limite_spesa.prenota(n, shared.stima_prezzo(*stima_batch(batch), bulk=True)):
+                break
+            ammessi.append(batch)
+        batches = ammessi
+    risultati = {n: {} for n in range(1, len(batches) + 1)}
+    # posizioni non reinviate per il budget: non vengono restituite (nessun placeholder)
+    esclusi = {n: set() for n in range(1, len(batches) + 1)}
+
+    # richieste in sospeso: custom_id -> (numero batch, posizioni degli attestati nel batch)
+    pendenti = {f"b{n}-r0": (n, list(range(1, len(b) + 1))) for n, b in enumerate(batches, start=1)}
+
+    for round_bulk in range(MAX_REINVII + 1):
+        if round_bulk and limite_spesa.attivo():
+            # reinvii: ogni richiesta viene prenotata come i batch del primo round
+            for custom_id, (n, posizioni) in list(pendenti.items()):
+                documenti = [batches[n - 1][p - 1] for p in posizioni]
+                if not limite_spesa.prenota(custom_id, shared.stima_prezzo(*stima_batch(documenti), bulk=True)):
+                    esclusi[n].update(posizioni)
+                    del pendenti[custom_id]
+        if not pendenti:
+            break
+        righe = []
+        locali = {}
+        for custom_id, (n, posizioni) in pendenti.items():
+            documenti = [batches[n - 1][p - 1] for p in posizioni]
+            locali[custom_id] = campi_locali([(d["nome_file"], d["testo"]) for d in documenti])
+            righe.append(riga_richiesta(custom_id, documenti, corsi_batch(documenti), locali[custom_id]))
+        risposte = esegui_job(righe, client, intervallo_polling)
+        # la spesa reale del round è ora in SharedState
+        for chiave in list(pendenti) + (list(risultati) if round_bulk == 0 else []):
+            limite_spesa.rilascia(chiave)
+
+        nuovi = {}
+        for custom_id, (n, posizioni) in pendenti.items():
+            items = analisi_da_body(risposte[custom_id]) if custom_id in risposte else []
+            for item in items:
+                item = espandi_json(item, locali[custom_id])
+                try:
+                    indice = int(item["id"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if 1 <= indice <= len(posizioni) and posizioni[indice - 1] not in risultati[n]:
+                    originale = posizioni[indice - 1]
+                    risultati[n][originale] = {**item, "id": str(originale)}
+                    if al_json:
+                        al_json(batches[n - 1], risultati[n][originale])
+
+            mancanti = [p for p in posizioni if p not in risultati[n]]
+            # bisezione solo se la risposta c'è ma non contiene JSON validi; una richiesta fallita
+            # (errore del server, job scaduto) viene reinviata intera
+            if len(mancanti) == len(posizioni) and len(mancanti) > 1 and custom_id in risposte:
+                meta = len(mancanti) // 2
+                gruppi = [mancanti[:meta], mancanti[meta:]]
+            else:
+                gruppi = [mancanti] if mancanti else []
+            for i, gruppo in enumerate(gruppi):
+                nuovi[f"{custom_id.split('-')[0]}-r{round_bulk + 1}-{len(nuovi)}-{i}"] = (n, gruppo)
+
+        if nuovi and round_bulk < MAX_REINVII:
+            print(f"\n{YELLOW}Reinvio bulk di {sum(len(p) for _, p in nuovi.values())} attestati senza risposta valida{RESET}")
+        pendenti = nuovi
+
+    for n, batch in enumerate(batches, start=1):
+        if not esclusi[n]:
+            yield n, batch, [risultati[n][p] for p in sorted(risultati[n])]
+            continue
+        # batch ridotto agli attestati non esclusi, con gli id riportati alle nuove posizioni
+        tenute = [p for p in range(1, len(batch) + 1) if p not in esclusi[n]]
+        if tenute:
+            yield n, [batch[p - 1] for p in tenute], [{**risultati[n][p], "id": str(i)} for i, p in enumerate(tenute, start=1) if p in risultati[n]]
@@ -1,12 +1,19 @@
-import sys
+import time
 import json
 import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from utils.style import *
-from utils.format import Formatter
-from utils.config import openai_api_key
-from utils.match_corsi import prompt_db
-from gpt.tokens import shared
-from openai import OpenAI
+from utils.format import Formatter, ParserIncrementale
+from utils.config import openai_api_key, openai_base_url, output_compatto
+from utils.match_corsi import prompt_db, prompt_database, righe_corsi, candidati_corsi, indice_corsi
+from gpt.tokens import shared, TOKEN_OUTPUT_PER_PDF
+from gpt.statistiche import statistiche
+from gpt.rate_limit import RateLimiter
+from gpt.budget import limite_spesa
+from utils.metriche import metriche
+from utils.estrazione_locale import estrai_campi
+from gpt.batching import impacchetta_flusso
 
 # capacità totale di token per richiesta (default: 128.000)
 MAX_TOTAL_TOKENS = 128000
@@ -14,23 +21,79 @@ MAX_TOTAL_TOKENS = 128000
 MAX_OUTPUT_TOKENS = 16384
 # margine di sicurezza per la dimensione del batch
 BATCH_SAFETY_MARGIN = 0.1
+# batch accumulati prima del bin packing: uno in più di quello da inviare, così il primo batch
+# parte appena possibile e in memoria restano al massimo due batch di attestati
+FINESTRA_BATCH = 2
+# token della parte variabile prima degli attestati ("N = ...")
+TOKEN_PREFISSO_BATCH = 20
 
-# numero di token di output stimato per attestato (dipende dall'attestato)
-TOKEN_OUTPUT_PER_PDF = 170
+# numero massimo di batch inviati contemporaneamente
+MAX_RICHIESTE_IN_VOLO = 4
+# budget di richieste e token al minuto (da adeguare al tier dell'account, corretti poi dagli header)
+RPM_BUDGET = 500
+TPM_BUDGET = 450000
+# tentativi per richiesta in caso di 429 o errori temporanei
+MAX_TENTATIVI = 6
+# risposte in streaming con output strutturato (JSON schema), analizzate man mano che arrivano
+STREAMING_STRUTTURATO = True
+# livelli massimi di reinvio (con bisezione) degli attestati mancanti o troncati
+MAX_REINVII = 3
 
 
-# openai client configuration
-client = OpenAI(api_key=openai_api_key)
+# openai client configuration (i retry sono gestiti da richiesta_openai)
+# OPENAI_BASE_URL permette di puntare a un server compatibile (es. un server locale di test)
+_client = None
+_lock_client = threading.Lock()
 
-# prompt template
-prompt = f"""
+def openai_client():
+    """
+    Client OpenAI, creato al primo utilizzo.
+    """
+    global _client
+    with _lock_client:
+        if _client is None:
+            from openai import OpenAI
+            _client = OpenAI(api_key=openai_api_key, base_url=openai_base_url, max_retries=0)
+        return _client
+
+def imposta_client(client):
+    """
+    Sostituisce il client OpenAI (es. un client finto per test e benchmark).
+    """
+    global _client
+    with _lock_client:
+        _client = client
+
+rate_limiter = RateLimiter(RPM_BUDGET, TPM_BUDGET)
+
+
+class ErroreNonRecuperabile(Exception):
+    """
+    Errore di OpenAI che si ripeterebbe su ogni batch (credito esaurito, richiesta non valida):
+    l'invio si ferma, i risultati già ricevuti vengono salvati.
+    """
+
+class TentativiEsauriti(RuntimeError):
+    """
+    Richiesta fallita per 429 o errori temporanei anche dopo MAX_TENTATIVI tentativi.
+    """
+
+class ErroreTrasporto(Exception):
+    """
+    Risposta interrotta da un errore di rete o del server: il contenuto del batch non c'entra.
+    """
+
+# prompt template (istruzioni comuni, formato del JSON e regole di compilazione)
+INTRODUZIONE = f"""
 Ogni corso del database, quindi ogni riga, è espresso nella forma [CODICE CORSO] --- [NOME CORSO] (alias) --- [DURATA MINIMA - DURATA MASSIMA]
-Ti invio inoltre un totale di N testi estratti da altrettanti attestati di partecipazione di dipendenti a corsi di formazione. 
+Ti invio inoltre un totale di N testi estratti da altrettanti attestati di partecipazione di dipendenti a corsi di formazione (il valore di N è indicato all'inizio del messaggio con gli attestati). 
 Ogni testo è numerato e introdotto dalla dicitura "Attestato X - [nome_file]", dove X è il numero d'ordine dell'attestato nell'elenco nonchè l'id dell'attestato.
 Rispondi SEMPRE con una lista [] che contenga come elementi ESATTAMENTE N JSON, uno per ciascuno degli attestati. A ciascun attestato deve essere associato il suo JSON, che non condivide con nessun altro attestato nell'elenco.
 Esempio di output per N attestati: [{{json_attestato1}}, {{json_attestato2}}, ... {{json_attestatoN}}]
 Il tuo output verrà elaborato automaticamente. Qualsiasi deviazione dal formato richiesto causerà errori nel sistema.
+"""
 
+FORMATO_ESTESO = f"""
 Usa questo formato esatto per il JSON di ciascun attestato:
 {{
     "id": "<numero dell'attestato>",
@@ -44,7 +107,15 @@ Usa questo formato esatto per il JSON di ciascun attestato:
     "tdi": "<YES/NO>",
     "durata_corso": "<durata>",
 }}
+"""
+
+FORMATO_COMPATTO = f"""
+Usa questo formato esatto per il JSON di ciascun attestato, con le chiavi abbreviate:
+{{"i": "<numero dell'attestato>", "n": "<nome proprio del partecipante>", "c": "<cognome del partecipante>", "f": "<codice fiscale>", "d": "<data fine corso>", "nc": "<nome del corso>", "cc": "<codice corso>", "h": "<durata>"}}
+Legenda delle chiavi: i = id, n = nome_partecipante, c = cognome_partecipante, f = codice_fiscale, d = data_fine_corso, nc = nome_corso, cc = codice_corso, h = durata_corso.
+"""
 
+REGOLE = f"""
 Queste sono le regole da seguire alla lettera per elaborare gli attestati:
 > Per ogni attestato nella richiesta, anche se duplicato, devi generare un JSON specifico nella riposta. Quindi se ricevi per esempio i testi di 10 attestati, dovrai SEMPRE ritornare 10 JSON associati.
 > Se un dato manca tra quelli da compilare nel JSON dell'attestato, scrivi 'ND'.
@@ -65,7 +136,9 @@ Compilazione JSON:
     - La durata_corso DOVREBBE essere compresa tra la DURATA MINIMA e MASSIMA del corso selezionato nel database corsi.
     - Per attestati che hanno lo stesso "nome_corso", associa lo stesso "codice_corso".
     - In generale forza la scrittura del match migliore trovato, solo nel caso in cui non trovi nessun match soddisfacente riporta "ND".
-> In dati_anagrafici scrivi 'YES' se nel testo dell'attestato è presente ALMENO UNO dei seguenti dati sul partecipante:
+"""
+
+REGOLE_ESTESE = f"""> In dati_anagrafici scrivi 'YES' se nel testo dell'attestato è presente ALMENO UNO dei seguenti dati sul partecipante:
     - codice fiscale (alfanumerico di 16 caratteri, può contenere spazi e chiamato c.f. o simili)
     - data di nascita (in qualsasi formato)
     - luogo di nascita (nome di una città, provincia o stato)
@@ -75,110 +148,299 @@ Compilazione JSON:
 \n\n
 """
 
-# tokens riservati per il prompt di sistema (assumo costante)
-SYSTEM_PROMPT = shared.token_calculation(prompt+prompt_db)
+REGOLE_COMPATTE = f"""> Scrivi la durata_corso così come compare nell'attestato (in numero ore), se non è presente scrivi 'ND'.
+> Se l'intestazione di un attestato termina con "[già estratti: ...]", i campi elencati sono già stati ricavati dal testo: scrivi per ciascuno una stringa vuota "".
+\n\n
+"""
 
-# chiamata a openai API
-def openai_call(testi_batch):
-    
-    # stima del tempo di attesa
-    tempo_stimato = shared.stima_durata(testi_batch)
-    # flag per fermare il caricamento
-    stop_loading = threading.Event()
-    # avvia la barra di caricamento in un thread separato
-    progress_thread = threading.Thread(target=progress_bar, args=(tempo_stimato, stop_loading))
-    progress_thread.start()
-    
-    # prompt per openai
-    prompt = f"""
-Ogni corso del database, quindi ogni riga, è espresso nella forma [CODICE CORSO] --- [NOME CORSO] (alias) --- [DURATA MINIMA - DURATA MASSIMA]
-Ti invio inoltre un totale di {shared.current_batch_size} testi estratti da altrettanti attestati di partecipazione di dipendenti a corsi di formazione. 
-Ogni testo è numerato e introdotto dalla dicitura "Attestato X - [nome_file]", dove X è il numero d'ordine dell'attestato nell'elenco nonchè l'id dell'attestato.
-Rispondi SEMPRE con una lista [] che contenga come elementi ESATTAMENTE {shared.current_batch_size} JSON, uno per ciascuno degli attestati. A ciascun attestato deve essere associato il suo JSON, che non condivide con nessun altro attestato nell'elenco.
-Esempio di output per N attestati: [{{json_attestato1}}, {{json_attestato2}}, ... {{json_attestatoN}}]
-Il tuo output verrà elaborato automaticamente. Qualsiasi deviazione dal formato richiesto causerà errori nel sistema.
+# output compatto: chiavi brevi e nessun campo ricavabile con regole locali (tdi, dati anagrafici,
+# codice fiscale e durata se trovati con certezza), riespanso da espandi_json all'arrivo
+CHIAVI_COMPATTE = {
+    "i": "id", "n": "nome_partecipante", "c": "cognome_partecipante", "f": "codice_fiscale",
+    "d": "data_fine_corso", "nc": "nome_corso", "cc": "codice_corso", "h": "durata_corso",
+}
+if output_compatto:
+    prompt = INTRODUZIONE + FORMATO_COMPATTO + REGOLE + REGOLE_COMPATTE
+else:
+    prompt = INTRODUZIONE + FORMATO_ESTESO + REGOLE + REGOLE_ESTESE
 
-Usa questo formato esatto per il JSON di ciascun attestato:
-{{
-    "id": "<numero dell'attestato>",
-    "nome_partecipante": "<nome proprio del partecipante>",
-    "cognome_partecipante": "<cognome del partecipante>",
-    "codice_fiscale": "<codice fiscale>",
-    "data_fine_corso": "<data fine corso>",
-    "nome_corso": "<nome del corso>",
-    "codice_corso": "<codice corso>",
-    "dati_anagrafici": "<YES/NO>",
-    "tdi": "<YES/NO>",
-    "durata_corso": "<durata>",
-}}
+# schema dell'output strutturato (lo strict mode richiede un oggetto alla radice)
+CAMPI_ATTESTATO = [
+    "id", "nome_partecipante", "cognome_partecipante", "codice_fiscale", "data_fine_corso",
+    "nome_corso", "codice_corso", "dati_anagrafici", "tdi", "durata_corso",
+]
+CAMPI_RISPOSTA = list(CHIAVI_COMPATTE) if output_compatto else CAMPI_ATTESTATO
+SCHEMA_ATTESTATI = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "attestati",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "attestati": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {campo: {"type": "string"} for campo in CAMPI_RISPOSTA},
+                        "required": CAMPI_RISPOSTA,
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["attestati"],
+            "additionalProperties": False,
+        },
+    },
+}
 
-Queste sono le regole da seguire alla lettera per elaborare gli attestati:
-> Per ogni attestato nella richiesta, anche se duplicato, devi generare un JSON specifico nella riposta. Quindi se ricevi per esempio i testi di 10 attestati, dovrai SEMPRE ritornare 10 JSON associati.
-> Se un dato manca tra quelli da compilare nel JSON dell'attestato, scrivi 'ND'.
-> Analizza con attenzione tutti i dati prima di rispondere, la soglia di errore deve essere minima!
-Compilazione JSON:
-> Nel campo 'id' scrivi il numero dell'attestato ("<numero dell'attestato>" = "X" ricavato da "Attestato X - [nome_file]").
-> Nome e cognome del partecipante devono essere separati e scritti ciascuno nelle apposite voci del JSON dell'attestato. Quindi in nome_partecipante devi scrivere il nome proprio del partecipante mentre in cognome_partecipante il cognome.
-> Il codice fiscale deve essere alfanumerico di 16 caratteri (per esempio 'ZNLMTT94R21C618B' o 'ZNL MTT 94R21 C618B' ecc). Non accettare valori che non corrispondono ai formati.
-> Per compilare correttamente la voce data_fine_corso:
-    - La data_fine_corso, nel senso del periodo di effettivo svolgimento del corso, NON coincide necessariamente con la data di rilascio dell'attestato in coda al testo, che può essere successiva a quella di fine corso.
-    - La data_fine_corso può essere riportata anche con termini quali "data registrazione verbale" o simili. Non considerare invece date non pertinenti quali, per esempio, quella di nascita per questo campo.
-    - Conferma che la data_fine_corso sia in formato numerico gg/mm/aaaa, se è in un altro formato convertila.
-> Il nome_corso, cioè il nome del corso di formazione dell'attestato, deve essere completo come indicato nel testo estratto.
-> Per trovare il codice_corso:
-    - Usa il database iniziale dei corsi di formazione per confrontare il corso dell'attestato.
-    - Resta valida la forma [CODICE CORSO] --- [NOME CORSO] (alias) --- [DURATA MINIMA - DURATA MASSIMA] per l'estrapolazione del codice dal database.
-    - In codice_corso devi riportare il migliore match possibile tra i codici corso presenti nel database con l'attestato analizzato, in base alle informazioni in tuo possesso.
-    - La durata_corso DOVREBBE essere compresa tra la DURATA MINIMA e MASSIMA del corso selezionato nel database corsi.
-    - Per attestati che hanno lo stesso "nome_corso", associa lo stesso "codice_corso".
-    - In generale forza la scrittura del match migliore trovato, solo nel caso in cui non trovi nessun match soddisfacente riporta "ND".
-> In dati_anagrafici scrivi 'YES' se nel testo dell'attestato è presente ALMENO UNO dei seguenti dati sul partecipante:
-    - codice fiscale (alfanumerico di 16 caratteri, può contenere spazi e chiamato c.f. o simili)
-    - data di nascita (in qualsasi formato)
-    - luogo di nascita (nome di una città, provincia o stato)
-    Se NESSUNO di questi dati è presente, scrivi 'NO'.
-> In tdi scrivi 'YES' se nell'attestato è presente la dicitura 'tecnologie d'impresa' relativa all'erogatore del corso, altrimenti scrivi 'NO'.
-> Scrivi la durata_corso così come compare nell'attestato (in numero ore), se non è presente scrivi 'ND'.
-\n\n
-"""
-    
-    messaggi = [
+@functools.lru_cache(maxsize=None)
+def token_sistema():
+    """
+    Token riservati per il prompt di sistema (costante), calcolati al primo utilizzo.
+    Con la ricerca locale dei corsi il database è aggiunto per batch, solo con i corsi candidati.
+    """
+    if indice_corsi() is None:
+        return shared.token_calculation(prompt+prompt_db())
+    return shared.token_calculation(prompt+prompt_database([]))
+
+@functools.lru_cache(maxsize=None)
+def token_righe_corsi():
+    """
+    Token di ogni riga del database corsi (per il database ridotto di ogni batch).
+    """
+    return [shared.token_calculation(riga) for riga in righe_corsi()]
+
+def richiesta_openai(token_stimati, **parametri):
+    """
+    Esegue una chat completion rispettando i limiti RPM/TPM.
+    In caso di 429 o errori temporanei attende (retry-after o backoff esponenziale) e riprova.
+    """
+    from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+    for tentativo in range(MAX_TENTATIVI):
+        # ogni tentativo riserva i token nel secchio TPM; se fallisce vengono restituiti
+        rate_limiter.acquisisci(token_stimati)
+        try:
+            inizio = time.monotonic()
+            metriche.incrementa("llm_richieste")
+            raw = openai_client().chat.completions.with_raw_response.create(**parametri)
+            rate_limiter.aggiorna_da_header(raw.headers)
+            response = raw.parse()
+            # in streaming usage e tempi sono disponibili solo a fine lettura (risposta_in_streaming)
+            if parametri.get("stream"):
+                return response
+            statistiche.registra_velocita(response.usage.total_tokens, time.monotonic() - inizio)
+            # restituisce al secchio i token riservati ma non usati
+            rate_limiter.token.rimborsa(max(0, token_stimati - response.usage.total_tokens))
+            return response
+
+        except RateLimitError as e:
+            rate_limiter.token.rimborsa(token_stimati)
+            # quota esaurita: inutile riprovare
+            if getattr(e, "code", None) == "insufficient_quota":
+                raise
+            attesa = RateLimiter.attesa_retry(e.response.headers, tentativo)
+            rate_limiter.pausa(attesa)
+            metriche.incrementa("llm_retry_429")
+            print(f"\n{YELLOW}Limite di richieste raggiunto (429), nuovo tentativo tra {attesa:.1f} sec ({tentativo + 1}/{MAX_TENTATIVI}){RESET}")
+
+        except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+            rate_limiter.token.rimborsa(token_stimati)
+            attesa = RateLimiter.attesa_retry(None, tentativo)
+            metriche.incrementa("llm_retry_errori")
+            print(f"\n{YELLOW}Errore temporaneo OpenAI ({e}), nuovo tentativo tra {attesa:.1f} sec ({tentativo + 1}/{MAX_TENTATIVI}){RESET}")
+            time.sleep(attesa)
+
+        except Exception:
+            rate_limiter.token.rimborsa(token_stimati)
+            raise
+
+    raise TentativiEsauriti(f"Richiesta OpenAI fallita dopo {MAX_TENTATIVI} tentativi")
+
+def risposta_in_streaming(token_stimati, messaggi, al_json):
+    """
+    Richiede l'output strutturato in streaming e passa ad `al_json` ogni attestato appena completo.
+    Ritorna (usage, finish_reason); se lo stream si interrompe gli attestati già ricevuti restano consegnati.
+    """
+    inizio = time.monotonic()
+    stream = richiesta_openai(
+        token_stimati,
+        messages=messaggi,
+        model="gpt-4o",
+        max_tokens=MAX_OUTPUT_TOKENS,
+        temperature=0.0,
+        response_format=SCHEMA_ATTESTATI,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    parser = ParserIncrementale()
+    usage = None
+    finish_reason = None
+    for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+        for choice in chunk.choices:
+            if choice.delta and choice.delta.content:
+                for item in parser.aggiungi(choice.delta.content):
+                    al_json(item)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+
+    if usage is not None:
+        statistiche.registra_velocita(usage.total_tokens, time.monotonic() - inizio)
+        rate_limiter.token.rimborsa(max(0, token_stimati - usage.total_tokens))
+    return usage, finish_reason
+
+def campi_locali(testi_batch):
+    """
+    Campi ricavati con regole locali per ogni attestato del batch (vuoti con l'output esteso).
+    """
+    if not output_compatto:
+        return [{} for _ in testi_batch]
+    return [estrai_campi(testo) for _, testo in testi_batch]
+
+def nota_estratti(campi):
+    """
+    Nota in coda all'intestazione con le chiavi dei campi che il modello non deve generare.
+    """
+    chiavi = [chiave for chiave, campo in CHIAVI_COMPATTE.items() if campo in campi]
+    return f" [già estratti: {', '.join(chiavi)}]" if chiavi else ""
+
+def espandi_json(item, locali):
+    """
+    Riporta il JSON di un attestato ai nomi dei campi estesi e aggiunge i campi ricavati localmente.
+    - locali: campi locali degli attestati del batch (da campi_locali), nell'ordine degli id.
+    """
+    if not output_compatto:
+        return item
+    esteso = {CHIAVI_COMPATTE.get(chiave, chiave): valore for chiave, valore in item.items()}
+    try:
+        campi = locali[int(esteso["id"]) - 1]
+    except (KeyError, TypeError, ValueError, IndexError):
+        return esteso
+    esteso.update(campi)
+    for campo in CAMPI_ATTESTATO:
+        if not esteso.get(campo):
+            esteso[campo] = "ND"
+    return esteso
+
+def componi_messaggi(testi_batch, corsi=None, locali=None):
+    """
+    Costruisce i messaggi per OpenAI con un prefisso identico byte per byte tra le richieste
+    (istruzioni statiche + database completo), così da essere servito dalla prompt cache del provider.
+    Le parti variabili (database ridotto dei candidati, numero di attestati, testi) seguono il prefisso.
+    - locali: campi già ricavati localmente, indicati nell'intestazione di ogni attestato.
+    """
+    locali = locali or [{} for _ in testi_batch]
+    sistema = prompt + prompt_db() if corsi is None else prompt
+
+    variabile = ""
+    if corsi is not None:
+        variabile += prompt_database(corsi) + "\n"
+    variabile += f"N = {len(testi_batch)}: rispondi con ESATTAMENTE {len(testi_batch)} JSON.\n\n"
+
+    return [
         {
             "role": "system",
-            "content": prompt_db + prompt
+            "content": sistema
         },
         {
             "role": "user",
-            "content": "\n\n".join([f"Attestato {i+1} - {nome_file}\n{text}" for i, (nome_file, text) in enumerate(testi_batch)])
+            "content": variabile + "\n\n".join([f"Attestato {i+1} - {nome_file}{nota_estratti(campi)}\n{text}" for i, ((nome_file, text), campi) in enumerate(zip(testi_batch, locali))])
         }
     ]
 
+# chiamata a openai API
+def openai_call(testi_batch, mostra_progresso=True, corsi=None, token_attestati=None, al_json=None):
+    """
+    Analizza un batch di (nome_file, testo) con OpenAI.
+    - corsi: indici dei corsi da includere nel prompt (None per il database completo).
+    - token_attestati: token già calcolati dei testi con intestazione (None per ricalcolarli).
+    - al_json: callback chiamata per ogni JSON di attestato appena disponibile.
+    """
+    prompt_corsi = prompt_db() if corsi is None else prompt_database(corsi)
+
+    # flag per fermare il caricamento
+    stop_loading = threading.Event()
+    # avvia la barra di caricamento in un thread separato (disattivata con più batch in volo)
+    progress_thread = threading.Thread(target=progress_bar, args=(shared.stima_durata(testi_batch, prompt_corsi, token_attestati), stop_loading))
+    if mostra_progresso:
+        progress_thread.start()
+    
+    
+    locali = campi_locali(testi_batch)
+    messaggi = componi_messaggi(testi_batch, corsi, locali)
+
+    # token riservati nel budget TPM: input stimato + massimo output richiesto
+    token_input, _ = shared.stima_token(testi_batch, prompt_corsi, token_attestati)
+
+    analisi = []
+    def ricevi(item):
+        item = espandi_json(item, locali)
+        analisi.append(item)
+        if al_json:
+            al_json(item)
+
+    inizio = time.monotonic()
     try:
 
-        response = client.chat.completions.create(
-            messages=messaggi,
-            model="gpt-4o",
-            # max_tokens troppo piccolo causa il troncamento dell'output
-            # max_tokens troppo grande causa errore 400 (max_tokens is too large)
-            max_tokens= MAX_OUTPUT_TOKENS,
-            temperature=0.0,
-        )
+        if STREAMING_STRUTTURATO:
+            usage, finish_reason = risposta_in_streaming(token_input + MAX_OUTPUT_TOKENS, messaggi, ricevi)
+        else:
+            response = richiesta_openai(
+                token_input + MAX_OUTPUT_TOKENS,
+                messages=messaggi,
+                model="gpt-4o",
+                # max_tokens troppo piccolo causa il troncamento dell'output
+                # max_tokens troppo grande causa errore 400 (max_tokens is too large)
+                max_tokens= MAX_OUTPUT_TOKENS,
+                temperature=0.0,
+            )
+            usage, finish_reason = response.usage, response.choices[0].finish_reason
+
+        durata = time.monotonic() - inizio
+        metriche.osserva("llm_batch_secondi", durata)
+        metriche.osserva("llm_attestati_per_batch", len(testi_batch))
 
         # aggiorna i token utilizzati
-        shared.token(response)
+        if usage is not None:
+            shared.token(usage)
+            metriche.incrementa("llm_token_input", usage.prompt_tokens)
+            metriche.incrementa("llm_token_output", usage.completion_tokens)
+            if durata > 0:
+                metriche.osserva("llm_token_output_al_secondo", usage.completion_tokens / durata)
+            # token di output per attestato (le risposte troncate sottostimerebbero)
+            if finish_reason != "length":
+                statistiche.registra_output(usage.completion_tokens, len(testi_batch))
 
         # ferma la barra di caricamento
         stop_loading.set()
-        progress_thread.join()
+        if mostra_progresso:
+            progress_thread.join()
 
         # DEBUG
         # print(json.dumps(response.to_dict(), indent=4))
         # print(response.choices[0].message.content)
         # prompt_completo = messaggi[0]["content"] + messaggi[1]["content"]
         # print(prompt_completo)
-        # print(shared.token_calculation(prompt_db))
+        # print(shared.token_calculation(prompt_db()))
 
-        analisi = json.loads(Formatter.pulisci_output(response.choices[0].message.content))
+        if finish_reason == "length":
+            # output troncato: si tengono solo i JSON completi, i mancanti vengono reinviati
+            print(f"\n{YELLOW}Attenzione: risposta troncata a {MAX_OUTPUT_TOKENS} token di output{RESET}")
+            metriche.incrementa("llm_risposte_troncate")
+
+        if not STREAMING_STRUTTURATO:
+            contenuto = response.choices[0].message.content
+            try:
+                if finish_reason == "length":
+                    raise ValueError("output troncato")
+                items = json.loads(Formatter.pulisci_output(contenuto))
+            except ValueError:
+                items = Formatter.estrai_json_parziali(contenuto)
+            for item in items:
+                ricevi(item)
         
         # DEBUG JSON
         if len(analisi) != len(testi_batch):
@@ -188,57 +450,212 @@ Compilazione JSON:
 
     except Exception as e:
         stop_loading.set()
-        progress_thread.join()
+        if mostra_progresso:
+            progress_thread.join()
+        metriche.incrementa("llm_batch_errore")
 
         error_message = str(e)
         print(f"\n{RED}{BOLD}Errore nell'elaborazione con OpenAI:{RESET} {e}")
 
-        # errori di limits
-        if "rate_limit_exceeded" in error_message or "429" in error_message:
-            sys.exit(1)
-        if "max_tokens" in error_message or "400" in error_message:
-            sys.exit(1)
-        return []
+        # richiesta non riuscita (tentativi esauriti o stream interrotto): gli attestati già ricevuti
+        # restano consegnati tramite al_json, analizza_batch decide come reinviare gli altri
+        if isinstance(e, TentativiEsauriti):
+            raise
+        from openai import APIConnectionError, APITimeoutError, InternalServerError
+        from httpx import TransportError
+        if isinstance(e, (APIConnectionError, APITimeoutError, InternalServerError, TransportError)):
+            raise ErroreTrasporto(error_message) from e
+        # errori non recuperabili (i 429 sono già stati ritentati da richiesta_openai): sollevati
+        # come eccezione, non con sys.exit, perché la chiamata gira in un thread di dispatch_batch
+        if "insufficient_quota" in error_message or "max_tokens" in error_message or "400" in error_message:
+            raise ErroreNonRecuperabile(error_message) from e
+        # gli attestati già ricevuti prima dell'errore restano validi
+        return analisi
 
 
 
 
-def crea_batch(testi_estratti):
+def analizza_batch(testi_batch, mostra_progresso=True, corsi=None, token_attestati=None, livello=0, al_json=None):
     """
-    Crea batch rispettando il limite totale di token per richiesta (input e output).
-    - testi_estratti: Lista di dizionari con `nome_file`, `testo` e `token`.
+    Analizza un batch e reinvia solo gli attestati senza JSON valido (id mancanti o risposta troncata).
+    Se la risposta di un (sotto)batch non contiene nessun JSON valido il batch viene diviso a metà;
+    dopo un errore di rete viene reinviato intero, dopo i tentativi esauriti non viene reinviato.
+    Dopo MAX_REINVII livelli i mancanti restano senza JSON (placeholder in allinea_json).
+    - al_json: callback chiamata una sola volta per ogni JSON valido, appena ricevuto.
+    Ritorna la lista dei JSON con `id` riferiti alla posizione nel batch originale.
+    """
+    risultati = {}
+
+    def ricevi(item):
+        try:
+            id_attestato = int(item["id"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if 1 <= id_attestato <= len(testi_batch) and id_attestato not in risultati:
+            risultati[id_attestato] = item
+            if al_json:
+                al_json(item)
+
+    trasporto = False
+    try:
+        for item in openai_call(testi_batch, mostra_progresso, corsi, token_attestati, ricevi):
+            ricevi(item)
+    except TentativiEsauriti:
+        # già ritentata con backoff: un altro invio fallirebbe allo stesso modo, i mancanti restano senza JSON
+        metriche.incrementa("llm_batch_abbandonati")
+        return [risultati[i] for i in sorted(risultati)]
+    except ErroreTrasporto:
+        trasporto = True
+
+    mancanti = [i for i in range(1, len(testi_batch) + 1) if i not in risultati]
+    if not mancanti or livello >= MAX_REINVII:
+        return [risultati[i] for i in sorted(risultati)]
+
+    # risposta senza nessun JSON valido (es. troncata subito): bisezione; altrimenti, e dopo un errore
+    # di rete, un unico sotto-batch con i soli mancanti
+    if len(mancanti) == len(testi_batch) and len(mancanti) > 1 and not trasporto:
+        meta = len(mancanti) // 2
+        gruppi = [mancanti[:meta], mancanti[meta:]]
+    else:
+        gruppi = [mancanti]
+
+    for gruppo in gruppi:
+        metriche.incrementa("llm_reinvii")
+        metriche.incrementa("llm_attestati_reinviati", len(gruppo))
+        print(f"\n{YELLOW}Reinvio di {len(gruppo)} attestati senza risposta valida (livello {livello + 1}/{MAX_REINVII}){RESET}")
+        sotto_batch = [testi_batch[i - 1] for i in gruppo]
+        # riporta l'id alla posizione nel batch originale
+        riporta = lambda item, gruppo=gruppo: ricevi({**item, "id": str(gruppo[int(item["id"]) - 1])})
+        for item in analizza_batch(sotto_batch, mostra_progresso, corsi, None, livello + 1, riporta):
+            riporta(item)
+
+    return [risultati[i] for i in sorted(risultati)]
+
+
+def dispatch_batch(batches, max_in_volo=MAX_RICHIESTE_IN_VOLO, al_json=None):
+    """
+    Invia i batch a OpenAI tenendone fino a `max_in_volo` in parallelo.
+    Generatore che restituisce (numero_batch, batch, analisi) nell'ordine di completamento.
+    - al_json: callback (batch, json) chiamata dai thread di invio per ogni attestato appena analizzato.
+    Con un budget (BUDGET_EURO) non vengono inviati batch oltre la spesa prevista.
+    I batch vengono letti da `batches` solo quando c'è un posto libero, così il flusso resta limitato.
+    Dopo un ErroreNonRecuperabile non partono altri batch: quelli in volo vengono attesi e restituiti,
+    poi l'errore viene risollevato.
+    """
+    mostra_progresso = max_in_volo == 1
+    in_volo = {}
+    batches = iter(batches)
+    numero_batch = 0
+    errore = None
+
+    with ThreadPoolExecutor(max_workers=max_in_volo) as executor:
+        while True:
+            # riempie i posti liberi (finché la spesa prevista resta entro il budget)
+            while errore is None and len(in_volo) < max_in_volo and not limite_spesa.superato:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                if limite_spesa.attivo() and not limite_spesa.prenota(numero_batch + 1, shared.stima_prezzo(*stima_batch(batch))):
+                    break
+                numero_batch += 1
+                print(f"{BOLD}Inviato Batch {numero_batch} con {len(batch)} attestati{RESET}")
+                future = executor.submit(
+                    analizza_batch,
+                    [(t["nome_file"], t["testo"]) for t in batch],
+                    mostra_progresso,
+                    corsi_batch(batch),
+                    sum(t["token_batch"] for t in batch),
+                    0,
+                    (lambda item, batch=batch: al_json(batch, item)) if al_json else None,
+                )
+                in_volo[future] = (numero_batch, batch)
+
+            if not in_volo:
+                break
+
+            completati, _ = wait(in_volo, return_when=FIRST_COMPLETED)
+            for future in completati:
+                numero, batch = in_volo.pop(future)
+                limite_spesa.rilascia(numero)
+                try:
+                    analisi = future.result()
+                except ErroreNonRecuperabile as e:
+                    if errore is None:
+                        print(f"{RED}{BOLD}Errore non recuperabile: nessun nuovo batch verrà inviato{RESET}")
+                    errore = errore or e
+                    continue
+                yield numero, batch, analisi
+
+    if errore is not None:
+        raise errore
+
+
+def corsi_batch(batch):
+    """
+    Unione dei corsi candidati degli attestati del batch, None se la ricerca locale è disattivata.
+    """
+    if indice_corsi() is None:
+        return None
+    return sorted(set().union(*(t["corsi"] for t in batch)))
+
+
+def stima_batch(batch):
+    """
+    Token di input e di output stimati per un batch di crea_batch (prima dell'invio).
+    """
+    corsi = corsi_batch(batch)
+    return shared.stima_token(
+        [(t["nome_file"], t["testo"]) for t in batch],
+        prompt_db() if corsi is None else prompt_database(corsi),
+        sum(t["token_batch"] for t in batch),
+    )
+
+
+def token_intestazione(nome_file):
+    """
+    Token dell'intestazione "Attestato X - nome_file" e del separatore tra attestati
+    (X a 3 cifre e nota dei campi già estratti: caso peggiore).
     """
+    nota = nota_estratti({"codice_fiscale": "", "durata_corso": ""}) if output_compatto else ""
+    return shared.token_calculation(f"Attestato 999 - {nome_file}{nota}\n\n\n")
 
-    max_input_tokens = int((MAX_TOTAL_TOKENS - MAX_OUTPUT_TOKENS - SYSTEM_PROMPT) * (1 - BATCH_SAFETY_MARGIN))
+
+def limiti_batch():
+    """
+    Token massimi di input (attestati con intestazione) e di output per batch, margine di sicurezza incluso.
+    """
+    max_input_tokens = int((MAX_TOTAL_TOKENS - MAX_OUTPUT_TOKENS - token_sistema() - TOKEN_PREFISSO_BATCH) * (1 - BATCH_SAFETY_MARGIN))
     max_output_tokens = int(MAX_OUTPUT_TOKENS * (1 - BATCH_SAFETY_MARGIN))
+    return max_input_tokens, max_output_tokens
+
+
+def crea_batch(testi_estratti, finestra=FINESTRA_BATCH):
+    """
+    Crea batch rispettando il limite totale di token per richiesta (input e output).
+    - testi_estratti: Iterabile di dizionari con `nome_file`, `testo` e `token`.
+    - finestra: numero di batch da accumulare prima di impacchettarli insieme.
+    Gli attestati arrivano in streaming: quando la finestra è piena viene impacchettata con
+    first fit decreasing, i batch chiusi vengono inviati subito e il meno pieno resta aperto per i successivi
+    (impacchetta_flusso). Con la ricerca locale attiva, ogni attestato riceve i suoi corsi candidati (`corsi`)
+    e nel limite di input si conta anche il database ridotto del batch.
+    """
+
+    # token di output per attestato appresi dalle esecuzioni precedenti (percentile alto)
+    token_output_per_pdf = statistiche.token_output_per_pdf(TOKEN_OUTPUT_PER_PDF)
+    max_input_tokens, max_output_tokens = limiti_batch()
+    ricerca_locale = indice_corsi() is not None
+    token_righe = token_righe_corsi() if ricerca_locale else None
+
+    def con_conteggi():
+        for testo in testi_estratti:
+            # conteggi per attestato calcolati una sola volta
+            testo["token_batch"] = testo["token"] + token_intestazione(testo["nome_file"])
+            testo["token_output"] = token_output_per_pdf
+            if ricerca_locale:
+                testo["corsi"] = candidati_corsi(testo["testo"])
+            yield testo
 
-    batch_corrente = []
-    token_corrente_input = 0
-
-    for testo in testi_estratti:
-        token_testo = testo["token"]
-        token_output_stimati = TOKEN_OUTPUT_PER_PDF * (len(batch_corrente) + 1)
-
-        # controlla se il batch supera i limiti di input o output
-        if token_corrente_input + token_testo > max_input_tokens or token_output_stimati > max_output_tokens:
-            # debug limite raggiunto
-            # if token_corrente_input + token_testo > max_input_tokens:
-            #    print(f"Limite di input raggiunto: {token_corrente_input + token_testo}/{max_input_tokens}")
-            # if token_output_stimati > max_output_tokens:
-            #    print(f"Limite di output raggiunto: {token_output_stimati}/{max_output_tokens}")
-            
-            # aggiorna lunghezza del batch
-            shared.current_batch_size = len(batch_corrente)
-            
-            yield batch_corrente
-            batch_corrente = []
-            token_corrente_input = 0
-
-        # aggiungi il testo al batch
-        batch_corrente.append(testo)
-        token_corrente_input += token_testo
-
-    # ritorna l'ultimo batch, se esiste
-    if batch_corrente:
-        shared.current_batch_size = len(batch_corrente)
-        yield batch_corrente
\ No newline at end of file
+    for batch in impacchetta_flusso(con_conteggi(), max_input_tokens, max_output_tokens, token_righe, finestra):
+        # aggiorna lunghezza del batch
+        shared.current_batch_size = len(batch)
+        yield batch
@@ -0,0 +1,125 @@
+# ----- Controllo dei limiti di richieste e token al minuto (RPM / TPM) -----
+import re
+import time
+import random
+import threading
+
+
+class TokenBucket:
+    """
+    Secchio di gettoni che si ricarica in modo continuo fino alla capacità in un periodo (default 60s).
+    Una richiesta più grande della capacità viene accettata a secchio pieno e lo porta in negativo.
+    """
+    def __init__(self, capacita, periodo=60.0):
+        self.capacita = capacita
+        self.periodo = periodo
+        self.livello = capacita
+        self.ultimo = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _ricarica(self):
+        adesso = time.monotonic()
+        self.livello = min(self.capacita, self.livello + (adesso - self.ultimo) * self.capacita / self.periodo)
+        self.ultimo = adesso
+
+    def acquisisci(self, quantita):
+        """
+        Blocca finché non sono disponibili `quantita` gettoni, poi li consuma.
+        """
+        with self._cond:
+            while True:
+                self._ricarica()
+                necessari = min(quantita, self.capacita)
+                if self.livello >= necessari:
+                    self.livello -= quantita
+                    return
+                self._cond.wait((necessari - self.livello) * self.periodo / self.capacita)
+
+    def rimborsa(self, quantita):
+        """
+        Restituisce gettoni stimati in eccesso (es. output reale minore di quello riservato).
+        """
+        with self._cond:
+            self._ricarica()
+            self.livello = min(self.capacita, self.livello + quantita)
+            self._cond.notify_all()
+
+    def sincronizza(self, limite=None, rimanenti=None):
+        """
+        Allinea il secchio ai valori comunicati dal server (header x-ratelimit-*).
+        """
+        with self._cond:
+            self._ricarica()
+            if limite:
+                self.capacita = limite
+            if rimanenti is not None:
+                self.livello = min(self.livello, rimanenti)
+
+
+def durata_header(valore):
+    """
+    Converte le durate degli header OpenAI (es. '1s', '6m0s', '20ms') in secondi.
+    """
+    if not valore:
+        return None
+    try:
+        return float(valore)
+    except ValueError:
+        pass
+    unita = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parti = re.findall(r"([\d.]+)(ms|h|m|s)", valore)
+    if not parti:
+        return None
+    return sum(float(numero) * unita[u] for numero, u in parti)
+
+
+class RateLimiter:
+    """
+    Limita richieste e token al minuto per tutte le chiamate in volo verso OpenAI.
+    I limiti iniziali sono quelli configurati, poi vengono corretti dagli header delle risposte.
+    """
+    def __init__(self, rpm, tpm):
+        self.richieste = TokenBucket(rpm)
+        self.token = TokenBucket(tpm)
+        self._pausa_fino = 0.0
+        self._lock = threading.Lock()
+
+    def acquisisci(self, token_stimati):
+        # pausa globale dopo un 429: nessuna nuova richiesta parte prima della scadenza
+        while True:
+            with self._lock:
+                attesa = self._pausa_fino - time.monotonic()
+            if attesa <= 0:
+                break
+            time.sleep(attesa)
+        self.richieste.acquisisci(1)
+        self.token.acquisisci(token_stimati)
+
+    def pausa(self, secondi):
+        with self._lock:
+            self._pausa_fino = max(self._pausa_fino, time.monotonic() + secondi)
+
+    def aggiorna_da_header(self, headers):
+        def intero(nome):
+            try:
+                return int(headers.get(nome))
+            except (TypeError, ValueError):
+                return None
+
+        self.richieste.sincronizza(intero("x-ratelimit-limit-requests"), intero("x-ratelimit-remaining-requests"))
+        self.token.sincronizza(intero("x-ratelimit-limit-tokens"), intero("x-ratelimit-remaining-tokens"))
+
+    @staticmethod
+    def attesa_retry(headers, tentativo, base=2.0, massimo=60.0):
+        """
+        Secondi da attendere prima di riprovare: usa retry-after / x-ratelimit-reset-* se presenti,
+        altrimenti backoff esponenziale con jitter.
+        """
+        if headers is not None:
+            for nome in ("retry-after-ms", "retry-after", "x-ratelimit-reset-tokens", "x-ratelimit-reset-requests"):
+                valore = headers.get(nome)
+                if valore:
+                    secondi = float(valore) / 1000 if nome == "retry-after-ms" else durata_header(valore)
+                    if secondi is not None:
+                        return min(secondi + random.uniform(0, 0.5), massimo)
+        return min(base * (2 ** tentativo), massimo) * random.uniform(0.5, 1.0)
@@ -0,0 +1,105 @@
+# ----- Statistiche osservate sulle risposte OpenAI, salvate tra un'esecuzione e l'altra -----
+import os
+import json
+import socket
+import threading
+from utils.style import *
+from utils.config import statistiche_path, output_compatto
+
+# campioni conservati per ogni misura
+MAX_CAMPIONI = 500
+# campioni minimi prima di sostituire le stime di default
+MIN_CAMPIONI = 5
+# percentile usato per dimensionare i batch (stima prudente dei token di output)
+PERCENTILE_OUTPUT = 90
+# formato dell'output: i token per attestato di un formato non valgono per l'altro
+FORMATO_OUTPUT = "compatto" if output_compatto else "esteso"
+
+
+def percentile(valori, p):
+    """
+    Percentile con interpolazione lineare (valori non vuoti).
+    """
+    ordinati = sorted(valori)
+    posizione = (len(ordinati) - 1) * p / 100
+    inferiore = int(posizione)
+    superiore = min(inferiore + 1, len(ordinati) - 1)
+    return ordinati[inferiore] + (ordinati[superiore] - ordinati[inferiore]) * (posizione - inferiore)
+
+
+class Statistiche:
+    """
+    Registra token di output per attestato e token al secondo di ogni risposta
+    e li usa per stimare dimensione dei batch e durata delle richieste nelle esecuzioni successive.
+    """
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self._lock = threading.Lock()
+        self.output_per_attestato = []
+        self.token_al_secondo = []
+        try:
+            with open(percorso, "r", encoding="utf-8") as f:
+                dati = json.load(f)
+            if dati.get("formato_output", "esteso") == FORMATO_OUTPUT:
+                self.output_per_attestato = dati.get("output_per_attestato", [])
+            self.token_al_secondo = dati.get("token_al_secondo", [])
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _aggiungi(campioni, valore):
+        campioni.append(valore)
+        del campioni[:-MAX_CAMPIONI]
+
+    def registra_output(self, token_output, numero_attestati):
+        if numero_attestati > 0 and token_output > 0:
+            with self._lock:
+                self._aggiungi(self.output_per_attestato, token_output / numero_attestati)
+
+    def registra_velocita(self, token, secondi):
+        if secondi > 0 and token > 0:
+            with self._lock:
+                self._aggiungi(self.token_al_secondo, token / secondi)
+
+    def token_output_per_pdf(self, default):
+        """
+        Token di output per attestato al percentile PERCENTILE_OUTPUT, `default` se i campioni sono pochi.
+        """
+        with self._lock:
+            if len(self.output_per_attestato) < MIN_CAMPIONI:
+                return default
+            return int(round(percentile(self.output_per_attestato, PERCENTILE_OUTPUT)))
+
+    def token_rate(self, default):
+        """
+        Token elaborati al secondo (mediana), `default` se i campioni sono pochi.
+        """
+        with self._lock:
+            if len(self.token_al_secondo) < MIN_CAMPIONI:
+                return default
+            return percentile(self.token_al_secondo, 50)
+
+    def salva(self):
+        """
+        Salva le statistiche su disco in modo atomico.
+        """
+        with self._lock:
+            dati = {
+                "formato_output": FORMATO_OUTPUT,
+                "output_per_attestato": self.output_per_attestato,
+                "token_al_secondo": self.token_al_secondo,
+            }
+        try:
+            cartella = os.path.dirname(self.percorso)
+            if cartella:
+                os.makedirs(cartella, exist_ok=True)
+            # nome temporaneo unico: più worker (anche su macchine diverse) possono condividere la cartella
+            tmp = f"{self.percorso}.{socket.gethostname()}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(dati, f)
+            os.replace(tmp, self.percorso)
+        except OSError as e:
+            print(f"{YELLOW}Impossibile salvare le statistiche: {e}{RESET}")
+
+
+statistiche = Statistiche(statistiche_path)
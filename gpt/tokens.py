@@ -1,34 +1,93 @@
 # ----- Valutazione MASSIMA in euro per richiesta OpenAI API -----
 import os
+import json
+import socket
 import math
-import requests
-import tiktoken
+import time
+import functools
+import queue
+import threading
+from collections import Counter
 from tqdm import tqdm  # progress bar
 from utils.style import *
 from utils.match_corsi import prompt_db
-from OCR.text_extraction import estrai_google_vision
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from OCR.text_extraction import estrai_testo, anteprima_testo, OCR_DPI, OCR_MODE
+from OCR.cache import ocr_cache
+from gpt.statistiche import statistiche
+from utils.journal import journal, FASE_OCR
+from utils.metriche import metriche
+from utils.config import cambio_path, cambio_ttl_ore, output_compatto
+from concurrent.futures import ThreadPoolExecutor
 
 # prezzi in dollari per 1k tokens gpt-4o (da https://openai.com/api/pricing/)
 PRICE_API_INPUT = 0.00250
+PRICE_API_INPUT_CACHED = 0.00125
+# la Batch API (modalità bulk) costa la metà
+PRICE_BULK_FACTOR = 0.5
 PRICE_API_OUTPUT = 0.01000
+# prezzo in dollari per pagina di Google Vision (text detection, oltre le prime 1000 unità al mese)
+PRICE_VISION_PAGINA = 0.0015
 
 # numero di token di output stimato per attestato (dipende dall'attestato)
-TOKEN_OUTPUT_PER_PDF = 170
-# numero di token processati per secondo (stima)
+# default finché gpt/statistiche.py non ha abbastanza campioni dalle esecuzioni precedenti
+# (con l'output compatto il modello genera chiavi brevi e meno campi)
+TOKEN_OUTPUT_PER_PDF = 90 if output_compatto else 170
+# numero di token processati per secondo (stima, sostituita dalla mediana osservata)
 TOKEN_OUTPUT_RATE = 250
 
+# stime senza OCR (comando stima): token di una pagina non ancora letta da Vision
+# e secondi per pagina tra conversione e Vision con un solo thread
+TOKEN_PAGINA_OCR = 450
+SECONDI_PAGINA_OCR = 1.5
+
+# thread per l'elaborazione dei PDF
+OCR_THREADS = min(32, (os.cpu_count() or 1) + 4)
+# numero massimo di testi estratti in attesa di essere inviati a OpenAI (memoria limitata)
+OCR_CODA_MAX = 100
+
+# tasso EUR-USD usato senza rete e senza una copia su disco
+EUR_USD_DEFAULT = 1.08
+
+
+@functools.lru_cache(maxsize=None)
+def encoder(model):
+    """
+    Encoder tiktoken del modello, creato una sola volta.
+    """
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+@functools.lru_cache(maxsize=16)
+def token_prompt(testo_prompt, model="gpt-4o"):
+    """
+    Token di un prompt ricorrente (istruzioni + database corsi), calcolati una sola volta.
+    """
+    return SharedState.token_calculation(testo_prompt, model)
+
 
 class SharedState:
     def __init__(self):
         self.token_totali = 0
         self.token_totali_input = 0
         self.token_totali_output = 0
+        # token di input serviti dalla prompt cache di OpenAI (inclusi in token_totali_input)
+        self.token_totali_input_cached = 0
+        # token elaborati con la Batch API (inclusi nei totali, prezzati con PRICE_BULK_FACTOR)
+        self.token_bulk_input = 0
+        self.token_bulk_output = 0
+        self._lock_token = threading.Lock()
         # dimensione batch da scrivere nella chiamata API (per bug numero JSON prodotti)
         self.current_batch_size = 0
         
+        # metodo di estrazione usato per i file (nativo / ocr / misto)
+        self.metodi_estrazione = Counter()
+        # file saltati perché già completati in un'esecuzione precedente
+        self.file_saltati = 0
+        self._lock_metodi = threading.Lock()
+
         # tasso di cambio
         self._cached_rate = None
+        self._lock_cambio = threading.Lock()
         
     @staticmethod
     def token_calculation(testo, model="gpt-4o"):
@@ -37,74 +96,205 @@ class SharedState:
         Modello di default: gpt-4o.
         """
         try:
-            encoding = tiktoken.encoding_for_model(model)
-            tokens = encoding.encode(testo)
+            tokens = encoder(model).encode(testo)
             return len(tokens)
         except Exception as e:
             print(f"Errore nel calcolo dei token: {e}")
             return 0
         
     # calcolo token
-    def token(self, response):
-        usage = response.usage
-        self.token_totali += usage.total_tokens
-        self.token_totali_input += usage.prompt_tokens
-        self.token_totali_output += usage.completion_tokens
+    def token(self, usage, bulk=False):
+        # più batch possono essere in volo contemporaneamente
+        with self._lock_token:
+            if bulk:
+                self.token_bulk_input += usage.prompt_tokens
+                self.token_bulk_output += usage.completion_tokens
+            self.token_totali += usage.total_tokens
+            self.token_totali_input += usage.prompt_tokens
+            self.token_totali_output += usage.completion_tokens
+            dettagli = getattr(usage, "prompt_tokens_details", None)
+            self.token_totali_input_cached += (getattr(dettagli, "cached_tokens", 0) or 0) if dettagli else 0
 
     def price_input(self):
-        return ((self.token_totali_input / 1000) * PRICE_API_INPUT) / self.get_eur_to_usd_rate()
+        token_non_cached = self.token_totali_input - self.token_totali_input_cached
+        return ((token_non_cached / 1000) * PRICE_API_INPUT) / self.get_eur_to_usd_rate()
+    def price_input_cached(self):
+        return ((self.token_totali_input_cached / 1000) * PRICE_API_INPUT_CACHED) / self.get_eur_to_usd_rate()
     def price_output(self):
         return ((self.token_totali_output / 1000) * PRICE_API_OUTPUT) / self.get_eur_to_usd_rate()
+    def sconto_bulk(self):
+        token_pieno = (self.token_bulk_input / 1000) * PRICE_API_INPUT + (self.token_bulk_output / 1000) * PRICE_API_OUTPUT
+        return -(token_pieno * (1 - PRICE_BULK_FACTOR)) / self.get_eur_to_usd_rate()
     def price(self):
-        return round(self.price_input() + self.price_output(), 3)
+        return round(self.price_input() + self.price_input_cached() + self.price_output() + self.sconto_bulk(), 3)
+    def stima_prezzo(self, token_input, token_output, bulk=False):
+        """
+        Costo in euro di token non ancora consumati (senza prompt cache, stima prudente).
+        """
+        dollari = (token_input / 1000) * PRICE_API_INPUT + (token_output / 1000) * PRICE_API_OUTPUT
+        if bulk:
+            dollari *= PRICE_BULK_FACTOR
+        return round(dollari / self.get_eur_to_usd_rate(), 3)
+
+    def stima_prezzo_vision(self, pagine):
+        """
+        Costo in euro delle pagine ancora da passare a Google Vision.
+        """
+        return round(pagine * PRICE_VISION_PAGINA / self.get_eur_to_usd_rate(), 3)
+
+    def documento_stimato(self, pdf_folder, pdf_filename):
+        """
+        Dizionario dell'attestato per le stime, senza Vision né OpenAI: dalla cache OCR se disponibile,
+        altrimenti dal testo nativo con TOKEN_PAGINA_OCR token per ogni pagina che andrebbe all'OCR.
+        `pagine_ocr` indica le pagine ancora da inviare a Vision.
+        """
+        documento = self.documento_in_cache(pdf_folder, pdf_filename)
+        if documento is not None:
+            documento["pagine_ocr"] = 0
+            return documento
+        pdf_path = os.path.join(pdf_folder, pdf_filename)
+        testo, pagine_ocr = anteprima_testo(pdf_path)
+        return {
+            "nome_file": pdf_filename,
+            "testo": testo,
+            "token": (self.token_calculation(testo) if testo else 0) + pagine_ocr * TOKEN_PAGINA_OCR,
+            "hash": ocr_cache.hash_file(pdf_path),
+            "metodo": "stima",
+            "pagine_ocr": pagine_ocr,
+        }
+
+    def documento_in_cache(self, pdf_folder, pdf_filename):
+        """
+        Dizionario dell'attestato ricostruito dalla sola cache OCR (nessuna estrazione), None se assente.
+        """
+        pdf_path = os.path.join(pdf_folder, pdf_filename)
+        hash_pdf = ocr_cache.hash_file(pdf_path)
+        cached = ocr_cache.leggi(ocr_cache.chiave(hash_pdf, OCR_DPI, OCR_MODE))
+        if cached is None:
+            return None
+        return {
+            "nome_file": pdf_filename,
+            "testo": cached["testo"],
+            "token": cached["token"],
+            "hash": hash_pdf,
+            "metodo": cached.get("metodo", "ocr"),
+        }
     
+    def elabora_pdf(self, pdf_folder, pdf_filename):
+        """
+        Estrae il testo di un singolo PDF (da cache OCR se disponibile) e ne calcola i token.
+        Ritorna un dizionario con nome del file, testo e numero di token, None in caso di errore.
+        """
+        pdf_path = os.path.join(pdf_folder, pdf_filename)
+
+        # cache OCR: i file invariati non vengono riconvertiti né rianalizzati da Vision
+        hash_pdf = ocr_cache.hash_file(pdf_path)
+
+        # journal: file già scritto nell'Excel in un'esecuzione precedente
+        if journal.completato({"nome_file": pdf_filename, "hash": hash_pdf}):
+            with self._lock_metodi:
+                self.file_saltati += 1
+            return None
+
+        chiave = ocr_cache.chiave(hash_pdf, OCR_DPI, OCR_MODE)
+        cached = ocr_cache.leggi(chiave)
+        if cached is not None:
+            testo, num_token, metodo = cached["testo"], cached["token"], cached.get("metodo", "ocr")
+        else:
+            with metriche.cronometro("estrazione_file_secondi"):
+                testo, metodo = estrai_testo(pdf_path)
+            if not testo or testo == "Errore":
+                metriche.incrementa("file_errore")
+                return None
+            with metriche.cronometro("tokenizzazione_secondi"):
+                num_token = self.token_calculation(testo)
+            ocr_cache.scrivi(chiave, {"testo": testo, "token": num_token, "metodo": metodo})
+
+        with self._lock_metodi:
+            self.metodi_estrazione[metodo] += 1
+        documento = {
+            "nome_file": pdf_filename,
+            "testo": testo,
+            "token": num_token,
+            "hash": hash_pdf,
+            "metodo": metodo
+        }
+        journal.registra(documento, FASE_OCR)
+        return documento
+
+    def flusso_pdf(self, pdf_folder, dimensione_coda=OCR_CODA_MAX, escludi=(), pdf_files=None):
+        """
+        Riceve una cartella con PDF (esclusi i nomi file in `escludi`);
+        con `pdf_files` vengono elaborati solo i file indicati (es. quelli appena arrivati).
+        Generatore che restituisce i dizionari degli attestati man mano che l'OCR termina
+        (ordine di completamento, non quello della cartella).
+        La coda è limitata: l'OCR si ferma quando ci sono `dimensione_coda` testi non ancora consumati,
+        così la memoria resta limitata e OCR e chiamate API procedono in parallelo.
+        """
+        if pdf_files is None:
+            pdf_files = os.listdir(pdf_folder)
+        pdf_files = [f for f in pdf_files if f.lower().endswith(".pdf") and f not in escludi]
+        self.file_saltati += sum(1 for f in escludi if f.lower().endswith(".pdf") and os.path.exists(os.path.join(pdf_folder, f)))
+        # i thread attendono soprattutto Vision: la conversione delle pagine è nel pool di processi
+        max_workers = OCR_THREADS
+
+        coda = queue.Queue()
+        posti = threading.Semaphore(max_workers + dimensione_coda)
+        stop = threading.Event()
+        FINE = object()
+
+        def produttore():
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for pdf in pdf_files:
+                    posti.acquire()
+                    if stop.is_set():
+                        break
+                    future = executor.submit(self.elabora_pdf, pdf_folder, pdf)
+                    future.add_done_callback(coda.put)
+            coda.put(FINE)
+
+        thread = threading.Thread(target=produttore, daemon=True)
+        thread.start()
+
+        try:
+            with tqdm(total=len(pdf_files), desc=f"{BOLD}{GREEN}Elaborazione OCR{RESET} ({max_workers} threads)") as pbar:
+                while True:
+                    future = coda.get()
+                    if future is FINE:
+                        break
+                    posti.release()
+                    pbar.update(1)
+                    risultato = future.result()
+                    if risultato is not None:
+                        yield risultato
+        finally:
+            # se il consumatore si interrompe, sblocca e ferma il produttore
+            stop.set()
+            posti.release()
+        print()
+
     def token_per_pdf(self, pdf_folder):
         """
         Riceve una cartella con PDF.
         Ritorna una lista di dizionari con nome del file, testo e numero di token stimati.
         Mantiene l'ordine originale dei file.
         """
-        pdf_files = [f for f in os.listdir(pdf_folder) if f.lower().endswith(".pdf")]
+        ordine = {f: i for i, f in enumerate(os.listdir(pdf_folder))}
+        risultati = list(self.flusso_pdf(pdf_folder, dimensione_coda=len(ordine)))
+        return sorted(risultati, key=lambda r: ordine[r["nome_file"]])
 
-        def process_pdf(index, pdf_filename):
-            """
-            Elabora un singolo file PDF e include l'indice per mantenere l'ordine.
-            """
-            pdf_path = os.path.join(pdf_folder, pdf_filename)
-            testo = estrai_google_vision(pdf_path)
-            if testo and testo != "Errore":
-                num_token = self.token_calculation(testo)
-                return index, {
-                    "nome_file": pdf_filename,
-                    "testo": testo,
-                    "token": num_token
-                }
-
-            return index, None
-
-        # utilizzo del multithreading con mantenimento dell'ordine
-        risultati = []
-        max_workers = min(4, os.cpu_count() or 1)
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(process_pdf, i, pdf): pdf for i, pdf in enumerate(pdf_files)}
-            for future in tqdm(as_completed(futures), total=len(futures), desc=f"{BOLD}{GREEN}Elaborazione OCR{RESET} ({max_workers} threads)"):
-                risultati.append(future.result())
-
-        # ordina i risultati in base all'indice originale e filtra i `None`
-        risultati_ordinati = [r[1] for r in sorted(risultati, key=lambda x: x[0]) if r[1] is not None]
-        print()
-        return risultati_ordinati
-    
     # stima della durata della richiesta
-    def stima_durata(self, testi_batch):
+    def stima_durata(self, testi_batch, prompt_corsi=None, token_attestati=None):
         """
         Stima il tempo di attesa in secondi.
         :param testi_batch: Testi batch
+        :param prompt_corsi: Database dei corsi inviato con il batch (None per il database completo)
+        :param token_attestati: Token già calcolati degli attestati
         :return: Durata stimata in secondi
         """
-        token_input, token_output_stimati = self.stima_token(testi_batch)
+        token_input, token_output_stimati = self.stima_token(testi_batch, prompt_corsi, token_attestati)
         total_tokens = token_input + token_output_stimati
-        tempo_stimato = math.ceil(total_tokens / TOKEN_OUTPUT_RATE)
+        tempo_stimato = math.ceil(total_tokens / statistiche.token_rate(TOKEN_OUTPUT_RATE))
 
         # print(f"\nTokens stimati: ~ {token_input + token_output_stimati}")
         # print(f"Tempo stimato: ~ {tempo_stimato} secondi\n")
@@ -112,11 +302,18 @@ class SharedState:
 
     # calcola i token in input e stima quelli in output
     # const TOKEN_OUTPUT_PER_PDF settabile in base a num tokens output per attestato (stima)
-    def stima_token(self, testi_batch):
+    def stima_token(self, testi_batch, prompt_corsi=None, token_attestati=None):
+        """
+        :param token_attestati: Token già calcolati degli attestati con intestazione (evita di ritokenizzare i testi)
+        """
         from gpt.openai_api import prompt
-        contenuto_attestati = "\n\n".join([f"Attestato {i+1} - {nome_file}\n{text}" for i, (nome_file, text) in enumerate(testi_batch)])
-        token_input = shared.token_calculation(prompt+prompt_db) + shared.token_calculation(contenuto_attestati)
-        token_output_estimated = TOKEN_OUTPUT_PER_PDF * len(testi_batch)
+        if prompt_corsi is None:
+            prompt_corsi = prompt_db()
+        if token_attestati is None:
+            contenuto_attestati = "\n\n".join([f"Attestato {i+1} - {nome_file}\n{text}" for i, (nome_file, text) in enumerate(testi_batch)])
+            token_attestati = shared.token_calculation(contenuto_attestati)
+        token_input = token_prompt(prompt+prompt_corsi) + token_attestati
+        token_output_estimated = statistiche.token_output_per_pdf(TOKEN_OUTPUT_PER_PDF) * len(testi_batch)
 
         return token_input, token_output_estimated
     
@@ -124,20 +321,49 @@ class SharedState:
     def get_eur_to_usd_rate(self):
         """
         Ritorna il tasso di cambio EUR-USD utilizzando l'API di ExchangeRate-API.
-        Salva il valore in una cache a partire dal tasso aggiornato al momento dell'esecuzione.
-        Ritorna None se c'è un errore.
+        Il valore è salvato su disco (CAMBIO_PATH) e riutilizzato per CAMBIO_TTL_ORE senza chiamate di rete;
+        se l'API non risponde si usa l'ultima copia su disco, anche scaduta, oppure EUR_USD_DEFAULT.
         """
-        if self._cached_rate is not None:
-            return self._cached_rate  
+        with self._lock_cambio:
+            if self._cached_rate is None:
+                self._cached_rate = self._carica_tasso()
+            return self._cached_rate
+
+    @staticmethod
+    def _carica_tasso():
+        salvato = None
         try:
+            with open(cambio_path, "r", encoding="utf-8") as f:
+                salvato = json.load(f)
+            if time.time() - salvato["salvato"] < cambio_ttl_ore * 3600:
+                return salvato["tasso"]
+        except (OSError, ValueError, KeyError, TypeError):
+            salvato = None
+
+        try:
+            import requests
             url = "https://api.exchangerate-api.com/v4/latest/EUR"
-            response = requests.get(url)
-            data = response.json()
-            self._cached_rate = data["rates"]["USD"] 
-            return self._cached_rate
+            response = requests.get(url, timeout=5)
+            tasso = response.json()["rates"]["USD"]
         except Exception as e:
-            print(f"Errore nel recupero del tasso di cambio: {e}")
-            return None
+            if salvato is not None:
+                print(f"{YELLOW}Tasso di cambio non aggiornato ({e}), uso l'ultimo salvato: {salvato['tasso']}{RESET}")
+                return salvato["tasso"]
+            print(f"{YELLOW}Errore nel recupero del tasso di cambio ({e}), uso il valore di default {EUR_USD_DEFAULT}{RESET}")
+            return EUR_USD_DEFAULT
+
+        try:
+            cartella = os.path.dirname(cambio_path)
+            if cartella:
+                os.makedirs(cartella, exist_ok=True)
+            # nome temporaneo unico: più worker (anche su macchine diverse) possono condividere la cartella
+            tmp = f"{cambio_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"tasso": tasso, "salvato": time.time()}, f)
+            os.replace(tmp, cambio_path)
+        except OSError as e:
+            print(f"{YELLOW}Impossibile salvare il tasso di cambio: {e}{RESET}")
+        return tasso
 
 
 shared = SharedState()
\ No newline at end of file
@@ -0,0 +1,231 @@
+# ----- Archivio SQLite dei risultati: il file Excel diventa un'esportazione -----
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from utils.excel import riga_excel, COLONNE_DEBUG
+
+# colonna del file Excel -> colonna dell'archivio
+COLONNE = {
+    "B": "nome_partecipante",
+    "C": "cognome_partecipante",
+    "D": "data_fine_corso",
+    "E": "dati_anagrafici",
+    "F": "codice_fiscale",
+    "H": "codice_corso",
+    "I": "tdi",
+    "J": "nome_file",
+    "N": "durata_corso",
+    "T": "nome_corso",
+    "U": "testo",
+    "V": "analisi",
+    "W": "metodo",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attestati (
+    nome_file TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    nome_partecipante TEXT,
+    cognome_partecipante TEXT,
+    codice_fiscale TEXT,
+    data_fine_corso TEXT,
+    nome_corso TEXT,
+    codice_corso TEXT,
+    durata_corso TEXT,
+    dati_anagrafici TEXT,
+    tdi TEXT,
+    metodo TEXT,
+    token INTEGER,
+    testo TEXT,
+    analisi TEXT,
+    data_fine_iso TEXT,
+    aggiornato REAL,
+    PRIMARY KEY (nome_file, hash)
+);
+CREATE INDEX IF NOT EXISTS idx_codice_fiscale ON attestati (codice_fiscale);
+CREATE INDEX IF NOT EXISTS idx_cognome_nome ON attestati (cognome_partecipante, nome_partecipante);
+CREATE INDEX IF NOT EXISTS idx_codice_corso ON attestati (codice_corso);
+"""
+
+DATA = re.compile(r"^\s*(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})\s*$")
+
+
+def data_iso(data):
+    """
+    Data gg/mm/aaaa (anche con - o .) in formato aaaa-mm-gg, ordinabile; None se non riconosciuta (es. ND).
+    """
+    corrispondenza = DATA.match(data or "")
+    if not corrispondenza:
+        return None
+    giorno, mese, anno = corrispondenza.groups()
+    return f"{anno}-{int(mese):02d}-{int(giorno):02d}"
+
+
+class Archivio:
+    """
+    Risultati, testo OCR, JSON del modello e metadati di ogni file in un database SQLite indicizzato
+    (codice fiscale, cognome e nome, codice corso). Le righe vengono inserite o aggiornate per nome file + hash.
+    """
+    def __init__(self, percorso):
+        self.percorso = percorso
+        cartella = os.path.dirname(percorso)
+        if cartella:
+            os.makedirs(cartella, exist_ok=True)
+        # una sola connessione condivisa dai thread di invio, protetta dal lock
+        self._lock = threading.Lock()
+        self.connessione = sqlite3.connect(percorso, check_same_thread=False)
+        self.connessione.row_factory = sqlite3.Row
+        self.connessione.execute("PRAGMA journal_mode=WAL")
+        self.connessione.execute("PRAGMA synchronous=NORMAL")
+        self.connessione.executescript(SCHEMA)
+        self._aggiungi_data_iso()
+
+    def _aggiungi_data_iso(self):
+        # archivi creati prima della colonna data_fine_iso: aggiunta e ricalcolata dalle date salvate
+        colonne = {riga["name"] for riga in self.connessione.execute("PRAGMA table_info(attestati)")}
+        if "data_fine_iso" in colonne:
+            return
+        self.connessione.create_function("data_iso", 1, data_iso)
+        with self.connessione:
+            self.connessione.execute("ALTER TABLE attestati ADD COLUMN data_fine_iso TEXT")
+            self.connessione.execute("UPDATE attestati SET data_fine_iso = data_iso(data_fine_corso)")
+
+    @staticmethod
+    def _valori(riga, documento):
+        valori = {colonna: riga.get(lettera) for lettera, colonna in COLONNE.items()}
+        valori["nome_file"] = documento["nome_file"]
+        valori["hash"] = documento["hash"]
+        valori["token"] = documento.get("token")
+        valori["data_fine_iso"] = data_iso(valori["data_fine_corso"])
+        valori["aggiornato"] = time.time()
+        return valori
+
+    def salva_righe(self, righe, documenti):
+        """
+        Inserisce o aggiorna le righe (dizionari {colonna Excel: valore}) in un'unica transazione.
+        Ritorna il numero di righe inserite o aggiornate.
+        """
+        valori = [self._valori(riga, documento) for riga, documento in zip(righe, documenti)]
+        if not valori:
+            return 0
+        colonne = list(valori[0])
+        aggiorna = ", ".join(f"{c} = excluded.{c}" for c in colonne if c not in ("nome_file", "hash"))
+        # l'upsert mantiene il rowid, quindi l'ordine di esportazione resta quello del primo inserimento
+        sql = (f"INSERT INTO attestati ({', '.join(colonne)}) VALUES ({', '.join(':' + c for c in colonne)}) "
+               f"ON CONFLICT (nome_file, hash) DO UPDATE SET {aggiorna}")
+        with self._lock, self.connessione:
+            return self.connessione.executemany(sql, valori).rowcount
+
+    def nomi_file(self):
+        with self._lock:
+            return {riga[0] for riga in self.connessione.execute("SELECT nome_file FROM attestati")}
+
+    def righe_excel(self, escludi=(), debug=True):
+        """
+        Righe {colonna Excel: valore} nell'ordine di inserimento, esclusi i nomi file in `escludi`;
+        senza `debug` solo le colonne del foglio (niente testo OCR e JSON).
+        """
+        lettere = [l for l in COLONNE if debug or l not in COLONNE_DEBUG]
+        with self._lock:
+            risultati = self.connessione.execute(f"SELECT {', '.join(COLONNE[l] for l in lettere)} FROM attestati ORDER BY rowid").fetchall()
+        return [dict(zip(lettere, riga)) for riga in risultati if riga["nome_file"] not in escludi]
+
+    def cerca(self, codice_fiscale=None, cognome=None):
+        """
+        Attestati di un codice fiscale e/o di un cognome (lettere maiuscole, come nel file Excel).
+        """
+        condizioni, parametri = [], []
+        if codice_fiscale:
+            condizioni.append("codice_fiscale = ?")
+            parametri.append(codice_fiscale.replace(" ", "").upper())
+        if cognome:
+            condizioni.append("cognome_partecipante = ?")
+            parametri.append(cognome.strip().upper())
+        where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ""
+        with self._lock:
+            return [dict(riga) for riga in self.connessione.execute(
+                f"SELECT nome_file, nome_partecipante, cognome_partecipante, codice_fiscale, data_fine_corso, "
+                f"codice_corso, nome_corso, durata_corso FROM attestati {where} "
+                f"ORDER BY data_fine_iso IS NULL, data_fine_iso, nome_file", parametri)]
+
+    def rivalida(self):
+        """
+        Ricalcola i campi di ogni riga dal JSON del modello salvato (validazione del codice fiscale,
+        pulizia del nome corso, ...) senza chiamate API. Aggiorna solo le righe che cambiano
+        e ritorna le nuove righe {colonna Excel: valore} modificate.
+        """
+        with self._lock:
+            salvate = self.connessione.execute(
+                f"SELECT hash, token, {', '.join(COLONNE.values())} FROM attestati").fetchall()
+        righe, documenti = [], []
+        for salvata in salvate:
+            try:
+                analisi = json.loads(salvata["analisi"])
+            except (TypeError, ValueError):
+                continue
+            documento = {k: salvata[k] for k in ("nome_file", "hash", "testo", "metodo", "token")}
+            riga = riga_excel(analisi, documento)
+            if all(riga.get(lettera) == salvata[colonna] for lettera, colonna in COLONNE.items()):
+                continue
+            righe.append(riga)
+            documenti.append(documento)
+        self.salva_righe(righe, documenti)
+        return righe
+
+    def chiudi(self):
+        with self._lock:
+            self.connessione.close()
+
+
+class ArchivioWriter:
+    """
+    Stessa interfaccia di ExcelWriter, ma le righe vanno nell'archivio; il file Excel viene poi
+    scritto da `esporta`. I file già presenti nell'archivio o nel file Excel (`presenti`) vengono saltati.
+    """
+    def __init__(self, archivio, presenti=(), al_salvataggio=None):
+        self.archivio = archivio
+        self.presenti = set(presenti)
+        self.al_salvataggio = al_salvataggio
+        self._lock = threading.RLock()
+        self.righe_non_salvate = []
+        self.documenti_non_salvati = []
+
+    def nomi_file_presenti(self):
+        return self.presenti | self.archivio.nomi_file()
+
+    def scrivi_righe(self, righe, documenti=()):
+        with self._lock:
+            self.righe_non_salvate.extend(righe)
+            self.documenti_non_salvati.extend(documenti)
+
+    def fine_batch(self):
+        # una transazione per batch: economica rispetto al salvataggio del file Excel
+        self.salva()
+
+    def salva(self):
+        with self._lock:
+            righe, self.righe_non_salvate = self.righe_non_salvate, []
+            documenti, self.documenti_non_salvati = self.documenti_non_salvati, []
+            self.archivio.salva_righe(righe, documenti)
+        if self.al_salvataggio and documenti:
+            self.al_salvataggio(documenti)
+
+
+def esporta(archivio, excel_writer, debug=False, riscrivi=()):
+    """
+    Accoda al file Excel le righe dell'archivio non ancora presenti (colonna J), nell'ordine di inserimento.
+    - debug: scrive anche le colonne di debug (testo OCR, JSON del modello, metodo).
+    - riscrivi: righe (es. rivalidate) da sovrascrivere se già presenti nel file Excel.
+    Ritorna il numero di righe esportate (accodate o riscritte).
+    """
+    righe = archivio.righe_excel(escludi=excel_writer.nomi_file_presenti(), debug=debug)
+    riscritte = excel_writer.riscrivi_righe(
+        [{l: v for l, v in riga.items() if debug or l not in COLONNE_DEBUG} for riga in riscrivi]) if riscrivi else 0
+    if righe:
+        excel_writer.scrivi_righe(righe)
+    if righe or riscritte:
+        excel_writer.salva()
+    return len(righe) + riscritte
@@ -7,7 +7,74 @@ pdf_folder = os.getenv("PDF_FOLDER")
 database_path = os.getenv("DATABASE_PATH")
 excel_path = os.getenv("EXCEL_PATH")
 openai_api_key = os.getenv("API_KEY")
+# endpoint alternativo compatibile OpenAI (None = api.openai.com)
+openai_base_url = os.getenv("OPENAI_BASE_URL") or None
 
 # OCR config
 poppler_path = os.getenv("POPPLER_PATH")
-google_vision_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
\ No newline at end of file
+google_vision_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+
+# cache OCR su disco
+ocr_cache_dir = os.getenv("OCR_CACHE_DIR", os.path.join(".cache", "ocr"))
+ocr_cache_max_mb = float(os.getenv("OCR_CACHE_MAX_MB", "500"))
+ocr_cache_max_giorni = float(os.getenv("OCR_CACHE_MAX_GIORNI", "90"))
+
+# preprocessing delle immagini inviate a Vision (default: immagine originale, nessuna pagina saltata)
+opzioni_immagine = {
+    "scala_grigi": os.getenv("IMMAGINE_SCALA_GRIGI", "0").lower() not in ("0", "false", "no"),
+    "lato_max": int(os.getenv("IMMAGINE_LATO_MAX", "0")),  # lato lungo massimo in pixel, 0 = nessun ridimensionamento
+    "formato": os.getenv("IMMAGINE_FORMATO", "PNG").upper(),  # PNG, JPEG o WEBP
+    "qualita": int(os.getenv("IMMAGINE_QUALITA", "85")),  # qualità per JPEG/WEBP
+    "salta_vuote": os.getenv("SALTA_PAGINE_VUOTE", "0").lower() not in ("0", "false", "no"),
+}
+
+# selezione locale dei corsi candidati (False = database completo in ogni richiesta)
+retrieval_corsi = os.getenv("RETRIEVAL_CORSI", "1").lower() not in ("0", "false", "no")
+retrieval_top_k = int(os.getenv("RETRIEVAL_TOP_K", "20"))
+
+# statistiche osservate su token di output e velocità delle risposte
+statistiche_path = os.getenv("STATISTICHE_PATH", os.path.join(".cache", "statistiche.json"))
+
+# scrittura Excel: checkpoint ogni N batch e colonne di debug in un CSV separato
+excel_checkpoint_ogni = int(os.getenv("EXCEL_CHECKPOINT_OGNI", "5"))
+excel_sidecar = os.getenv("EXCEL_SIDECAR", "0").lower() in ("1", "true", "yes")
+
+# journal delle elaborazioni (ripresa delle esecuzioni interrotte)
+journal_path = os.getenv("JOURNAL_PATH", os.path.join(".cache", "journal.jsonl"))
+
+# report delle metriche di esecuzione (JSON) e file opzionale per il textfile collector di Prometheus
+metriche_path = os.getenv("METRICHE_PATH", os.path.join(".cache", "metriche.json"))
+metriche_prometheus = os.getenv("METRICHE_PROMETHEUS") or None
+
+# copia su disco del database corsi già letto (riletto se l'Excel cambia o dopo la scadenza)
+corsi_cache_path = os.getenv("CORSI_CACHE_PATH", os.path.join(".cache", "corsi.json"))
+corsi_cache_ttl_ore = float(os.getenv("CORSI_CACHE_TTL_ORE", "168"))
+
+# tasso di cambio EUR-USD salvato su disco (fallback offline)
+cambio_path = os.getenv("CAMBIO_PATH", os.path.join(".cache", "cambio.json"))
+cambio_ttl_ore = float(os.getenv("CAMBIO_TTL_ORE", "24"))
+
+# attestati duplicati (stesso file o stessa scansione): analizzato uno solo, risultato copiato sugli altri
+deduplica = os.getenv("DEDUPLICA", "1").lower() not in ("0", "false", "no")
+dedup_soglia = float(os.getenv("DEDUP_SOGLIA", "0.97"))
+# quasi duplicati (confronto approssimato dei testi, solo tra attestati con lo stesso codice fiscale): disattivati di default
+dedup_simili = os.getenv("DEDUP_SIMILI", "0").lower() not in ("0", "false", "no")
+# rappresentanti ricordati dal rilevamento dei duplicati (i meno recenti vengono dimenticati; 0 = nessun limite)
+dedup_max_documenti = int(os.getenv("DEDUP_MAX_DOCUMENTI", "5000"))
+
+# output compatto del modello: chiavi brevi, campi ricavabili con regole locali non generati
+output_compatto = os.getenv("OUTPUT_COMPATTO", "1").lower() not in ("0", "false", "no")
+
+# modalità sorveglianza: secondi tra due controlli della cartella e attesa massima prima di inviare un batch incompleto
+sorveglia_intervallo = float(os.getenv("SORVEGLIA_INTERVALLO", "5"))
+sorveglia_attesa_max = float(os.getenv("SORVEGLIA_ATTESA_MAX", "60"))
+
+# elaborazione distribuita: file intermedi dei worker (su un filesystem condiviso, default accanto al file Excel)
+shard_dir = os.getenv("SHARD_DIR") or os.path.join(os.path.dirname(excel_path or ""), "shard")
+
+# archivio SQLite dei risultati (il file Excel viene esportato dall'archivio); ARCHIVIO=0 scrive direttamente nel file Excel
+archivio = os.getenv("ARCHIVIO", "1").lower() not in ("0", "false", "no")
+archivio_path = os.getenv("ARCHIVIO_PATH", os.path.join(".cache", "attestati.sqlite"))
+
+# limite di spesa in euro per esecuzione (nessun nuovo batch oltre la spesa prevista); vuoto = nessun limite
+budget_euro = float(os.getenv("BUDGET_EURO")) if os.getenv("BUDGET_EURO") else None
@@ -0,0 +1,209 @@
+# ----- Rilevamento di attestati duplicati (stesso file o stessa scansione con rumore OCR) -----
+import re
+import zlib
+import random
+import difflib
+import hashlib
+import threading
+from collections import defaultdict, Counter, OrderedDict
+from utils.config import dedup_soglia, dedup_simili, dedup_max_documenti
+from utils.estrazione_locale import estrai_codice_fiscale
+
+# firme MinHash per documento, divise in bande per la ricerca dei candidati (LSH)
+MINHASH_PERMUTAZIONI = 64
+MINHASH_BANDE = 16
+_PRIMO = (1 << 61) - 1
+_rnd = random.Random(0)
+_COEFFICIENTI = [(_rnd.randrange(1, _PRIMO), _rnd.randrange(0, _PRIMO)) for _ in range(MINHASH_PERMUTAZIONI)]
+# candidati verificati con difflib per ogni documento (i più simili per numero di bande in comune):
+# il confronto resta lineare anche con molti attestati dello stesso modello
+MAX_CANDIDATI = 5
+
+# due testi sono quasi uguali se molto simili e se ogni differenza è corta e non cambia cifre (rumore OCR sparso):
+# attestati diversi dello stesso modello differiscono per nomi, codici fiscali o date
+MAX_DIFFERENZA = 3
+
+
+def normalizza(testo):
+    return re.sub(r"\s+", " ", testo.lower()).strip()
+
+def shingle(testo, n=3):
+    """
+    Insieme degli n-grammi di parole del testo normalizzato (come interi stabili tra esecuzioni).
+    """
+    parole = testo.split()
+    if len(parole) < n:
+        return {zlib.crc32(testo.encode())}
+    return {zlib.crc32(" ".join(parole[i:i + n]).encode()) for i in range(len(parole) - n + 1)}
+
+def minhash(insieme):
+    return [min((a * x + b) % _PRIMO for x in insieme) for a, b in _COEFFICIENTI]
+
+def quasi_uguali(a, b, soglia):
+    """
+    Testi normalizzati con similarità >= soglia, nessuna differenza più lunga di MAX_DIFFERENZA caratteri
+    e nessuna cifra cambiata (date, codici fiscali, durate).
+    """
+    if abs(len(a) - len(b)) > (1 - soglia) * max(len(a), len(b)):
+        return False
+    confronto = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    if confronto.quick_ratio() < soglia or confronto.ratio() < soglia:
+        return False
+    for operazione, i1, i2, j1, j2 in confronto.get_opcodes():
+        if operazione == "equal":
+            continue
+        if max(i2 - i1, j2 - j1) > MAX_DIFFERENZA:
+            return False
+        # ammessi solo scambi lettera/cifra tipici dell'OCR (O/0, l/1), non cifre diverse o mancanti
+        cifre_a = any(c.isdigit() for c in a[i1:i2])
+        cifre_b = any(c.isdigit() for c in b[j1:j2])
+        if (cifre_a and cifre_b) or (operazione != "replace" and (cifre_a or cifre_b)):
+            return False
+    return True
+
+
+class Deduplicatore:
+    """
+    Riconosce, man mano che arrivano dall'OCR, gli attestati già visti:
+    - duplicati esatti: stesso hash del file o stesso testo normalizzato;
+    - quasi duplicati (solo con `simili`): stessa scansione acquisita due volte. Si confrontano solo documenti
+      con lo stesso codice fiscale valido (stessa persona), candidati con MinHash/LSH e verifica con difflib.
+    Solo il primo documento di ogni gruppo (rappresentante) va analizzato; l'analisi viene poi
+    riportata sui duplicati, subito se è già disponibile o appena arriva.
+    Con `max_documenti` vengono ricordati solo i rappresentanti usati più di recente (memoria limitata
+    anche in modalità sorveglianza): per i file più vecchi resta il journal (analisi per hash del contenuto).
+    """
+    def __init__(self, soglia=dedup_soglia, simili=dedup_simili, max_documenti=dedup_max_documenti):
+        self.soglia = soglia
+        self.simili_attivi = simili
+        self.max_documenti = max_documenti
+        # chiave del rappresentante -> (hash, impronta del testo, bande), dal meno recente
+        self.recenti = OrderedDict()
+        self._lock = threading.Lock()
+        self.per_hash = {}
+        self.per_testo = {}
+        self.bande = defaultdict(list)
+        # chiave del rappresentante -> duplicati in attesa dell'analisi / analisi già ricevuta
+        self.in_attesa = defaultdict(list)
+        self.analisi = {}
+        self.esatti = 0
+        self.simili = 0
+
+    @staticmethod
+    def chiave(documento):
+        return (documento["nome_file"], documento["hash"])
+
+    def _cerca(self, documento):
+        if documento["hash"] in self.per_hash:
+            self.esatti += 1
+            self._usato(self.per_hash[documento["hash"]])
+            return self.per_hash[documento["hash"]]
+
+        # solo il file hash per i documenti senza testo completo (es. scansioni non ancora lette nelle stime):
+        # un testo vuoto o parziale uguale non dice nulla sul contenuto
+        testo = normalizza(documento["testo"])
+        impronta = None
+        if testo and not documento.get("pagine_ocr"):
+            impronta = hashlib.sha256(testo.encode()).hexdigest()
+            if impronta in self.per_testo:
+                self.esatti += 1
+                self._usato(self.per_testo[impronta])
+                return self.per_testo[impronta]
+
+        # senza un codice fiscale valido la persona non è identificabile: nessun confronto approssimato
+        cf = estrai_codice_fiscale(documento["testo"]) if self.simili_attivi and impronta else None
+        bande = []
+        if cf is not None:
+            firma = minhash(shingle(testo))
+            righe = MINHASH_PERMUTAZIONI // MINHASH_BANDE
+            # le bande comprendono il codice fiscale: attestati di persone diverse non sono mai candidati
+            bande = [(cf, b, tuple(firma[b * righe:(b + 1) * righe])) for b in range(MINHASH_BANDE)]
+            in_comune = Counter()
+            candidati = {}
+            for banda in bande:
+                for candidato, testo_candidato in self.bande[banda]:
+                    in_comune[id(candidato)] += 1
+                    candidati[id(candidato)] = (candidato, testo_candidato)
+            for chiave, _ in in_comune.most_common(MAX_CANDIDATI):
+                candidato, testo_candidato = candidati[chiave]
+                if quasi_uguali(testo, testo_candidato, self.soglia):
+                    self.simili += 1
+                    self._usato(candidato)
+                    return candidato
+
+        # nuovo rappresentante
+        self.per_hash[documento["hash"]] = documento
+        if impronta:
+            self.per_testo[impronta] = documento
+        for banda in bande:
+            self.bande[banda].append((documento, testo))
+        self.recenti[self.chiave(documento)] = (documento["hash"], impronta, bande)
+        self._limita()
+        return None
+
+    def _usato(self, rappresentante):
+        chiave = self.chiave(rappresentante)
+        if chiave in self.recenti:
+            self.recenti.move_to_end(chiave)
+
+    def _limita(self):
+        """
+        Dimentica i rappresentanti meno recenti oltre `max_documenti` (salvo quelli con duplicati in attesa).
+        """
+        if not self.max_documenti:
+            return
+        for chiave in list(self.recenti):
+            if len(self.recenti) <= self.max_documenti:
+                break
+            if chiave in self.in_attesa:
+                continue
+            hash_pdf, impronta, bande = self.recenti.pop(chiave)
+            documento = self.per_hash.pop(hash_pdf, None)
+            if impronta and self.per_testo.get(impronta) is documento:
+                del self.per_testo[impronta]
+            for banda in bande:
+                rimasti = [voce for voce in self.bande[banda] if voce[0] is not documento]
+                if rimasti:
+                    self.bande[banda] = rimasti
+                else:
+                    del self.bande[banda]
+            self.analisi.pop(chiave, None)
+
+    def registra(self, documento):
+        """
+        Ritorna (rappresentante, analisi):
+        - (None, None) se il documento è nuovo e va analizzato;
+        - (rappresentante, analisi) se è un duplicato e l'analisi del rappresentante è già disponibile;
+        - (rappresentante, None) se è un duplicato in attesa: verrà restituito da `risolvi`.
+        """
+        with self._lock:
+            rappresentante = self._cerca(documento)
+            if rappresentante is None:
+                return None, None
+            chiave = self.chiave(rappresentante)
+            if chiave in self.analisi:
+                return rappresentante, self.analisi[chiave]
+            self.in_attesa[chiave].append(documento)
+            return rappresentante, None
+
+    def risolvi(self, rappresentante, analisi):
+        """
+        Registra l'analisi del rappresentante e ritorna i duplicati che la stavano aspettando.
+        """
+        with self._lock:
+            chiave = self.chiave(rappresentante)
+            if chiave in self.recenti:
+                self.analisi[chiave] = analisi
+            return self.in_attesa.pop(chiave, [])
+
+    def non_risolti(self):
+        with self._lock:
+            return sum(len(duplicati) for duplicati in self.in_attesa.values())
+
+
+def deduplica(documenti, soglia=dedup_soglia, simili=dedup_simili):
+    """
+    Lista dei soli rappresentanti (duplicati esclusi), per le stime.
+    """
+    deduplicatore = Deduplicatore(soglia, simili, max_documenti=None)
+    return [d for d in documenti if deduplicatore.registra(d)[0] is None]
@@ -0,0 +1,182 @@
+# ----- Estrazione locale (regole) dei campi ricavabili dal testo senza il modello -----
+import re
+import itertools
+
+# valori dei caratteri in posizione dispari (1a, 3a, ...) per il carattere di controllo del codice fiscale
+DISPARI = {
+    "0": 1, "1": 0, "2": 5, "3": 7, "4": 9, "5": 13, "6": 15, "7": 17, "8": 19, "9": 21,
+    "A": 1, "B": 0, "C": 5, "D": 7, "E": 9, "F": 13, "G": 15, "H": 17, "I": 19, "J": 21,
+    "K": 2, "L": 4, "M": 18, "N": 20, "O": 11, "P": 3, "Q": 6, "R": 8, "S": 12, "T": 14,
+    "U": 16, "V": 10, "W": 22, "X": 25, "Y": 24, "Z": 23,
+}
+MESI = "ABCDEHLMPRST"
+# lettere ammesse al posto delle cifre nei codici fiscali con omocodia
+OMOCODIA = "LMNPQRSTUV"
+POSIZIONI_CIFRE = (6, 7, 9, 10, 12, 13, 14)
+
+# scambi tipici dell'OCR tra lettere e cifre
+LETTERA_CIFRA = {"O": "0", "Q": "0", "D": "0", "I": "1", "L": "1", "Z": "2", "S": "5", "G": "6", "T": "7", "B": "8"}
+CIFRA_LETTERA = {"0": "O", "1": "I", "2": "Z", "5": "S", "6": "G", "7": "T", "8": "B"}
+# correzioni massime per candidato (oltre si rischia di "inventare" un codice fiscale)
+MAX_CORREZIONI_CF = 2
+
+
+def carattere_controllo(cf):
+    """
+    Carattere di controllo calcolato dai primi 15 caratteri del codice fiscale.
+    """
+    somma = sum(DISPARI[c] if i % 2 == 0 else (int(c) if c.isdigit() else ord(c) - 65) for i, c in enumerate(cf[:15]))
+    return chr(somma % 26 + 65)
+
+def ammesso(c, posizione):
+    if posizione in POSIZIONI_CIFRE:
+        return c.isdigit() or c in OMOCODIA
+    if posizione == 8:
+        return c in MESI
+    return c.isalpha()
+
+def cf_valido(cf):
+    return len(cf) == 16 and all(ammesso(c, i) for i, c in enumerate(cf)) and carattere_controllo(cf) == cf[15]
+
+def _alternative(c, posizione):
+    alternative = [c] if ammesso(c, posizione) else []
+    if c in LETTERA_CIFRA and ammesso(LETTERA_CIFRA[c], posizione):
+        alternative.append(LETTERA_CIFRA[c])
+    if c in CIFRA_LETTERA and ammesso(CIFRA_LETTERA[c], posizione):
+        alternative.append(CIFRA_LETTERA[c])
+    return alternative
+
+def ripara_cf(candidato):
+    """
+    Corregge gli scambi lettera/cifra dell'OCR in un codice fiscale di 16 caratteri usando formato
+    e carattere di controllo. Ritorna il codice valido con meno correzioni (al massimo MAX_CORREZIONI_CF),
+    None se nessuna correzione lo rende valido o se più correzioni diverse sono ugualmente plausibili.
+    """
+    cf = re.sub(r"[^A-Z0-9]", "", candidato.upper())
+    if len(cf) != 16:
+        return None
+    if cf_valido(cf):
+        return cf
+
+    opzioni = [_alternative(c, i) for i, c in enumerate(cf)]
+    if any(not o for o in opzioni):
+        return None
+    # posizioni in cui il carattere letto non è ammesso: la correzione è obbligata
+    obbligate = [i for i, c in enumerate(cf) if c not in opzioni[i]]
+    # lettere lette al posto di cifre (es. O per 0): ammesse per omocodia, ma quasi sempre errori dell'OCR;
+    # le cifre non vengono mai trasformate in lettere di omocodia, si inventerebbero codici diversi
+    facoltative = [i for i in POSIZIONI_CIFRE if cf[i] in LETTERA_CIFRA and i not in obbligate]
+    if len(obbligate) > MAX_CORREZIONI_CF:
+        return None
+
+    for extra in range(MAX_CORREZIONI_CF - len(obbligate) + 1):
+        validi = set()
+        for scelte in itertools.combinations(facoltative, extra):
+            posizioni = obbligate + list(scelte)
+            for sostituti in itertools.product(*[[a for a in opzioni[i] if a != cf[i]] for i in posizioni]):
+                corretto = list(cf)
+                for i, s in zip(posizioni, sostituti):
+                    corretto[i] = s
+                corretto = "".join(corretto)
+                if cf_valido(corretto):
+                    validi.add(corretto)
+        if len(validi) == 1:
+            return validi.pop()
+        if validi:
+            return None
+    return None
+
+def _candidati_con_posizione(testo):
+    # (candidato, posizione nel testo della prima parola)
+    parole = [(re.sub(r"[^A-Z0-9]", "", m.group().upper()), m.start()) for m in re.finditer(r"\S+", testo)]
+    for inizio in range(len(parole)):
+        unione = ""
+        for parola, _ in parole[inizio:inizio + 5]:
+            if not parola:
+                break
+            unione += parola
+            if len(unione) >= 16:
+                break
+        if len(unione) == 16 and sum(unione[i].isdigit() for i in POSIZIONI_CIFRE) >= 4:
+            yield unione, parole[inizio][1]
+
+def candidati_cf(testo):
+    """
+    Sequenze di 16 caratteri alfanumerici (anche spezzate da spazi, es. 'ZNL MTT 94R21 C618B')
+    con almeno 4 cifre nelle posizioni numeriche: prefiltro per non scambiare parole per codici.
+    """
+    for candidato, _ in _candidati_con_posizione(testo):
+        yield candidato
+
+# etichetta del codice fiscale e distanza massima (caratteri) tra etichetta o dati di nascita e codice
+ETICHETTA_CF = re.compile(r"(?<![a-z])c\s*\.\s*f\s*\.?|\bcf\b|codice\s+fiscale", re.IGNORECASE)
+DISTANZA_ETICHETTA = 40
+DISTANZA_NASCITA = 150
+
+def estrai_codice_fiscale(testo):
+    """
+    Codice fiscale del partecipante, solo se non ambiguo: nel testo c'è un solo codice valido
+    e segue un'etichetta ("C.F.", "codice fiscale") o è vicino ai dati di nascita.
+    Con più codici validi (es. anche quello del docente o dell'ente) decide il modello.
+    """
+    validi = {}
+    for candidato, posizione in _candidati_con_posizione(testo):
+        cf = ripara_cf(candidato)
+        if cf:
+            validi.setdefault(cf, []).append(posizione)
+    if len(validi) != 1:
+        return None
+    cf, posizioni = validi.popitem()
+    etichette = [m.end() for m in ETICHETTA_CF.finditer(testo)]
+    nascite = [m.start() for m in NASCITA.finditer(testo)]
+    for posizione in posizioni:
+        if any(0 <= posizione - fine <= DISTANZA_ETICHETTA for fine in etichette):
+            return cf
+        if any(abs(posizione - inizio) <= DISTANZA_NASCITA for inizio in nascite):
+            return cf
+    return None
+
+def estrai_tdi(testo):
+    return "YES" if re.search(r"tecnologie\s+d\s*['’`´]?\s*impresa", testo, re.IGNORECASE) else "NO"
+
+NASCITA = re.compile(
+    r"\bnat[oa]\s+(?:a|ad|in|il)\b|\bdata\s+di\s+nascita\b|\bluogo\s+di\s+nascita\b|\bnascita\s*:",
+    re.IGNORECASE,
+)
+
+def estrai_dati_anagrafici(testo):
+    """
+    YES se nel testo c'è un codice fiscale (anche non valido) o una data/luogo di nascita.
+    """
+    if NASCITA.search(testo) or any(True for _ in candidati_cf(testo)):
+        return "YES"
+    return "NO"
+
+DURATA = re.compile(
+    r"durata(?:\s+complessiva)?(?:\s+del\s+corso)?\s*(?:di|:|pari\s+a|=)?\s*(?:n\.?\s*)?(\d{1,3}(?:[.,]\d{1,2})?)\s*(?:ore|h)\b",
+    re.IGNORECASE,
+)
+ORE = re.compile(r"\b(\d{1,3}(?:[.,]\d{1,2})?)\s*ore\b", re.IGNORECASE)
+
+def estrai_durata(testo):
+    """
+    Durata del corso in ore se indicata senza ambiguità, None altrimenti (decide il modello).
+    """
+    valori = {m.group(1) for m in DURATA.finditer(testo)}
+    if not valori:
+        valori = {m.group(1) for m in ORE.finditer(testo)}
+    return valori.pop() if len(valori) == 1 else None
+
+def estrai_campi(testo):
+    """
+    Campi dell'attestato determinati localmente; codice fiscale e durata solo se trovati con certezza.
+    """
+    campi = {"tdi": estrai_tdi(testo), "dati_anagrafici": estrai_dati_anagrafici(testo)}
+    cf = estrai_codice_fiscale(testo)
+    if cf:
+        campi["codice_fiscale"] = cf
+        campi["dati_anagrafici"] = "YES"
+    durata = estrai_durata(testo)
+    if durata:
+        campi["durata_corso"] = durata
+    return campi
@@ -0,0 +1,160 @@
+# ----- Scrittura dei risultati nel file Excel -----
+import os
+import csv
+import json
+import threading
+import openpyxl
+from openpyxl.utils import column_index_from_string
+from utils.style import *
+from utils.format import Formatter
+from utils.metriche import metriche
+
+# colonne di debug (possono essere spostate nel file sidecar)
+COLONNE_DEBUG = ["T", "U", "V", "W"]
+
+
+def riga_excel(attestato, documento):
+    """
+    Converte il JSON di un attestato e il relativo documento (nome file, testo, metodo)
+    nel dizionario {colonna: valore} da scrivere nel file Excel.
+    """
+    return {
+        "B": attestato.get("nome_partecipante", "ND").upper(),
+        "C": attestato.get("cognome_partecipante", "ND").upper(),
+        "D": attestato.get("data_fine_corso", "ND"),
+        "E": attestato.get("dati_anagrafici", "ND"),
+        "F": Formatter.valida_cf(attestato.get("codice_fiscale", "ND")),
+        "I": attestato.get("tdi", "ND"),
+        "J": documento["nome_file"],
+        "H": attestato.get("codice_corso", "ND"),
+        "N": attestato.get("durata_corso", "ND"),
+        # DEBUG columns
+        "T": Formatter.pulisci_nome_corso(attestato.get("nome_corso", "ND")).upper(),
+        "U": documento["testo"],
+        "V": json.dumps(attestato, ensure_ascii=False),
+        "W": documento.get("metodo", "ND"),
+    }
+
+
+class ExcelWriter:
+    """
+    Accoda righe al foglio attivo del file Excel.
+    - Trova la prima riga libera (B e C vuote) leggendo solo le colonne necessarie.
+    - Salva un checkpoint atomico (file temporaneo + rename) ogni `checkpoint_ogni` batch.
+    - Con `sidecar` le colonne di debug (T/U/V/W) vanno in un CSV accanto al file Excel.
+    """
+    def __init__(self, excel_path, checkpoint_ogni=5, sidecar=False, al_salvataggio=None):
+        self.excel_path = excel_path
+        self.checkpoint_ogni = checkpoint_ogni
+        # callback con i documenti le cui righe sono state salvate su disco
+        self.al_salvataggio = al_salvataggio
+        self.documenti_non_salvati = []
+        # le righe possono arrivare dai thread di invio (risposte in streaming)
+        self._lock = threading.RLock()
+        self.workbook = openpyxl.load_workbook(excel_path)
+        self.sheet = self.workbook.active
+        self.row = self.prima_riga_libera()
+        self.batch_scritti = 0
+        self.modificato = False
+
+        self.sidecar_path = None
+        if sidecar:
+            self.sidecar_path = os.path.splitext(excel_path)[0] + "_debug.csv"
+
+    def prima_riga_libera(self):
+        """
+        Prima riga con nome e cognome vuoti (colonne B e C), altrimenti la riga dopo l'ultima.
+        """
+        for indice, (nome, cognome) in enumerate(self.sheet.iter_rows(min_col=2, max_col=3, values_only=True), start=1):
+            if not nome and not cognome:
+                return indice
+        return self.sheet.max_row + 1
+
+    def nomi_file_presenti(self):
+        """
+        Nomi file già presenti nella colonna J (attestati già scritti).
+        """
+        return {valore for (valore,) in self.sheet.iter_rows(min_col=10, max_col=10, values_only=True) if valore}
+
+    def scrivi_righe(self, righe, documenti=()):
+        """
+        Scrive una lista di dizionari {colonna: valore} a partire dalla prima riga libera.
+        - documenti: documenti delle righe, passati ad `al_salvataggio` al prossimo salvataggio.
+        """
+        with self._lock:
+            self._scrivi_righe(righe, documenti)
+
+    def riscrivi_righe(self, righe):
+        """
+        Sovrascrive le righe già presenti con lo stesso nome file (colonna J), senza spostarle.
+        Ritorna il numero di righe riscritte; quelle senza corrispondenza vengono ignorate.
+        """
+        with self._lock:
+            posizioni = {valore: indice for indice, (valore,) in
+                         enumerate(self.sheet.iter_rows(min_col=10, max_col=10, values_only=True), start=1) if valore}
+            riscritte = 0
+            for riga in righe:
+                indice = posizioni.get(riga.get("J"))
+                if indice is None:
+                    continue
+                for colonna, valore in riga.items():
+                    if self.sidecar_path and colonna in COLONNE_DEBUG:
+                        continue
+                    self.sheet.cell(row=indice, column=column_index_from_string(colonna), value=valore)
+                riscritte += 1
+            if riscritte:
+                self.modificato = True
+            return riscritte
+
+    def _scrivi_righe(self, righe, documenti):
+        self.documenti_non_salvati.extend(documenti)
+        debug = []
+        for riga in righe:
+            for colonna, valore in riga.items():
+                if self.sidecar_path and colonna in COLONNE_DEBUG:
+                    continue
+                self.sheet.cell(row=self.row, column=column_index_from_string(colonna), value=valore)
+            if self.sidecar_path and any(c in riga for c in COLONNE_DEBUG):
+                debug.append([self.row, riga.get("J")] + [riga.get(c, "") for c in COLONNE_DEBUG])
+            self.row += 1
+
+        if debug:
+            self._scrivi_sidecar(debug)
+        self.modificato = True
+
+    def _scrivi_sidecar(self, righe):
+        nuovo = not os.path.exists(self.sidecar_path)
+        with open(self.sidecar_path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if nuovo:
+                writer.writerow(["riga", "nome_file"] + COLONNE_DEBUG)
+            writer.writerows(righe)
+
+    def fine_batch(self):
+        """
+        Da chiamare dopo ogni batch scritto: salva un checkpoint ogni `checkpoint_ogni` batch.
+        """
+        self.batch_scritti += 1
+        if self.checkpoint_ogni and self.batch_scritti % self.checkpoint_ogni == 0:
+            self.salva()
+
+    def salva(self):
+        """
+        Salva il file Excel in modo atomico: un salvataggio interrotto non corrompe il file esistente.
+        """
+        with self._lock:
+            self._salva()
+
+    def _salva(self):
+        if not self.modificato:
+            return
+        base, estensione = os.path.splitext(self.excel_path)
+        tmp = f"{base}.tmp{estensione}"
+        with metriche.cronometro("excel_salvataggio_secondi"):
+            self.workbook.save(tmp)
+            os.replace(tmp, self.excel_path)
+        self.modificato = False
+
+        salvati, self.documenti_non_salvati = self.documenti_non_salvati, []
+        if self.al_salvataggio and salvati:
+            self.al_salvataggio(salvati)
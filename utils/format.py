@@ -1,4 +1,12 @@
 import re
+import json
+from utils.estrazione_locale import ripara_cf
+
+# chiavi dell'id nei JSON degli attestati (formato esteso e compatto)
+CHIAVI_ID = ("id", "i")
+
+def ha_id(oggetto):
+    return isinstance(oggetto, dict) and any(chiave in oggetto for chiave in CHIAVI_ID)
 
 class Formatter:
     def valida_cf(cf):
@@ -10,6 +18,11 @@ class Formatter:
         
         if len(cf) != 16:
             return "ND"
+
+        # codice valido, eventualmente dopo aver corretto scambi lettera/cifra con il carattere di controllo
+        riparato = ripara_cf(cf)
+        if riparato:
+            return riparato
         
         # formato del codice fiscale (L lettera, N numero)
         formato = "LLLLLLNNLNNLNNNL"
@@ -62,6 +75,28 @@ class Formatter:
         else:
             raise ValueError("JSON non trovato nell'output")
         
+    # estrae i JSON completi da un output troncato o malformato
+    def estrai_json_parziali(output):
+        """
+        Ritorna la lista degli oggetti JSON completi presenti nell'output, ignorando
+        l'eventuale oggetto troncato in coda (risposta interrotta da max_tokens).
+        """
+        output = re.sub(r"```json|```", "", output)
+        decoder = json.JSONDecoder()
+        oggetti = []
+        posizione = output.find("{")
+        while posizione != -1:
+            try:
+                oggetto, fine = decoder.raw_decode(output, posizione)
+            except ValueError:
+                # oggetto incompleto o non valido: prova dal successivo
+                posizione = output.find("{", posizione + 1)
+                continue
+            if ha_id(oggetto):
+                oggetti.append(oggetto)
+            posizione = output.find("{", fine)
+        return oggetti
+
     # gestione bug #JSON < #Attestati
     def crea_placeholder(id_attestato):
         return {
@@ -93,4 +128,54 @@ class Formatter:
                 print(f"Aggiunto JSON placeholder per l'attestato {i} ({nome_attestato}).")
                 json_completi.append(Formatter.crea_placeholder(i))
 
-        return json_completi
\ No newline at end of file
+        return json_completi
+
+
+class ParserIncrementale:
+    """
+    Parser per output JSON in streaming: riceve frammenti di testo e restituisce
+    ogni oggetto contenuto direttamente in una lista appena la sua parentesi di chiusura arriva.
+    Funziona sia con una lista di attestati sia con {"attestati": [...]}.
+    """
+    def __init__(self):
+        self.pila = []
+        self.in_stringa = False
+        self.escape = False
+        self.corrente = None
+        self.livello = 0
+
+    def aggiungi(self, frammento):
+        completati = []
+        for c in frammento:
+            if self.corrente is not None:
+                self.corrente.append(c)
+
+            if self.in_stringa:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_stringa = False
+                continue
+
+            if c == '"':
+                self.in_stringa = True
+            elif c in "{[":
+                # inizio di un oggetto direttamente dentro una lista
+                if c == "{" and self.corrente is None and self.pila and self.pila[-1] == "[":
+                    self.corrente = ["{"]
+                    self.livello = len(self.pila)
+                self.pila.append(c)
+            elif c in "}]":
+                if self.pila:
+                    self.pila.pop()
+                if c == "}" and self.corrente is not None and len(self.pila) == self.livello:
+                    try:
+                        oggetto = json.loads("".join(self.corrente))
+                        if ha_id(oggetto):
+                            completati.append(oggetto)
+                    except ValueError:
+                        pass
+                    self.corrente = None
+        return completati
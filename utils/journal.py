@@ -0,0 +1,111 @@
+# ----- Journal delle elaborazioni per riprendere le esecuzioni interrotte -----
+import os
+import json
+import time
+import threading
+from utils.style import *
+from utils.config import journal_path
+
+# fasi registrate per ogni PDF, nell'ordine in cui vengono completate
+FASE_OCR = "ocr"
+FASE_ANALISI = "analisi"
+FASE_SCRITTO = "scritto"
+
+
+class Journal:
+    """
+    Journal append-only (una riga JSON per evento) con chiave nome file + hash del contenuto.
+    Per ogni PDF registra OCR completato, analisi completata (con il JSON del modello) e riga salvata nell'Excel,
+    così una nuova esecuzione salta i file completati e riprende dal punto in cui si era fermata.
+    """
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self._lock = threading.Lock()
+        self.fasi = {}
+        self.analisi = {}
+        # hash del contenuto -> (nome file, analisi): copie dello stesso file con un altro nome
+        self.analisi_contenuto = {}
+        self._carica()
+
+    @staticmethod
+    def chiave(documento):
+        return (documento["nome_file"], documento["hash"])
+
+    def _carica(self):
+        try:
+            with open(self.percorso, "r", encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        evento = json.loads(linea)
+                    except ValueError:
+                        # ultima riga troncata da un'interruzione
+                        continue
+                    chiave = (evento["nome_file"], evento["hash"])
+                    self.fasi.setdefault(chiave, set()).add(evento["fase"])
+                    if evento["fase"] == FASE_ANALISI:
+                        self.analisi[chiave] = evento.get("dati")
+                        self.analisi_contenuto[evento["hash"]] = (evento["nome_file"], evento.get("dati"))
+        except OSError:
+            pass
+
+    def registra(self, documenti, fase, dati=None):
+        """
+        Registra la fase per uno o più documenti; `dati` (opzionale) è una lista parallela ai documenti.
+        """
+        if isinstance(documenti, dict):
+            documenti = [documenti]
+            dati = [dati] if dati is not None else None
+
+        linee = []
+        for i, documento in enumerate(documenti):
+            evento = {"nome_file": documento["nome_file"], "hash": documento["hash"], "fase": fase, "ts": time.time()}
+            if dati is not None:
+                evento["dati"] = dati[i]
+            linee.append(json.dumps(evento, ensure_ascii=False) + "\n")
+
+        with self._lock:
+            for documento, evento_dati in zip(documenti, dati or [None] * len(documenti)):
+                chiave = self.chiave(documento)
+                self.fasi.setdefault(chiave, set()).add(fase)
+                if fase == FASE_ANALISI:
+                    self.analisi[chiave] = evento_dati
+                    self.analisi_contenuto[documento["hash"]] = (documento["nome_file"], evento_dati)
+            try:
+                cartella = os.path.dirname(self.percorso)
+                if cartella:
+                    os.makedirs(cartella, exist_ok=True)
+                with open(self.percorso, "a", encoding="utf-8") as f:
+                    f.writelines(linee)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                print(f"{YELLOW}Impossibile aggiornare il journal: {e}{RESET}")
+
+    def sposta(self, percorso):
+        """
+        Registra i nuovi eventi in un altro file (es. uno per worker, così macchine diverse non scrivono
+        sullo stesso file); gli eventi già caricati restano validi e si aggiungono quelli del nuovo file.
+        """
+        with self._lock:
+            self.percorso = percorso
+        self._carica()
+
+    def completato(self, documento):
+        return FASE_SCRITTO in self.fasi.get(self.chiave(documento), ())
+
+    def analisi_salvata(self, documento):
+        """
+        JSON dell'analisi già ottenuta per il documento, None se l'analisi va ancora fatta.
+        """
+        with self._lock:
+            return self.analisi.get(self.chiave(documento))
+
+    def analisi_contenuto_salvata(self, documento):
+        """
+        (nome file, JSON) dell'analisi di un file con lo stesso contenuto, None se non ce n'è.
+        """
+        with self._lock:
+            return self.analisi_contenuto.get(documento["hash"])
+
+
+journal = Journal(journal_path)
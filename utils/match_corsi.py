@@ -1,41 +1,132 @@
 # prompt_db (quindi il database dei corsi con codice, nome_corso e durata minima) è di circa 10k tokens, che equivale a circa 2 cent per richiesta
-import pandas as pd
-from utils.config import database_path
+import os
+import re
+import json
+import socket
+import math
+import time
+import functools
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from utils.style import *
+from utils.config import database_path, retrieval_corsi, retrieval_top_k, corsi_cache_path, corsi_cache_ttl_ore
+
+COLONNE_CORSI = ["CODICE CORSO", "NOME CORSO", "alias", "DURATA MINIMA CORSO (ore)", "DURATA MASSIMA CORSO (ore)"]
+
+
+def presente(valore):
+    """
+    Valore non vuoto (le celle vuote lette da pandas sono NaN).
+    """
+    return valore is not None and valore == valore and str(valore).strip() != ""
 
 def carica_database_corsi(database_path):
     """
     Carica il database dei corsi da un file Excel.
     :param database_path: Percorso al file Excel.
-    :return: DataFrame con i dettagli dei corsi.
+    :return: Lista di dizionari (uno per corso) con le colonne di COLONNE_CORSI.
     """
-    columns_to_load = ["CODICE CORSO", "NOME CORSO", "alias", "DURATA MINIMA CORSO (ore)", "DURATA MASSIMA CORSO (ore)"]
+    # pandas viene importato solo se il database va riletto dall'Excel
+    import pandas as pd
     try:
-        df_corsi = pd.read_excel(database_path, usecols=columns_to_load)
-        return df_corsi
+        df_corsi = pd.read_excel(database_path, usecols=COLONNE_CORSI)
     except Exception as e:
         print(f"Errore nel caricamento del database: {e}")
         return None
+    return [{colonna: (valore if presente(valore) else None) for colonna, valore in row.items()} for row in df_corsi.to_dict("records")]
+
+def _firma_database(database_path):
+    stat = os.stat(database_path)
+    return {"percorso": os.path.abspath(database_path), "mtime": stat.st_mtime, "dimensione": stat.st_size}
+
+def _leggi_cache_corsi():
+    try:
+        with open(corsi_cache_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _scrivi_cache_corsi(firma, corsi):
+    try:
+        cartella = os.path.dirname(corsi_cache_path)
+        if cartella:
+            os.makedirs(cartella, exist_ok=True)
+        # nome temporaneo unico: più worker (anche su macchine diverse) possono condividere la cartella
+        tmp = f"{corsi_cache_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({**firma, "salvato": time.time(), "corsi": corsi}, f, ensure_ascii=False, default=str)
+        os.replace(tmp, corsi_cache_path)
+    except OSError as e:
+        print(f"{YELLOW}Impossibile salvare la cache dei corsi: {e}{RESET}")
+
+def _carica_con_cache():
+    cache = _leggi_cache_corsi()
+    try:
+        firma = _firma_database(database_path)
+    except (OSError, TypeError):
+        # Excel non raggiungibile (es. cartella di rete offline): ultima copia in cache
+        if cache is not None:
+            print(f"{YELLOW}Database dei corsi non raggiungibile, uso la copia in cache{RESET}")
+            return cache["corsi"]
+        return carica_database_corsi(database_path)
+
+    # copia su disco valida se l'Excel non è cambiato e non è scaduta
+    if cache is not None and all(cache.get(k) == v for k, v in firma.items()) \
+            and time.time() - cache.get("salvato", 0) < corsi_cache_ttl_ore * 3600:
+        return cache["corsi"]
+
+    corsi = carica_database_corsi(database_path)
+    if corsi is not None:
+        _scrivi_cache_corsi(firma, corsi)
+    elif cache is not None:
+        print(f"{YELLOW}Database dei corsi non leggibile, uso la copia in cache{RESET}")
+        return cache["corsi"]
+    return corsi
+
+_corsi = None
+_corsi_caricati = False
+_lock_database = threading.Lock()
+
+def database_corsi():
+    """
+    Corsi del database (lista di dizionari), caricati al primo utilizzo dalla cache su disco
+    o dall'Excel se è cambiato o la cache è scaduta. None se il caricamento non è possibile.
+    """
+    global _corsi, _corsi_caricati
+    with _lock_database:
+        if not _corsi_caricati:
+            _corsi = _carica_con_cache()
+            _corsi_caricati = True
+        return _corsi
+
+def riga_corso(row):
+    """
+    Costruisce una riga leggibile con tutte le informazioni del corso.
+    """
+    return (
+        f"{row['CODICE CORSO']} --- "
+        f"{row['NOME CORSO']} "
+        f"(alias: {row['alias'] if presente(row['alias']) else 'ND'}) --- "
+        f"{row['DURATA MINIMA CORSO (ore)']}-{row['DURATA MASSIMA CORSO (ore)']} ore\n"
+    )
+
+@functools.lru_cache(maxsize=None)
+def righe_corsi():
+    corsi = database_corsi()
+    return [riga_corso(row) for row in corsi] if corsi is not None else []
 
-def prompt_database():
+def prompt_database(indici=None):
     """
-    Prepara il prompt includendo tutti i corsi con informazioni dettagliate.
+    Prepara il prompt includendo i corsi con informazioni dettagliate.
+    :param indici: Indici dei corsi da includere (None per tutto il database).
     :return: Stringa formattata con l'elenco dei corsi.
     """
-    database_corsi = carica_database_corsi(database_path)
-    if database_corsi is None:
+    if database_corsi() is None:
         return "Errore nel caricamento del database dei corsi."
 
-    prompt_lines = []
-    for _, row in database_corsi.iterrows():
-        # costruisce una riga leggibile con tutte le informazioni del corso
-        line = (
-            f"{row['CODICE CORSO']} --- "
-            f"{row['NOME CORSO']} "
-            f"(alias: {row['alias'] if pd.notna(row['alias']) else 'ND'}) --- "
-            f"{row['DURATA MINIMA CORSO (ore)']}-{row['DURATA MASSIMA CORSO (ore)']} ore\n"
-        )
-        prompt_lines.append(line)
-
+    righe = righe_corsi()
+    prompt_lines = righe if indici is None else [righe[i] for i in sorted(indici)]
     prompt_database = "\n".join(prompt_lines)
 
     prompt_database = f"""
@@ -45,4 +136,89 @@ Questo è un database di corsi di formazione:
 """
     return prompt_database
 
-prompt_db = prompt_database()
\ No newline at end of file
+@functools.lru_cache(maxsize=None)
+def prompt_db():
+    """
+    Prompt con il database completo dei corsi, costruito una sola volta.
+    """
+    return prompt_database()
+
+
+class IndiceCorsi:
+    """
+    Indice TF-IDF su n-grammi di caratteri di codice, nome e alias dei corsi.
+    Serve a selezionare i corsi candidati per un attestato senza inviare l'intero database a OpenAI.
+    """
+    def __init__(self, corsi, n_min=3, n_max=5):
+        self.n_min = n_min
+        self.n_max = n_max
+
+        documenti = []
+        for row in corsi:
+            campi = [row["CODICE CORSO"], row["NOME CORSO"], row["alias"]]
+            documenti.append(" ".join(str(c) for c in campi if presente(c)))
+
+        conteggi = [self.ngrammi(d) for d in documenti]
+        frequenza_documenti = Counter(g for c in conteggi for g in c)
+        totale = len(documenti)
+        self.idf = {g: math.log((1 + totale) / (1 + df)) + 1 for g, df in frequenza_documenti.items()}
+
+        # indice invertito n-gramma -> [(indice corso, peso normalizzato)]
+        self.invertito = defaultdict(list)
+        for i, c in enumerate(conteggi):
+            vettore = self._pesi(c)
+            for g, peso in vettore.items():
+                self.invertito[g].append((i, peso))
+
+    @staticmethod
+    def normalizza(testo):
+        testo = unicodedata.normalize("NFKD", str(testo)).encode("ascii", "ignore").decode()
+        return re.sub(r"[^a-z0-9]+", " ", testo.lower()).strip()
+
+    def ngrammi(self, testo):
+        """
+        Conta gli n-grammi di caratteri delle parole (con bordi), robusti a errori OCR e abbreviazioni.
+        """
+        conteggio = Counter()
+        for parola in self.normalizza(testo).split():
+            parola = f" {parola} "
+            for n in range(self.n_min, self.n_max + 1):
+                for i in range(len(parola) - n + 1):
+                    conteggio[parola[i:i + n]] += 1
+        return conteggio
+
+    def _pesi(self, conteggio):
+        # tf sublineare * idf, normalizzato L2 (n-grammi sconosciuti ignorati)
+        vettore = {g: (1 + math.log(tf)) * self.idf[g] for g, tf in conteggio.items() if g in self.idf}
+        norma = math.sqrt(sum(p * p for p in vettore.values())) or 1.0
+        return {g: p / norma for g, p in vettore.items()}
+
+    def cerca(self, testo, k):
+        """
+        Ritorna gli indici dei k corsi più simili al testo (similarità coseno).
+        """
+        punteggi = defaultdict(float)
+        for g, peso in self._pesi(self.ngrammi(testo)).items():
+            for i, peso_corso in self.invertito[g]:
+                punteggi[i] += peso * peso_corso
+        return [i for i, _ in sorted(punteggi.items(), key=lambda x: -x[1])[:k]]
+
+
+@functools.lru_cache(maxsize=None)
+def indice_corsi():
+    """
+    Indice per la selezione dei corsi candidati, creato al primo utilizzo.
+    None = ricerca locale disattivata o database non disponibile (database completo in ogni richiesta).
+    """
+    if not retrieval_corsi or database_corsi() is None:
+        return None
+    return IndiceCorsi(database_corsi())
+
+def candidati_corsi(testo, k=retrieval_top_k):
+    """
+    Indici dei corsi candidati per il testo di un attestato, None se la ricerca locale è disattivata.
+    """
+    indice = indice_corsi()
+    if indice is None:
+        return None
+    return indice.cerca(testo, k)
@@ -0,0 +1,129 @@
+# ----- Metriche di esecuzione per fase (tempi, token, retry), esportate in JSON e in formato Prometheus -----
+import os
+import json
+import socket
+import time
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from utils.style import *
+from utils.config import metriche_path, metriche_prometheus
+from gpt.statistiche import percentile
+
+# prefisso dei nomi nel file per il textfile collector di node_exporter
+PREFISSO_PROMETHEUS = "attestati"
+QUANTILI = (50, 90, 99)
+
+
+class Metriche:
+    """
+    Raccoglie distribuzioni (es. secondi per pagina, per richiesta, per batch) e contatori
+    dai thread dell'esecuzione; a fine esecuzione scrive un report JSON e, se configurato,
+    un file di testo per il textfile collector di Prometheus.
+    """
+    def __init__(self, percorso_json, percorso_prometheus=None):
+        self.percorso_json = percorso_json
+        self.percorso_prometheus = percorso_prometheus
+        self._lock = threading.Lock()
+        self.distribuzioni = defaultdict(list)
+        self.contatori = Counter()
+        self.inizio = time.time()
+
+    def osserva(self, nome, valore):
+        with self._lock:
+            self.distribuzioni[nome].append(valore)
+
+    def incrementa(self, nome, quantita=1):
+        with self._lock:
+            self.contatori[nome] += quantita
+
+    @contextmanager
+    def cronometro(self, nome):
+        """
+        Registra in `nome` i secondi trascorsi nel blocco (anche se solleva un'eccezione).
+        """
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.osserva(nome, time.perf_counter() - inizio)
+
+    def riepilogo(self):
+        with self._lock:
+            distribuzioni = {nome: list(valori) for nome, valori in self.distribuzioni.items() if valori}
+            contatori = dict(self.contatori)
+
+        riepilogo = {}
+        for nome, valori in sorted(distribuzioni.items()):
+            riepilogo[nome] = {
+                "conteggio": len(valori),
+                "somma": round(sum(valori), 4),
+                "media": round(sum(valori) / len(valori), 4),
+                "min": round(min(valori), 4),
+                "max": round(max(valori), 4),
+                **{f"p{q}": round(percentile(valori, q), 4) for q in QUANTILI},
+            }
+        return {"distribuzioni": riepilogo, "contatori": dict(sorted(contatori.items()))}
+
+    def stampa(self):
+        """
+        Tabella delle distribuzioni in secondi ordinate per tempo totale (la fase dominante in cima).
+        """
+        distribuzioni = self.riepilogo()["distribuzioni"]
+        fasi = sorted(((n, d) for n, d in distribuzioni.items() if n.endswith("_secondi")), key=lambda x: -x[1]["somma"])
+        if not fasi:
+            return
+        print(f"\n{BOLD}{'fase':<28}{'n':>7}{'totale s':>11}{'media ms':>10}{'p90 ms':>9}{'max ms':>9}{RESET}")
+        for nome, d in fasi:
+            print(f"{nome[:-len('_secondi')]:<28}{d['conteggio']:>7}{d['somma']:>11.1f}{d['media'] * 1000:>10.0f}{d['p90'] * 1000:>9.0f}{d['max'] * 1000:>9.0f}")
+
+    def prometheus(self):
+        """
+        Testo nel formato di esposizione di Prometheus (summary per le distribuzioni, counter per i contatori).
+        """
+        riepilogo = self.riepilogo()
+        righe = []
+        for nome, d in riepilogo["distribuzioni"].items():
+            metrica = f"{PREFISSO_PROMETHEUS}_{nome}"
+            righe.append(f"# TYPE {metrica} summary")
+            righe += [f'{metrica}{{quantile="{q / 100}"}} {d[f"p{q}"]}' for q in QUANTILI]
+            righe.append(f"{metrica}_sum {d['somma']}")
+            righe.append(f"{metrica}_count {d['conteggio']}")
+        for nome, valore in riepilogo["contatori"].items():
+            metrica = f"{PREFISSO_PROMETHEUS}_{nome}_total"
+            righe.append(f"# TYPE {metrica} counter")
+            righe.append(f"{metrica} {valore}")
+        metrica = f"{PREFISSO_PROMETHEUS}_ultima_esecuzione_timestamp_secondi"
+        righe += [f"# TYPE {metrica} gauge", f"{metrica} {time.time():.0f}"]
+        return "\n".join(righe) + "\n"
+
+    @staticmethod
+    def _scrivi(percorso, testo):
+        cartella = os.path.dirname(percorso)
+        if cartella:
+            os.makedirs(cartella, exist_ok=True)
+        # il collector può leggere il file in qualsiasi momento: scrittura atomica
+        tmp = f"{percorso}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(testo)
+        os.replace(tmp, percorso)
+
+    def salva(self, extra=None):
+        """
+        Scrive il report JSON dell'esecuzione (con i totali in `extra`) ed eventualmente il file Prometheus.
+        """
+        report = {
+            "inizio": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.inizio)),
+            "durata_secondi": round(time.time() - self.inizio, 2),
+            **(extra or {}),
+            **self.riepilogo(),
+        }
+        try:
+            self._scrivi(self.percorso_json, json.dumps(report, indent=2, ensure_ascii=False))
+            if self.percorso_prometheus:
+                self._scrivi(self.percorso_prometheus, self.prometheus())
+        except OSError as e:
+            print(f"{YELLOW}Impossibile salvare le metriche: {e}{RESET}")
+
+
+metriche = Metriche(metriche_path, metriche_prometheus)
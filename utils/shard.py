@@ -0,0 +1,208 @@
+# ----- Elaborazione distribuita: shard della cartella per hash, file intermedi dei worker e unione -----
+import os
+import re
+import json
+import time
+import hashlib
+import socket
+import threading
+from utils.style import *
+from utils.config import shard_dir
+
+# file intermedio di ogni worker: una riga JSON per attestato scritto e una con i totali di ogni esecuzione
+TIPO_RIGA = "riga"
+TIPO_TOTALI = "totali"
+NOME_SHARD = re.compile(r"^shard-(\d+)-di-(\d+)\.jsonl$")
+# esecuzioni dei worker i cui totali sono già stati sommati da un'unione precedente
+REGISTRO_UNIONE = "unione.json"
+
+
+def shard_di(nome_file, dimensione, totale):
+    """
+    Shard di un file in base a nome e dimensione: uguale su ogni macchina e a ogni esecuzione,
+    senza leggere il contenuto (ogni worker elenca tutta la cartella, ma calcola l'hash solo dei suoi file).
+    """
+    chiave = hashlib.sha256(f"{nome_file}\0{dimensione}".encode("utf-8")).hexdigest()
+    return int(chiave[:16], 16) % totale
+
+def file_dello_shard(pdf_folder, shard, totale):
+    with os.scandir(pdf_folder) as voci:
+        pdf_files = sorted((voce.name, voce.stat().st_size) for voce in voci if voce.name.lower().endswith(".pdf"))
+    return [nome for nome, dimensione in pdf_files if shard_di(nome, dimensione, totale) == shard]
+
+def percorso_shard(shard, totale, estensione="jsonl", prefisso="shard"):
+    # es. shard-03-di-08.jsonl: l'ordine alfabetico dei file segue quello degli shard
+    cifre = len(str(totale - 1))
+    return os.path.join(shard_dir, f"{prefisso}-{shard:0{cifre}d}-di-{totale}.{estensione}")
+
+
+class ShardWriter:
+    """
+    Stessa interfaccia di ExcelWriter, ma le righe vengono accodate al file intermedio del worker
+    invece che al file Excel condiviso (che viene scritto solo dall'unione).
+    """
+    def __init__(self, percorso, al_salvataggio=None):
+        self.percorso = percorso
+        self.al_salvataggio = al_salvataggio
+        self._lock = threading.RLock()
+        self.in_sospeso = []
+        self.documenti_non_salvati = []
+        self.presenti = {riga["nome_file"] for riga in leggi_shard(percorso) if riga["tipo"] == TIPO_RIGA}
+
+    def nomi_file_presenti(self):
+        return set(self.presenti)
+
+    def scrivi_righe(self, righe, documenti=()):
+        with self._lock:
+            for riga, documento in zip(righe, documenti):
+                self.in_sospeso.append({"tipo": TIPO_RIGA, "nome_file": documento["nome_file"], "hash": documento["hash"], "riga": riga})
+                self.presenti.add(documento["nome_file"])
+            self.documenti_non_salvati.extend(documenti)
+
+    def fine_batch(self):
+        # accodare è economico: ogni batch completato è subito su disco
+        self.salva()
+
+    def _accoda(self, eventi):
+        cartella = os.path.dirname(self.percorso)
+        if cartella:
+            os.makedirs(cartella, exist_ok=True)
+        with open(self.percorso, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(evento, ensure_ascii=False) + "\n" for evento in eventi)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def salva(self):
+        with self._lock:
+            if not self.in_sospeso:
+                return
+            self._accoda(self.in_sospeso)
+            self.in_sospeso = []
+            documenti, self.documenti_non_salvati = self.documenti_non_salvati, []
+        if self.al_salvataggio and documenti:
+            self.al_salvataggio(documenti)
+
+    def registra_totali(self, shared):
+        """
+        Accoda token e metodi di estrazione dell'esecuzione (SharedState del worker), sommati dall'unione.
+        """
+        self.salva()
+        with self._lock:
+            self._accoda([{
+                "tipo": TIPO_TOTALI,
+                "worker": socket.gethostname(),
+                "pid": os.getpid(),
+                "ts": time.time(),
+                "token": {
+                    "input": shared.token_totali_input,
+                    "input_cached": shared.token_totali_input_cached,
+                    "output": shared.token_totali_output,
+                    "bulk_input": shared.token_bulk_input,
+                    "bulk_output": shared.token_bulk_output,
+                },
+                "metodi_estrazione": dict(shared.metodi_estrazione),
+                "file_saltati": shared.file_saltati,
+            }])
+
+
+def leggi_shard(percorso):
+    try:
+        with open(percorso, "r", encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    yield json.loads(linea)
+                except ValueError:
+                    # ultima riga troncata da un worker interrotto
+                    continue
+    except OSError:
+        return
+
+def file_shard():
+    """
+    File intermedi presenti in SHARD_DIR, come lista di (percorso, shard, totale).
+    """
+    try:
+        nomi = sorted(os.listdir(shard_dir))
+    except OSError:
+        return []
+    trovati = []
+    for nome in nomi:
+        corrispondenza = NOME_SHARD.match(nome)
+        if corrispondenza:
+            trovati.append((os.path.join(shard_dir, nome), int(corrispondenza.group(1)), int(corrispondenza.group(2))))
+    return trovati
+
+def _id_esecuzione(evento):
+    return f"{evento.get('worker')}:{evento.get('pid')}:{evento.get('ts')}"
+
+def _leggi_registro():
+    try:
+        with open(os.path.join(shard_dir, REGISTRO_UNIONE), "r", encoding="utf-8") as f:
+            return set(json.load(f).get("totali_uniti", []))
+    except (OSError, ValueError):
+        return set()
+
+def _salva_registro(uniti):
+    percorso = os.path.join(shard_dir, REGISTRO_UNIONE)
+    tmp = f"{percorso}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"totali_uniti": sorted(uniti)}, f)
+    os.replace(tmp, percorso)
+
+def unisci_shard(writer, shared):
+    """
+    Scrive con `writer` (ExcelWriter) le righe di tutti i file intermedi, ordinate per nome file,
+    saltando quelle già presenti nel file Excel; somma in `shared` i totali delle esecuzioni dei worker
+    non ancora contate da un'unione precedente (REGISTRO_UNIONE), così ripetere l'unione non li raddoppia.
+    Ritorna il numero di righe scritte.
+    """
+    trovati = file_shard()
+    if not trovati:
+        print(f"{YELLOW}Nessun file intermedio in {shard_dir}{RESET}")
+        return 0
+
+    totali_attesi = {totale for _, _, totale in trovati}
+    if len(totali_attesi) > 1:
+        print(f"{YELLOW}File intermedi con numeri di shard diversi ({sorted(totali_attesi)}): vengono uniti tutti{RESET}")
+    for totale in totali_attesi:
+        mancanti = sorted(set(range(totale)) - {shard for _, shard, t in trovati if t == totale})
+        if mancanti:
+            print(f"{YELLOW}Shard mancanti su {totale}: {mancanti} (i loro attestati verranno aggiunti alla prossima unione){RESET}")
+
+    presenti = writer.nomi_file_presenti()
+    uniti = _leggi_registro()
+    nuovi_totali = set()
+    righe = {}
+    for percorso, shard, totale in trovati:
+        completato = False
+        for evento in leggi_shard(percorso):
+            if evento["tipo"] == TIPO_RIGA:
+                chiave = (evento["nome_file"], evento["hash"])
+                if evento["nome_file"] not in presenti and chiave not in righe:
+                    righe[chiave] = evento["riga"]
+            elif evento["tipo"] == TIPO_TOTALI:
+                completato = True
+                esecuzione = _id_esecuzione(evento)
+                if esecuzione in uniti or esecuzione in nuovi_totali:
+                    continue
+                nuovi_totali.add(esecuzione)
+                token = evento["token"]
+                shared.token_totali_input += token["input"]
+                shared.token_totali_input_cached += token["input_cached"]
+                shared.token_totali_output += token["output"]
+                shared.token_totali += token["input"] + token["output"]
+                shared.token_bulk_input += token.get("bulk_input", 0)
+                shared.token_bulk_output += token.get("bulk_output", 0)
+                shared.metodi_estrazione.update(evento.get("metodi_estrazione", {}))
+                shared.file_saltati += evento.get("file_saltati", 0)
+        if not completato:
+            print(f"{YELLOW}Lo shard {shard} di {totale} non ha ancora terminato: unite solo le righe già scritte{RESET}")
+
+    # ordine stabile: per nome file, indipendente da quale worker ha finito prima
+    ordinate = sorted(righe.items(), key=lambda voce: voce[0])
+    writer.scrivi_righe([riga for _, riga in ordinate], [{"nome_file": nome, "hash": hash_pdf} for (nome, hash_pdf), _ in ordinate])
+    writer.salva()
+    # registrati solo dopo il salvataggio delle righe
+    if nuovi_totali:
+        _salva_registro(uniti | nuovi_totali)
+    return len(ordinate)
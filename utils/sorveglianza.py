@@ -0,0 +1,83 @@
+# ----- Modalità sorveglianza: PDF in arrivo nella cartella e invio a finestre di tempo/dimensione -----
+import os
+import time
+from gpt.openai_api import limiti_batch, token_intestazione
+from gpt.tokens import TOKEN_OUTPUT_PER_PDF
+from gpt.statistiche import statistiche
+
+
+class CartellaSorvegliata:
+    """
+    Controllo periodico della cartella (polling, nessuna dipendenza esterna): restituisce solo i PDF
+    non ancora visti e completi, cioè con dimensione e data di modifica invariate tra due controlli
+    (un file ancora in copia viene ripreso al controllo successivo).
+    """
+    def __init__(self, cartella, escludi=()):
+        self.cartella = cartella
+        self.visti = set(escludi)
+        # nome -> (dimensione, data di modifica) al controllo precedente
+        self.in_arrivo = {}
+
+    def nuovi_file(self):
+        nuovi = []
+        in_arrivo = {}
+        with os.scandir(self.cartella) as voci:
+            for voce in voci:
+                if voce.name in self.visti or not voce.name.lower().endswith(".pdf") or not voce.is_file():
+                    continue
+                stato = voce.stat()
+                firma = (stato.st_size, stato.st_mtime_ns)
+                if stato.st_size > 0 and self.in_arrivo.get(voce.name) == firma:
+                    nuovi.append(voce.name)
+                    self.visti.add(voce.name)
+                else:
+                    in_arrivo[voce.name] = firma
+        self.in_arrivo = in_arrivo
+        return sorted(nuovi)
+
+
+class MicroBatch:
+    """
+    Attestati in attesa di invio: il batch parte quando raggiunge il budget di token di crea_batch
+    (input o output) oppure quando il primo attestato aspetta da `attesa_max` secondi.
+    """
+    def __init__(self, attesa_max):
+        self.attesa_max = attesa_max
+        self.documenti = []
+        self.token_input = 0
+        self.token_output = 0
+        self.primo_arrivo = None
+
+    def __len__(self):
+        return len(self.documenti)
+
+    def aggiungi(self, documento):
+        if not self.documenti:
+            self.primo_arrivo = time.monotonic()
+        self.documenti.append(documento)
+        self.token_input += documento["token"] + token_intestazione(documento["nome_file"])
+        self.token_output += statistiche.token_output_per_pdf(TOKEN_OUTPUT_PER_PDF)
+
+    def pieno(self):
+        max_input_tokens, max_output_tokens = limiti_batch()
+        return self.token_input >= max_input_tokens or self.token_output >= max_output_tokens
+
+    def pronto(self):
+        return bool(self.documenti) and (self.pieno() or time.monotonic() - self.primo_arrivo >= self.attesa_max)
+
+    def attesa(self, intervallo):
+        """
+        Secondi da attendere prima del prossimo controllo (non oltre la scadenza del batch in attesa).
+        """
+        if not self.documenti:
+            return intervallo
+        scadenza = self.primo_arrivo + self.attesa_max - time.monotonic()
+        return max(0.0, min(intervallo, scadenza))
+
+    def svuota(self):
+        documenti = self.documenti
+        self.documenti = []
+        self.token_input = 0
+        self.token_output = 0
+        self.primo_arrivo = None
+        return documenti